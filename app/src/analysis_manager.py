@@ -1,17 +1,28 @@
 import uuid
 import asyncio
+import copy
 import json
+import keyword
 import os
 import re
+import time
 import requests
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, Set
 import openai
-from .models.requests import StartAnalysisRequest
+from .models.requests import StartAnalysisRequest, VariableRetrievalResponse
 from .utils.prompts import (
     get_db_embedded_prompt,
+    get_agentic_plan_prompt,
     is_database_registered,
 )
-from .code_service import CodeService
+from .code_service import code_service
+from .scheduler import AnalysisScheduler, QueueFullError
+from .result_cache import result_cache
+from .streaming_execution import StatementStreamExecutor
+from .preflight import defined_names, format_problems, preflight
+from .deadline import DeadlineBudget, PHASE_BUDGETS
+from .utils import metrics
+from .utils.tables import table_records
 from .utils.llm_models import (
     get_openai_client,
     get_model_by_id,
@@ -25,19 +36,61 @@ spaces: Dict[str, List[str]] = {}  # analysis_idのリスト
 
 space_history: Dict[str, List[List[Dict]]] = {}  # スペースの履歴を保持するリスト(履歴は二次元配列で)
 
-code_service = CodeService()
+# 実行中（キュー待ちを含む）の分析タスク
+analysis_tasks: Dict[str, asyncio.Task] = {}
+# 分析とは別に動かしているタスク(サンドボックスの事前準備、近似モードの後の正確な結果の計算)
+background_tasks: Set[asyncio.Task] = set()
+
+scheduler = AnalysisScheduler()
 
 ACTION_MODEL_TEMPERATURE = 0.2
 
-def create_space():
+# コード修正時に並列で生成する候補数（1の場合は従来通り逐次で1回だけ修正する）
+REPAIR_CANDIDATES = int(os.getenv("REPAIR_CANDIDATES", "1"))
+# Trueの場合は`n`パラメータで候補をまとめて生成する（未対応のバックエンドでは並列呼び出しを使う）
+REPAIR_USE_N = os.getenv("REPAIR_USE_N", "false").lower() == "true"
+# 2つ目以降の候補の多様性を確保するための温度
+REPAIR_TEMPERATURE = float(os.getenv("REPAIR_TEMPERATURE", "0.7"))
+
+# エージェント型分析で分解するサブ質問の最大数（コードの生成は並列、実行はサンドボックスで1つずつ）
+AGENTIC_MAX_STEPS = int(os.getenv("AGENTIC_MAX_STEPS", "4"))
+
+# /get-table-pageで1回に返す表の最大行数
+TABLE_PAGE_MAX_ROWS = int(os.getenv("TABLE_PAGE_MAX_ROWS", "10000"))
+
+# 近似モードで1クエリが大きなテーブルから読み込む行数の目安（これを超えるテーブルはTABLESAMPLEで読む）
+APPROXIMATE_SAMPLE_ROWS = int(os.getenv("APPROXIMATE_SAMPLE_ROWS", "1000000"))
+# 近似モードの後に標本化せずに実行する正確な結果の計算の締め切りと実行の予算（秒）
+# 近似の分析とは別に数える（近似の分析で使った時間で打ち切られないようにする）
+EXACT_FOLLOWUP_DEADLINE = float(os.getenv("EXACT_FOLLOWUP_DEADLINE", "1800"))
+EXACT_FOLLOWUP_EXECUTION_BUDGET = float(os.getenv("EXACT_FOLLOWUP_EXECUTION_BUDGET", "1200"))
+
+async def create_space():
     """新しいspaceを作成し、space_idを返す"""
     global spaces
     global space_history
     space_id = str(uuid.uuid4())
     spaces[space_id] = []
     space_history[space_id] = []
+    # 最初のクエリまでにサンドボックスのカーネル・名前空間・DB接続を用意しておく
+    _keep_background_task(asyncio.create_task(_prepare_space(space_id)))
     return space_id
 
+def _keep_background_task(task: asyncio.Task):
+    """完了するまでタスクの参照を保持する"""
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def _prepare_space(space_id: str):
+    """サンドボックスにspaceの名前空間を事前に作成させる（失敗しても最初のクエリで作成されるため記録のみ）"""
+    try:
+        result = await code_service.prepare_space(space_id)
+    except Exception as e:
+        print(f"Failed to prepare sandbox for space {space_id}: {e}")
+        return
+    if "error" in result:
+        print(f"Failed to prepare sandbox for space {space_id}: {result['error']}")
+
 def get_space(space_id: str) -> List[str]:
     """指定されたspace_idの分析IDリストを取得"""
     return spaces.get(space_id, [])
@@ -49,6 +102,9 @@ def start_analysis(request: StartAnalysisRequest) -> str:
     global space_history
     # バリデーション
     _validate_request(request)
+    # キューが満杯なら受け付けない
+    if scheduler.is_full():
+        raise QueueFullError("Analysis queue is full. Please try again later.")
     if request.index != -1:
         # 履歴のindexが指定されている場合、そのindexまで履歴を戻す
         print(f"Reverting to history index {request.index} for space {request.space_id}")
@@ -61,6 +117,8 @@ def start_analysis(request: StartAnalysisRequest) -> str:
             raise ValueError("Invalid history index")
     analysis_id = str(uuid.uuid4())
     spaces[request.space_id].append(analysis_id)
+    # この分析で作られる履歴のindex
+    version = len(space_history[request.space_id])
     
     analysis_states[analysis_id] = {
         "query": request.query,
@@ -74,21 +132,170 @@ def start_analysis(request: StartAnalysisRequest) -> str:
         "content": [],
         "steps": [],
         "full_response": "",
+        "metrics": {},
     }
+    submitted_at = time.monotonic()
 
-    # 非同期でAI分析を開始
+    # 非同期でAI分析を開始（スケジューラ経由でモデルごとの同時実行数を制御）
     if request.mode == "agentic":
         # エージェント型分析
         print("Starting agentic analysis...")
-        asyncio.create_task(_run_analysis(request.space_id,analysis_id, request))
+        run = lambda: _run_agentic_analysis(request.space_id, analysis_id, request, submitted_at)
     else:
         # 通常の分析
         print("Starting standard analysis...")
-        asyncio.create_task(_run_analysis(request.space_id,analysis_id, request))
+        run = lambda: _run_analysis(request.space_id, analysis_id, request, submitted_at)
         # asyncio.create_task(_run_analysis_non_streaming(analysis_id, request))
+    job = lambda: _run_from_version(request.space_id, version, request.index != -1, run)
+    task = scheduler.submit(
+        request.model,
+        analysis_id,
+        job,
+        priority=request.priority,
+        on_position=lambda position: _set_queue_position(analysis_id, position),
+    )
+    analysis_tasks[analysis_id] = task
+    task.add_done_callback(lambda _: analysis_tasks.pop(analysis_id, None))
 
     return analysis_id
 
+def cancel_analysis(analysis_id: str) -> bool:
+    """実行中の分析をキャンセルする。キャンセルできた場合はTrueを返す"""
+    if analysis_id not in analysis_states:
+        raise ValueError("Analysis ID not found")
+    state = analysis_states[analysis_id]
+    task = analysis_tasks.get(analysis_id)
+    if state["done"] or task is None:
+        return False
+    task.cancel()
+    # キュー待ちのままキャンセルされた場合に備えてここでも状態を更新する
+    state["error"] = "Analysis cancelled"
+    state["done"] = True
+    state["progress"] = ""
+    return True
+
+async def _run_from_version(space_id: str, version: int, revert: bool, run):
+    """
+    サンドボックスの名前空間を履歴のindexに合わせてから分析を実行する
+    (履歴を戻した場合はスナップショットから復元し、分析の開始時点のスナップショットを保存する)
+    """
+    if revert:
+        result = await code_service.revert_space(space_id, version)
+        if "error" in result:
+            # スナップショットがない場合は名前空間を戻さずに続行する
+            print(f"Could not revert space {space_id} to history index {version}: {result['error']}")
+    await code_service.checkpoint_space(space_id, version)
+    await run()
+
+def _set_queue_position(analysis_id: str, position: int):
+    """キュー待ちの順番をprogressに反映する"""
+    state = analysis_states.get(analysis_id)
+    if state is not None and not state["done"]:
+        state["progress"] = f"Waiting in queue (position {position})..."
+
+async def _execute_code(
+    python_code: str,
+    space_id: str,
+    budget: DeadlineBudget,
+    snapshot: bool = True,
+    analysis_metrics: Optional[Dict[str, Any]] = None,
+    sample_rows: Optional[int] = None,
+    sampling: Optional[Dict[str, float]] = None,
+):
+    """
+    サンドボックスの同時実行数制限のもとで、実行フェーズの残り時間を上限にコードを実行する
+    近似モードではsample_rowsを渡し、標本化したテーブルとサンプリング率をsamplingに集める
+    """
+    async with scheduler.sandbox_slot():
+        started_at = time.perf_counter()
+        result = None
+        try:
+            result = await code_service.code_execution(
+                python_code,
+                space_id,
+                snapshot=snapshot,
+                timeout=budget.remaining("execution"),
+                sample_rows=sample_rows,
+            )
+            if sampling is not None:
+                for sample in ((result or {}).get("result") or {}).get("sampling") or []:
+                    sampling[sample["table"]] = min(sample["percent"], sampling.get(sample["table"], 100.0))
+            return result
+        finally:
+            if analysis_metrics is not None:
+                analysis_metrics["code_execution"] = (
+                    analysis_metrics.get("code_execution", 0.0) + time.perf_counter() - started_at
+                )
+                _add_sandbox_usage(analysis_metrics, result)
+
+async def _preflight_error(
+    python_code: str,
+    space_id: str,
+    analysis_metrics: Optional[Dict[str, Any]] = None,
+    preceding_code: str = "",
+) -> str:
+    """
+    サンドボックスで実行する前にコードを検査し、問題があれば修正依頼に渡すエラーメッセージを返す
+    spaceの過去の分析で定義した変数と、同じブロックで先に実行した文(preceding_code)で定義した変数は
+    名前空間に残っているため定義済みとして扱う
+    サブ分析の取り込み時に名前を変えた変数などはコードに現れないため、サンドボックスの名前空間の変数名も加える
+    """
+    known_names = defined_names(preceding_code) if preceding_code else set()
+    for history in space_history.get(space_id, []):
+        for message in history:
+            if message["role"] == "assistant":
+                known_names |= defined_names(_extract_python_code(message["content"]))
+    known_names |= await code_service.get_names(space_id) or set()
+    problems = await preflight(python_code, known_names)
+    if not problems:
+        return ""
+    for kind, _ in problems:
+        metrics.PREFLIGHT_PROBLEMS.inc(kind=kind)
+    if analysis_metrics is not None:
+        analysis_metrics["preflight_problems"] = analysis_metrics.get("preflight_problems", 0) + len(problems)
+    return format_problems(problems)
+
+def _add_sandbox_usage(analysis_metrics: Dict[str, Any], result: Optional[Dict[str, Any]]):
+    """サンドボックスが返した実行ごとの資源使用量を分析全体で集計する"""
+    usage = (result or {}).get("usage") or ((result or {}).get("result") or {}).get("usage")
+    if not usage:
+        return
+    analysis_metrics["sandbox_cpu_seconds"] = analysis_metrics.get("sandbox_cpu_seconds", 0.0) + usage.get("cpu_seconds", 0.0)
+    analysis_metrics["sandbox_peak_rss_delta_bytes"] = max(
+        analysis_metrics.get("sandbox_peak_rss_delta_bytes", 0), usage.get("peak_rss_delta_bytes", 0)
+    )
+    analysis_metrics["sandbox_db_rows"] = analysis_metrics.get("sandbox_db_rows", 0) + usage.get("db_rows", 0)
+
+def _record_metrics(state: Dict[str, Any], model: str):
+    """分析ごとのメトリクスをアプリ全体のヒストグラムに反映する"""
+    analysis_metrics = state["metrics"]
+    if "queue_wait" in analysis_metrics:
+        metrics.QUEUE_WAIT.observe(analysis_metrics["queue_wait"], model=model)
+    if "time_to_first_token" in analysis_metrics:
+        metrics.TIME_TO_FIRST_TOKEN.observe(analysis_metrics["time_to_first_token"], model=model)
+    if "tokens_per_second" in analysis_metrics:
+        metrics.TOKENS_PER_SECOND.observe(analysis_metrics["tokens_per_second"], model=model)
+    if "code_execution" in analysis_metrics:
+        metrics.CODE_EXECUTION.observe(analysis_metrics["code_execution"])
+    metrics.REPAIR_COUNT.observe(analysis_metrics.get("repair_count", 0))
+    if "variable_fetch" in analysis_metrics:
+        metrics.VARIABLE_FETCH.observe(analysis_metrics["variable_fetch"])
+    if "content_render" in analysis_metrics:
+        metrics.CONTENT_RENDER.observe(analysis_metrics["content_render"])
+    if state["error"] == "Analysis cancelled":
+        outcome = "cancelled"
+    elif state["error"]:
+        outcome = "error"
+    else:
+        outcome = "success"
+    metrics.ANALYSES_TOTAL.inc(outcome=outcome)
+
+async def _stop_code_task(code_task, space_id: str):
+    """実行中のコードタスクを中断し、サンドボックス側の実行も止める"""
+    if code_task is not None and not code_task.done():
+        code_task.cancel()
+        await code_service.interrupt(space_id)
+
 def _validate_request(request: StartAnalysisRequest):
     """リクエストのバリデーション"""
     # データベース登録チェック
@@ -100,16 +307,51 @@ def _validate_request(request: StartAnalysisRequest):
         raise ValueError("クエリが短すぎます")
 
 
-async def _run_analysis(space_id:str,analysis_id: str, request: StartAnalysisRequest):
+async def _run_analysis(
+    space_id:str,analysis_id: str, request: StartAnalysisRequest, submitted_at: Optional[float] = None
+):
     """実際の分析処理を行う"""
     global analysis_states
     global space_history
+    state = analysis_states[analysis_id]
+    analysis_metrics = state["metrics"]
+    if submitted_at is not None:
+        analysis_metrics["queue_wait"] = time.monotonic() - submitted_at
+    budget = DeadlineBudget()
+    stream = None
+    stream_executor = None
+    code_task = None
+    # 近似モードの行数の予算と、標本化したテーブルのサンプリング率
+    sample_rows = APPROXIMATE_SAMPLE_ROWS if request.mode == "approximate" else None
+    sampling: Dict[str, float] = {}
+    exact_fork_id = None
     try:
-        state = analysis_states[analysis_id]
-
         # プログレス更新
         state["progress"] = "Thinking..."
 
+        # 同じ質問の結果がキャッシュにあれば再利用する
+        cache_key = result_cache.make_key(
+            request.query,
+            request.tables,
+            request.model,
+            request.mode,
+            space_history[space_id],
+        )
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            if await _restore_cached_result(space_id, analysis_id, request, cached, budget):
+                return
+            # 復元に失敗した場合はキャッシュを破棄して通常の分析を行う
+            result_cache.discard(cache_key)
+            state["error"] = ""
+            state["progress"] = "Thinking..."
+
+        if sample_rows is not None and request.exact_followup:
+            # 正確な結果を後で計算するため、近似のコードを実行する前の名前空間をフォークしておく
+            exact_fork_id = f"{space_id}:exact:{uuid.uuid4().hex[:8]}"
+            if "error" in await code_service.fork_space(space_id, exact_fork_id):
+                exact_fork_id = None
+
         # OpenAIクライアントの設定
         print("Starting analysis with model:", request.model)
         # カスタムモデルが指定されている場合は現在未対応
@@ -123,37 +365,88 @@ async def _run_analysis(space_id:str,analysis_id: str, request: StartAnalysisReq
         for history in space_history[space_id]:
             messages.extend(history)
         messages.append({"role": "user", "content": request.query})
-        stream = await actionmodel_client.chat.completions.create(
-            model=model["model_name"],
-            messages=messages,
-            temperature=ACTION_MODEL_TEMPERATURE,
-            stream=True,
-            **model["config"],
+        requested_at = time.perf_counter()
+        first_token_at = None
+        chunk_count = 0
+        stream = await asyncio.wait_for(
+            actionmodel_client.chat.completions.create(
+                model=model["model_name"],
+                messages=messages,
+                temperature=ACTION_MODEL_TEMPERATURE,
+                stream=True,
+                **model["config"],
+            ),
+            timeout=budget.remaining("llm"),
         )
         full_response = ""
         executed = False
-        code_task = None
+        preflight_error = ""
+        # 文単位のストリーミング実行（オプトイン）
+        if request.streaming_execution:
+            stream_executor = StatementStreamExecutor(
+                lambda code, snapshot: _execute_code(
+                    code,
+                    space_id,
+                    budget,
+                    snapshot=snapshot,
+                    analysis_metrics=analysis_metrics,
+                    sample_rows=sample_rows,
+                    sampling=sampling,
+                ),
+                lambda: code_service.code_rollback(space_id),
+                lambda code, preceding: _preflight_error(code, space_id, analysis_metrics, preceding),
+                interrupt=lambda: code_service.interrupt(space_id),
+            )
 
-        # ストリーミング処理
-        async for chunk in stream:
+        # ストリーミング処理（LLMフェーズの予算を超えたら打ち切る）
+        stream_iter = stream.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(
+                    stream_iter.__anext__(), timeout=budget.remaining("llm")
+                )
+            except StopAsyncIteration:
+                break
             if chunk.choices[0].delta.content is not None:
                 content = chunk.choices[0].delta.content
                 full_response += content
+                chunk_count += 1
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    analysis_metrics["time_to_first_token"] = first_token_at - requested_at
             if "<python>" not in full_response:
                 state["progress"] = f"Thinking... {full_response[-20:]}"
             # Pythonコード実行開始の検出
             if "<python>" in full_response and "</python>" not in full_response:
                 state["progress"] = "Executing Python code..."
+                if stream_executor is not None:
+                    cleaned_response = _del_think_tag(full_response)
+                    if "<think>" not in cleaned_response and "<python>" in cleaned_response:
+                        stream_executor.feed(cleaned_response.split("<python>")[1])
 
             # Pythonコード実行
             if not executed and "</python>" in full_response:
                 executed = True
+                budget.start("execution")
                 python_code = _del_think_tag(full_response).split("<python>")[1].split("</python>")[0]
                 state["python_code"] = python_code
                 # 非ブロッキングでコード実行を開始
-                code_task = asyncio.create_task(
-                    code_service.code_execution(python_code, space_id)
-                )
+                if stream_executor is not None:
+                    code_task = asyncio.create_task(stream_executor.finish(python_code))
+                else:
+                    # 実行前の検査で問題が見つかった場合はサンドボックスで実行せずに修正に回す
+                    preflight_error = await _preflight_error(python_code, space_id, analysis_metrics)
+                    if not preflight_error:
+                        code_task = asyncio.create_task(
+                            _execute_code(
+                                python_code,
+                                space_id,
+                                budget,
+                                analysis_metrics=analysis_metrics,
+                                sample_rows=sample_rows,
+                                sampling=sampling,
+                            )
+                        )
 
             # レポート生成の検出
             if "<report>" in full_response and "</report>" not in full_response:
@@ -161,20 +454,32 @@ async def _run_analysis(space_id:str,analysis_id: str, request: StartAnalysisReq
                 report_buffer = _del_think_tag(full_response).split("<report>")[1]
                 state["content"] = [{"type": "markdown", "content": report_buffer}]
 
-        # コードの実行が完了するまで待機（タイムアウト付き）
-        if code_task and not code_task.done():
+        # コードの実行が完了するまで待機（実行フェーズの予算でタイムアウト）
+        if preflight_error:
+            code_result = {"code_error": preflight_error}
+        elif code_task and not code_task.done():
             try:
-                # 最大10秒間待機
-                code_result = await asyncio.wait_for(code_task, timeout=10.0)
+                code_result = await asyncio.wait_for(
+                    asyncio.shield(code_task), timeout=budget.remaining("execution")
+                )
             except asyncio.TimeoutError:
+                await _stop_code_task(code_task, space_id)
                 state["error"] = "Code execution timed out"
                 state["done"] = True
+                state["progress"] = ""
                 return
         else:
             code_result = (
                 code_task.result() if code_task else {"result": "No code executed"}
             )
-        print(full_response)
+        if stream_executor is not None and stream_executor.check_error:
+            # 文単位の実行でも検査で失敗した場合は何も実行していないため、修正時にロールバックしない
+            preflight_error = stream_executor.check_error
+        if first_token_at is not None and chunk_count > 1:
+            # ストリームのチャンク数をトークン数の近似として生成速度を計算
+            generation_time = time.perf_counter() - first_token_at
+            if generation_time > 0:
+                analysis_metrics["tokens_per_second"] = (chunk_count - 1) / generation_time
         if full_response == "":
             state["error"] = "No response from model"
             state["done"] = True
@@ -189,54 +494,92 @@ async def _run_analysis(space_id:str,analysis_id: str, request: StartAnalysisReq
             #
             #
             state["progress"] = "Fixing code execution error..."
-            message = f"以下のエラーが発生しました。\n{error_msg}\n\n修正後のpythonコードを<python></python>タグで囲んで返してください。"
+            message = _repair_message(error_msg)
             messages.append({"role": "assistant", "content": full_response})
             messages.append({"role": "user", "content": message})
-            fixed_response = await actionmodel_client.chat.completions.create(
-                model=model["model_name"],
-                messages=messages,
-                temperature=ACTION_MODEL_TEMPERATURE,
-            )
-            if not fixed_response.choices or not fixed_response.choices[0].message:
-                state["error"] = "モデルからの応答がありません。"
-                state["done"] = True
-                return
-            fixed_full_response = fixed_response.choices[0].message.content
-            print("## 修正後のコード")
-            print(fixed_full_response)
-            if (
-                "<python>" not in fixed_full_response
-                or "</python>" not in fixed_full_response
-            ):
-                state["error"] = "修正されたpythonコードがありません。"
-                state["done"] = True
-                return
-            fixed_python_code = _del_think_tag(fixed_full_response).split("<python>")[1].split(
-                "</python>"
-            )[0]
-            state["python_code"] = fixed_python_code
-            # full_response 内のpythonタグの内容をfixed_python_codeに置き換える
-            full_response = full_response.split("<python>")[0] + "<python>" + fixed_python_code + "</python>" + full_response.split("</python>")[1]
-            # 修正されたコードを再実行
-            code_task = await code_service.code_execution(
-                fixed_python_code, space_id
-            )
-            if code_task and ("error" in code_task or "code_error" in code_task):
-                error_msg = code_task.get(
-                    "error", code_task.get("code_error", "Unknown error")
+            analysis_metrics["repair_count"] = analysis_metrics.get("repair_count", 0) + 1
+            if REPAIR_CANDIDATES > 1:
+                # 複数の修正候補を並列に生成し、生成できた順に実行して最初に成功したものを採用する
+                fixed_python_code, repair_error = await _repair_with_candidates(
+                    space_id, messages, actionmodel_client, model, budget, analysis_metrics,
+                    rollback=not preflight_error,
+                    sample_rows=sample_rows,
+                    sampling=sampling,
                 )
-                state["progress"] = f"再実行後のコード実行エラー: {error_msg}"
-                state["done"] = True
-                state["error"] = f"再実行後のコード実行エラー: {error_msg}"
-                return
+                if repair_error:
+                    state["progress"] = f"再実行後のコード実行エラー: {repair_error}"
+                    state["done"] = True
+                    state["error"] = f"再実行後のコード実行エラー: {repair_error}"
+                    return
+                state["python_code"] = fixed_python_code
+                full_response = full_response.split("<python>")[0] + "<python>" + fixed_python_code + "</python>" + full_response.split("</python>")[1]
+            else:
+                fixed_response = await asyncio.wait_for(
+                    actionmodel_client.chat.completions.create(
+                        model=model["model_name"],
+                        messages=messages,
+                        temperature=ACTION_MODEL_TEMPERATURE,
+                    ),
+                    timeout=budget.remaining("llm"),
+                )
+                if not fixed_response.choices or not fixed_response.choices[0].message:
+                    state["error"] = "モデルからの応答がありません。"
+                    state["done"] = True
+                    return
+                fixed_full_response = fixed_response.choices[0].message.content
+                print("## 修正後のコード")
+                print(fixed_full_response)
+                if (
+                    "<python>" not in fixed_full_response
+                    or "</python>" not in fixed_full_response
+                ):
+                    state["error"] = "修正されたpythonコードがありません。"
+                    state["done"] = True
+                    return
+                fixed_python_code = _del_think_tag(fixed_full_response).split("<python>")[1].split(
+                    "</python>"
+                )[0]
+                state["python_code"] = fixed_python_code
+                # full_response 内のpythonタグの内容をfixed_python_codeに置き換える
+                full_response = full_response.split("<python>")[0] + "<python>" + fixed_python_code + "</python>" + full_response.split("</python>")[1]
+                # 修正されたコードを再実行
+                code_task = await _execute_code(
+                    fixed_python_code,
+                    space_id,
+                    budget,
+                    analysis_metrics=analysis_metrics,
+                    sample_rows=sample_rows,
+                    sampling=sampling,
+                )
+                if code_task and ("error" in code_task or "code_error" in code_task):
+                    error_msg = code_task.get(
+                        "error", code_task.get("code_error", "Unknown error")
+                    )
+                    state["progress"] = f"再実行後のコード実行エラー: {error_msg}"
+                    state["done"] = True
+                    state["error"] = f"再実行後のコード実行エラー: {error_msg}"
+                    return
         if "</report>" not in full_response:
             full_response += "\n</report>"
         state["full_response"] = full_response
         # レスポンスの解析とコンテンツの生成
-        content = await _parse_response_to_content(
-            full_response, space_id, ignore_errors=True
+        render_started_at = time.perf_counter()
+        content = await asyncio.wait_for(
+            _parse_response_to_content(
+                full_response, space_id, ignore_errors=True, analysis_metrics=analysis_metrics
+            ),
+            timeout=budget.remaining("render"),
         )
+        analysis_metrics["content_render"] = time.perf_counter() - render_started_at
+        if sampling:
+            state["sampling"] = [{"table": table, "percent": percent} for table, percent in sampling.items()]
+            content.insert(0, _sampling_label(sampling))
         state["content"] = content
+        # 標本化した近似の結果はキャッシュしない(正確な結果への置き換えがキャッシュからは行われないため)
+        if not sampling:
+            result_cache.put(
+                cache_key, request.tables, state["python_code"], full_response, content
+            )
 
         # 完了
         state["done"] = True
@@ -248,12 +591,483 @@ async def _run_analysis(space_id:str,analysis_id: str, request: StartAnalysisReq
         # 通常の分析の時は全部履歴に入れる
         space_history[space_id].append([{"role":"user", "content": request.query},{"role":"assistant", "content": full_response}])
 
+        if exact_fork_id is not None and sampling:
+            # 近似の結果を返した後、標本化せずに同じコードを実行して内容を置き換える
+            state["exact_pending"] = True
+            task = asyncio.get_running_loop().create_task(
+                _run_exact_followup(space_id, analysis_id, exact_fork_id, state["python_code"], full_response)
+            )
+            _keep_background_task(task)
+            exact_fork_id = None
+
+    except asyncio.CancelledError:
+        # ユーザーによるキャンセル: サンドボックスの実行も中断する
+        print(f"Analysis cancelled: {analysis_id}")
+        await _stop_code_task(code_task, space_id)
+        state["error"] = "Analysis cancelled"
+        state["done"] = True
+        state["progress"] = ""
+        raise
+    except asyncio.TimeoutError:
+        print(f"Analysis deadline exceeded for {analysis_id}")
+        await _stop_code_task(code_task, space_id)
+        state["error"] = "Analysis timed out"
+        state["done"] = True
+        state["progress"] = ""
     except Exception as e:
         print(f"Analysis error for {analysis_id}: {str(e)}")
-        state = analysis_states.get(analysis_id, {})
+        await _stop_code_task(code_task, space_id)
+        state["error"] = f"Error: {str(e)}"
+        state["done"] = True
+        state["progress"] = ""
+    finally:
+        # 正確な結果の計算を行わない場合はフォークを破棄する
+        if exact_fork_id is not None:
+            await code_service.drop_space(exact_fork_id)
+        # LLMのストリームを閉じて生成を止める
+        if stream is not None:
+            await stream.close()
+        # </python>に到達せずに終了した場合はストリーミング実行中の文も止め、実行済みの文を取り消す
+        if stream_executor is not None:
+            await stream_executor.abort()
+        _record_metrics(state, request.model)
+
+async def _repair_with_candidates(
+    space_id: str,
+    messages: List[Dict],
+    actionmodel_client,
+    model: Dict[str, Any],
+    budget: DeadlineBudget,
+    analysis_metrics: Optional[Dict[str, Any]] = None,
+    rollback: bool = True,
+    sample_rows: Optional[int] = None,
+    sampling: Optional[Dict[str, float]] = None,
+):
+    """
+    修正候補を並列に生成し、それぞれフォークした名前空間で実行する。
+    同じスペースのフォークはサンドボックスで1つずつ実行されるため、生成できた順に実行される
+    最初に成功した候補を採用して残りはキャンセルし、(修正後のコード, エラー)を返す
+    """
+    # 失敗した実行の途中状態を取り除いてからフォークする（実行前の検査で止めた場合は不要）
+    if rollback:
+        await code_service.code_rollback(space_id)
+    fork_ids = [f"{space_id}:repair:{uuid.uuid4().hex[:8]}" for _ in range(REPAIR_CANDIDATES)]
+
+    shared_response = None
+    if REPAIR_USE_N:
+        shared_response = asyncio.ensure_future(
+            asyncio.wait_for(
+                actionmodel_client.chat.completions.create(
+                    model=model["model_name"],
+                    messages=messages,
+                    temperature=REPAIR_TEMPERATURE,
+                    n=REPAIR_CANDIDATES,
+                ),
+                timeout=budget.remaining("llm"),
+            )
+        )
+
+    async def _candidate(index: int) -> str:
+        if shared_response is not None:
+            response = await shared_response
+            choice_index = index
+        else:
+            response = await asyncio.wait_for(
+                actionmodel_client.chat.completions.create(
+                    model=model["model_name"],
+                    messages=messages,
+                    temperature=ACTION_MODEL_TEMPERATURE if index == 0 else REPAIR_TEMPERATURE,
+                ),
+                timeout=budget.remaining("llm"),
+            )
+            choice_index = 0
+        if len(response.choices) <= choice_index or not response.choices[choice_index].message:
+            raise ValueError("モデルからの応答がありません。")
+        fixed_full_response = response.choices[choice_index].message.content or ""
+        if "<python>" not in fixed_full_response or "</python>" not in fixed_full_response:
+            raise ValueError("修正されたpythonコードがありません。")
+        fixed_python_code = _del_think_tag(fixed_full_response).split("<python>")[1].split("</python>")[0]
+        fork_result = await code_service.fork_space(space_id, fork_ids[index])
+        if "error" in fork_result:
+            raise ValueError(fork_result["error"])
+        result = await _execute_code(
+            fixed_python_code,
+            fork_ids[index],
+            budget,
+            analysis_metrics=analysis_metrics,
+            sample_rows=sample_rows,
+            sampling=sampling,
+        )
+        if result and ("error" in result or "code_error" in result):
+            raise ValueError(result.get("error", result.get("code_error", "Unknown error")))
+        return fixed_python_code
+
+    tasks = {asyncio.create_task(_candidate(i)): i for i in range(REPAIR_CANDIDATES)}
+    pending = set(tasks)
+    winner = None
+    last_error = "Unknown error"
+    try:
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if winner is None:
+                        winner = (tasks[task], task.result())
+                else:
+                    last_error = str(task.exception())
+                    print(f"Repair candidate {tasks[task]} failed: {last_error}")
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if shared_response is not None and not shared_response.done():
+            shared_response.cancel()
+
+    if winner is not None:
+        promote_result = await code_service.promote_fork(space_id, fork_ids[winner[0]])
+        if "error" in promote_result:
+            # 採用できなかった場合は成功した候補のフォークも破棄する
+            last_error = f"修正候補の名前空間を採用できませんでした: {promote_result['error']}"
+            winner = None
+    for index, fork_id in enumerate(fork_ids):
+        if winner is None or index != winner[0]:
+            await code_service.drop_space(fork_id)
+    if winner is None:
+        return "", last_error
+    return winner[1], ""
+
+async def _restore_cached_result(
+    space_id: str,
+    analysis_id: str,
+    request: StartAnalysisRequest,
+    cached: Dict[str, Any],
+    budget: DeadlineBudget,
+):
+    """キャッシュされた結果を復元する（LLM生成は行わない）。成功したらTrueを返す"""
+    state = analysis_states[analysis_id]
+    state["python_code"] = cached["python_code"]
+    if cached["python_code"]:
+        # 後続の質問で変数を参照できるように、キャッシュしたコードをこのスペースで再実行
+        state["progress"] = "Executing Python code..."
+        code_result = await _execute_code(
+            cached["python_code"],
+            space_id,
+            budget,
+            analysis_metrics=state["metrics"],
+            sample_rows=APPROXIMATE_SAMPLE_ROWS if request.mode == "approximate" else None,
+        )
+        if code_result and ("error" in code_result or "code_error" in code_result):
+            error_msg = code_result.get(
+                "error", code_result.get("code_error", "Unknown error")
+            )
+            print(f"Cached code execution error: {error_msg}")
+            return False
+    state["full_response"] = cached["full_response"]
+    # キャッシュの項目を後から書き換えないようにコピーし、表の続きのページをこのスペースから取得する
+    content = copy.deepcopy(cached["content"])
+    if any(item.get("type") == "table" and "source" in item for item in content):
+        names = await code_service.get_names(space_id)
+        for item in content:
+            if item.get("type") == "table" and "source" in item:
+                if names is not None and item["source"]["name"] in names:
+                    item["source"]["id"] = space_id
+                else:
+                    del item["source"]
+    state["content"] = content
+    state["done"] = True
+    state["progress"] = ""
+    space_history[space_id].append([{"role":"user", "content": request.query},{"role":"assistant", "content": cached["full_response"]}])
+    return True
+
+def _sampling_label(sampling: Dict[str, float]) -> Dict[str, Any]:
+    """近似モードの結果であることとサンプリング率を示すレポート冒頭のブロック"""
+    rates = ", ".join(f"`{table}` {percent:g}%" for table, percent in sorted(sampling.items()))
+    return {
+        "type": "markdown",
+        "content": (
+            f"> **Approximate result** — computed on a random sample of large tables ({rates}). "
+            "Counts and totals reflect the sample and are not scaled up."
+        ),
+    }
+
+async def _run_exact_followup(
+    space_id: str,
+    analysis_id: str,
+    fork_id: str,
+    python_code: str,
+    full_response: str,
+):
+    """
+    近似モードの分析と同じコードを、近似の実行前にフォークした名前空間で標本化せずに実行し、
+    完了したらレポートの内容を正確な結果に置き換える
+    """
+    state = analysis_states[analysis_id]
+    promoted = False
+    budget = _exact_followup_budget()
+    try:
+        result = await _execute_code(python_code, fork_id, budget)
+        if result and ("error" in result or "code_error" in result):
+            print(f"Exact follow-up failed for {analysis_id}: {result.get('error', result.get('code_error'))}")
+            return
+        content = await _parse_response_to_content(full_response, fork_id, ignore_errors=True)
+        # 後続の分析が始まっていなければ、正確な結果の変数をspaceに反映する
+        if get_space(space_id)[-1:] == [analysis_id]:
+            promote_result = await code_service.promote_fork(space_id, fork_id)
+            promoted = "error" not in promote_result
+        _retarget_table_sources(content, space_id if promoted else None)
+        state["content"] = content
+        state.pop("sampling", None)
+    except Exception as e:
+        print(f"Exact follow-up error for {analysis_id}: {e}")
+    finally:
+        state["exact_pending"] = False
+        if not promoted:
+            await code_service.drop_space(fork_id)
+
+def _exact_followup_budget() -> DeadlineBudget:
+    return DeadlineBudget(
+        EXACT_FOLLOWUP_DEADLINE,
+        {"llm": 0.0, "execution": EXACT_FOLLOWUP_EXECUTION_BUDGET, "render": PHASE_BUDGETS["render"]},
+    )
+
+def _retarget_table_sources(
+    content: List[Dict[str, Any]], access_id: Optional[str], renamed: Optional[Dict[str, str]] = None
+) -> None:
+    """
+    フォークから描画した表の続きのページの取得先を、変数を取り込んだaccess_idに付け替える
+    取り込み時に名前を変えた変数(renamed)は、取得する変数名も付け替える
+    フォークを取り込まずに破棄する場合(access_idがNone)は続きのページを取得できないため取得先を消す
+    """
+    for item in content:
+        if item.get("type") == "table" and "source" in item:
+            if access_id is not None:
+                item["source"]["id"] = access_id
+                item["source"]["name"] = (renamed or {}).get(item["source"]["name"], item["source"]["name"])
+            else:
+                del item["source"]
+
+def _is_plain_identifier(name: str) -> bool:
+    return name.strip().isidentifier() and not keyword.iskeyword(name.strip())
+
+def _repair_message(error_msg: str) -> str:
+    return f"以下のエラーが発生しました。\n{error_msg}\n\n修正後のpythonコードを<python></python>タグで囲んで返してください。"
+
+def _extract_python_code(response: str) -> str:
+    """応答から<python>タグ内のコードを取り出す（タグがなければ空文字）"""
+    cleaned = _del_think_tag(response)
+    if "<python>" not in cleaned or "</python>" not in cleaned:
+        return ""
+    return cleaned.split("<python>")[1].split("</python>")[0]
+
+def _extract_report(response: str) -> str:
+    match = re.search(r"<report>(.*?)(</report>|$)", _del_think_tag(response), re.IGNORECASE | re.DOTALL)
+    return match.group(1).strip() if match else ""
+
+async def _run_agentic_analysis(
+    space_id: str, analysis_id: str, request: StartAnalysisRequest, submitted_at: Optional[float] = None
+):
+    """
+    エージェント型分析: 質問を独立したサブ質問に分解し、同じspaceをフォークした名前空間で
+    分析して1つのレポートに統合する（LLMの呼び出しは並列、コードの実行はサンドボックスで1つずつ）
+    """
+    global space_history
+    state = analysis_states[analysis_id]
+    analysis_metrics = state["metrics"]
+    if submitted_at is not None:
+        analysis_metrics["queue_wait"] = time.monotonic() - submitted_at
+    budget = DeadlineBudget()
+    fork_ids: List[str] = []
+    delegated = False
+    try:
+        state["progress"] = "Planning..."
+        actionmodel_client = get_openai_client(request.model)
+        model = get_model_by_id(request.model)
+        sub_queries = await _plan_sub_queries(request, actionmodel_client, model, budget)
+        if len(sub_queries) <= 1:
+            # 分解できない質問は通常の分析として実行する
+            delegated = True
+            await _run_analysis(space_id, analysis_id, request, submitted_at)
+            return
+
+        if "quelmap" in model["model_name"] or "lightning" in model["model_name"]:
+            base_messages = [{"role": "system", "content": get_db_embedded_prompt(request.tables)[1]}]
+        else:
+            base_messages = [{"role": "system", "content": get_db_embedded_prompt(request.tables)[0]}]
+        for history in space_history[space_id]:
+            base_messages.extend(history)
+
+        fork_ids = [f"{space_id}:agent:{uuid.uuid4().hex[:8]}" for _ in sub_queries]
+        state["steps"] = [{"type": "code", "query": q, "python": "", "content": ""} for q in sub_queries]
+        state["progress"] = f"Running {len(sub_queries)} sub-analyses..."
+        results = await asyncio.gather(*[
+            _run_sub_analysis(
+                space_id, fork_ids[i], state["steps"][i], base_messages,
+                actionmodel_client, model, budget, analysis_metrics,
+            )
+            for i in range(len(sub_queries))
+        ])
+
+        # サブ分析の結果を1つのレポートに統合する
+        state["progress"] = "Merging results..."
+        content: List[Dict[str, Any]] = []
+        python_sections = []
+        report_sections = []
+        for index, (step, fork_id, result) in enumerate(zip(state["steps"], fork_ids, results)):
+            content.append({"type": "markdown", "content": f"## {step['query']}"})
+            if result["error"]:
+                content.append({"type": "markdown", "content": f"Error: {result['error']}"})
+                report_sections.append(f"## {step['query']}\nError: {result['error']}")
+                continue
+            if result["python_code"]:
+                # 後続の質問で参照できるようにサブ分析の変数をspaceに取り込む
+                # (先に取り込んだサブ分析の変数と名前が衝突する変数は接頭辞を付けて取り込む)
+                merge_result = await code_service.merge_fork(space_id, fork_id, prefix=f"step{index + 1}_")
+                renamed = {} if "error" in merge_result else merge_result["result"].get("renamed") or {}
+                python_section = f"# {step['query']}\n{result['python_code'].strip()}"
+                if renamed:
+                    python_section += "\n" + "\n".join(
+                        f"# 変数名が衝突したため {name} は {new_name} として取り込み済み" for name, new_name in renamed.items()
+                    )
+                python_sections.append(python_section)
+                # フォークは最後に破棄するため、表の続きはspaceから取得する
+                _retarget_table_sources(result["content"], None if "error" in merge_result else space_id, renamed)
+            content.extend(result["content"])
+            report_sections.append(f"## {step['query']}\n{_extract_report(result['full_response'])}")
+
+        python_code = "\n\n".join(python_sections)
+        full_response = f"<python>\n{python_code}\n</python>\n<report>\n" + "\n\n".join(report_sections) + "\n</report>"
+        state["python_code"] = python_code
+        state["full_response"] = full_response
+        state["content"] = content
+        state["done"] = True
+        state["progress"] = ""
+        space_history[space_id].append([{"role":"user", "content": request.query},{"role":"assistant", "content": full_response}])
+
+    except asyncio.CancelledError:
+        print(f"Agentic analysis cancelled: {analysis_id}")
+        for fork_id in fork_ids:
+            await code_service.interrupt(fork_id)
+        state["error"] = "Analysis cancelled"
+        state["done"] = True
+        state["progress"] = ""
+        raise
+    except asyncio.TimeoutError:
+        print(f"Agentic analysis deadline exceeded for {analysis_id}")
+        state["error"] = "Analysis timed out"
+        state["done"] = True
+        state["progress"] = ""
+    except Exception as e:
+        print(f"Agentic analysis error for {analysis_id}: {str(e)}")
         state["error"] = f"Error: {str(e)}"
         state["done"] = True
         state["progress"] = ""
+    finally:
+        for fork_id in fork_ids:
+            await code_service.drop_space(fork_id)
+        if not delegated:
+            _record_metrics(state, request.model)
+
+async def _plan_sub_queries(
+    request: StartAnalysisRequest, actionmodel_client, model: Dict[str, Any], budget: DeadlineBudget
+) -> List[str]:
+    """質問を独立したサブ質問に分解する（分解できない場合は元の質問のみを返す）"""
+    messages = [
+        {"role": "system", "content": get_agentic_plan_prompt(request.tables, AGENTIC_MAX_STEPS)},
+        {"role": "user", "content": request.query},
+    ]
+    response = await asyncio.wait_for(
+        actionmodel_client.chat.completions.create(
+            model=model["model_name"],
+            messages=messages,
+            temperature=ACTION_MODEL_TEMPERATURE,
+        ),
+        timeout=budget.remaining("llm"),
+    )
+    plan_text = ""
+    if response.choices and response.choices[0].message:
+        plan_text = _del_think_tag(response.choices[0].message.content or "")
+    match = re.search(r"<plan>(.*?)</plan>", plan_text, re.DOTALL)
+    try:
+        sub_queries = json.loads(match.group(1)) if match else []
+    except json.JSONDecodeError:
+        sub_queries = []
+    sub_queries = [q.strip() for q in sub_queries if isinstance(q, str) and q.strip()]
+    return sub_queries[:AGENTIC_MAX_STEPS] or [request.query]
+
+async def _run_sub_analysis(
+    space_id: str,
+    fork_id: str,
+    step: Dict[str, Any],
+    base_messages: List[Dict],
+    actionmodel_client,
+    model: Dict[str, Any],
+    budget: DeadlineBudget,
+    analysis_metrics: Dict[str, Any],
+) -> Dict[str, Any]:
+    """サブ質問1つ分の分析をフォークした名前空間で実行する"""
+    messages = base_messages + [{"role": "user", "content": step["query"]}]
+    response = await asyncio.wait_for(
+        actionmodel_client.chat.completions.create(
+            model=model["model_name"],
+            messages=messages,
+            temperature=ACTION_MODEL_TEMPERATURE,
+        ),
+        timeout=budget.remaining("llm"),
+    )
+    if not response.choices or not response.choices[0].message:
+        return {"error": "モデルからの応答がありません。"}
+    full_response = response.choices[0].message.content or ""
+    python_code = _extract_python_code(full_response)
+    if python_code:
+        step["python"] = python_code
+        fork_result = await code_service.fork_space(space_id, fork_id)
+        if "error" in fork_result:
+            return {"error": fork_result["error"]}
+        budget.start("execution")
+        preflight_error = await _preflight_error(python_code, space_id, analysis_metrics)
+        if preflight_error:
+            result = {"code_error": preflight_error}
+        else:
+            result = await _execute_code(python_code, fork_id, budget, analysis_metrics=analysis_metrics)
+        if result and ("error" in result or "code_error" in result):
+            # エラーが発生した場合は1回だけ修正して再実行する
+            error_msg = result.get("error", result.get("code_error", "Unknown error"))
+            analysis_metrics["repair_count"] = analysis_metrics.get("repair_count", 0) + 1
+            messages = messages + [
+                {"role": "assistant", "content": full_response},
+                {"role": "user", "content": _repair_message(error_msg)},
+            ]
+            fixed_response = await asyncio.wait_for(
+                actionmodel_client.chat.completions.create(
+                    model=model["model_name"],
+                    messages=messages,
+                    temperature=ACTION_MODEL_TEMPERATURE,
+                ),
+                timeout=budget.remaining("llm"),
+            )
+            fixed_python_code = ""
+            if fixed_response.choices and fixed_response.choices[0].message:
+                fixed_python_code = _extract_python_code(fixed_response.choices[0].message.content or "")
+            if not fixed_python_code:
+                return {"error": "修正されたpythonコードがありません。"}
+            if not preflight_error:
+                await code_service.code_rollback(fork_id)
+            result = await _execute_code(fixed_python_code, fork_id, budget, analysis_metrics=analysis_metrics)
+            if result and ("error" in result or "code_error" in result):
+                error_msg = result.get("error", result.get("code_error", "Unknown error"))
+                return {"error": f"再実行後のコード実行エラー: {error_msg}"}
+            python_code = fixed_python_code
+            step["python"] = python_code
+            full_response = full_response.split("<python>")[0] + "<python>" + python_code + "</python>" + full_response.split("</python>")[1]
+    if "</report>" not in full_response:
+        full_response += "\n</report>"
+    # コードを実行していない場合はspaceの既存の変数から描画する
+    render_id = fork_id if python_code else space_id
+    content = await asyncio.wait_for(
+        _parse_response_to_content(full_response, render_id, ignore_errors=True, analysis_metrics=analysis_metrics),
+        timeout=budget.remaining("render"),
+    )
+    return {"error": "", "python_code": python_code, "full_response": full_response, "content": content}
 
 def _del_think_tag(content:str) ->str:
     return re.sub(r"<think>.*?</think>", "", content, flags=re.DOTALL)
@@ -264,7 +1078,8 @@ from typing import List, Dict, Any
 async def _parse_response_to_content(
     response: str,
     analysis_id: str,
-    ignore_errors: bool = True
+    ignore_errors: bool = True,
+    analysis_metrics: Optional[Dict[str, Any]] = None,
 ) -> List[Dict[str, Any]]:
     """AIの応答を解析してコンテンツ形式に変換（安全版）"""
     content: List[Dict[str, Any]] = []
@@ -295,6 +1110,7 @@ async def _parse_response_to_content(
             content.append({"type": "markdown", "content": before_text.strip()})
 
         # 変数の値を取得
+        fetch_started_at = time.perf_counter()
         try:
             var_result = await code_service.get_variable_value(analysis_id, var_name)
         except Exception as e:
@@ -304,17 +1120,33 @@ async def _parse_response_to_content(
                 continue
             else:
                 raise
+        finally:
+            if analysis_metrics is not None:
+                analysis_metrics["variable_fetch"] = (
+                    analysis_metrics.get("variable_fetch", 0.0) + time.perf_counter() - fetch_started_at
+                )
 
         if var_result and isinstance(var_result, dict):
             if "result" in var_result and isinstance(var_result["result"], list):
-                for var_content in var_result["result"]:
+                for item, var_content in enumerate(var_result["result"]):
                     var_type = var_content.get("type", "string")
                     data = var_content.get("data")
 
                     if var_type == "image":
-                        content.append({"type": "image", "base64": data})
+                        image_content = {"type": "image", "base64": data, "mime_type": var_content.get("mime_type", "image/png")}
+                        if var_content.get("downsampled"):
+                            # 描画時に間引いた系列の記録（元の点数と描画した点数）
+                            image_content["downsampled"] = var_content["downsampled"]
+                        content.append(image_content)
                     elif var_type == "table":
-                        content.append({"type": "table", "table": data})
+                        # 最初のページだけを埋め込み、残りは/get-table-pageで取得する
+                        table_content = {"type": "table", "table": table_records(var_content)}
+                        if var_content.get("total_rows") is not None:
+                            table_content["total_rows"] = var_content["total_rows"]
+                            # 続きのページは変数名で取得するため、式から描画した表には取得先を付けない
+                            if _is_plain_identifier(var_name):
+                                table_content["source"] = {"id": analysis_id, "name": var_name.strip(), "item": item}
+                        content.append(table_content)
                     else:
                         content.append({"type": "variable", "data": data})
 
@@ -345,6 +1177,39 @@ async def _parse_response_to_content(
 
 
 
+async def get_table_page(analysis_id: str, block: int, offset: int = 0, limit: Optional[int] = None) -> Dict[str, Any]:
+    """
+    レポートに埋め込んだ表の続きのページを取得する
+    取得先のスペースと変数名はクライアントから受け取らず、分析の結果に記録した表のsourceを使う
+    """
+    if analysis_id not in analysis_states:
+        raise ValueError("Analysis ID not found")
+    content = analysis_states[analysis_id].get("content", [])
+    if not 0 <= block < len(content) or content[block].get("type") != "table" or "source" not in content[block]:
+        raise ValueError("the block is not a paged table")
+    source = content[block]["source"]
+    name = source["name"]
+    # /varは変数名を式として評価するため、単純な変数名以外は渡さない
+    if not _is_plain_identifier(name):
+        raise ValueError("the table source is not a variable")
+    limit = min(limit or TABLE_PAGE_MAX_ROWS, TABLE_PAGE_MAX_ROWS)
+    var_result = await code_service.get_variable(
+        VariableRetrievalResponse(id=source["id"], name=name, offset=max(0, offset), limit=limit)
+    )
+    if "error" in var_result:
+        raise ValueError(var_result.get("detail") or var_result["error"])
+    results = var_result.get("result", [])
+    item = source.get("item", 0)
+    if not 0 <= item < len(results) or results[item].get("type") != "table":
+        raise ValueError(f"{name} is not a table")
+    table = results[item]
+    return {
+        "table": table_records(table),
+        "total_rows": table.get("total_rows", 0),
+        "offset": table.get("offset", offset),
+    }
+
+
 def get_analysis_state(analysis_id: str) -> Dict[str, Any]:
     global analysis_states
     if analysis_id not in analysis_states:
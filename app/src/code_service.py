@@ -1,24 +1,116 @@
 import os
 import json
 import base64
+import asyncio
+import time
+from typing import List, Optional, Set
 import httpx
 from .models.requests import VariableRetrievalResponse
+from .sandbox_router import SandboxRouter
+from .utils import metrics
+from .utils.table_versions import on_tables_changed
+
+# サンドボックスへの接続プールの設定
+SANDBOX_MAX_CONNECTIONS = int(os.getenv("SANDBOX_MAX_CONNECTIONS", "32"))
+SANDBOX_MAX_KEEPALIVE = int(os.getenv("SANDBOX_MAX_KEEPALIVE", "16"))
+SANDBOX_KEEPALIVE_EXPIRY = float(os.getenv("SANDBOX_KEEPALIVE_EXPIRY", "60"))
+# 冪等なリクエストのリトライ回数
+SANDBOX_RETRIES = int(os.getenv("SANDBOX_RETRIES", "2"))
+SANDBOX_RETRY_BACKOFF = 0.2
+
+# リトライしても安全な（冪等な）サンドボックスのコマンド
+IDEMPOTENT_COMMANDS = {"var", "names", "rollback", "fork", "merge", "drop", "interrupt", "checkpoint", "revert", "prepare", "invalidate"}
+# テーブル変更の通知のタイムアウト(秒)
+SANDBOX_INVALIDATE_TIMEOUT = 5.0
+RETRYABLE_STATUS_CODES = {502, 503, 504}
 
-CODE_RUNNER_URL = os.getenv("CODE_RUNNER_URL")
 
 class CodeService:
-    async def code_execution(self, python_code: str, access_id: str):
-        """Pythonコードを実行する関数"""
-        try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    CODE_RUNNER_URL + "code",
-                    json={
-                        "code": python_code.replace("\\", "%@"),
-                        "id": access_id,
-                    }
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # 応答を待たずに送信中の通知(完了前にタスクが回収されないよう参照を保持する)
+        self._background: Set[asyncio.Task] = set()
+        # spaceごとのレプリカの割り当て
+        self.router = SandboxRouter()
+
+    async def start(self):
+        """アプリ起動時に接続プール付きのクライアントを作成する"""
+        self._loop = asyncio.get_running_loop()
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=30.0,
+                limits=httpx.Limits(
+                    max_connections=SANDBOX_MAX_CONNECTIONS,
+                    max_keepalive_connections=SANDBOX_MAX_KEEPALIVE,
+                    keepalive_expiry=SANDBOX_KEEPALIVE_EXPIRY,
+                ),
+            )
+
+    async def close(self):
+        """アプリ終了時にクライアントを閉じる"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _post(self, command: str, payload: dict, timeout: Optional[float] = None) -> httpx.Response:
+        """
+        共有クライアントでサンドボックスにリクエストを送る
+        冪等なコマンドは接続エラーや502/503/504の場合にリトライする
+        """
+        if self._client is None:
+            await self.start()
+        replica_url = await self.router.resolve(payload["id"], self._client)
+        return await self._post_to(replica_url, command, payload, timeout)
+
+    async def _post_to(
+        self, replica_url: str, command: str, payload: dict, timeout: Optional[float] = None
+    ) -> httpx.Response:
+        retries = SANDBOX_RETRIES if command in IDEMPOTENT_COMMANDS else 0
+        request_timeout = timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+        for attempt in range(retries + 1):
+            started_at = time.perf_counter()
+            try:
+                response = await self._client.post(
+                    replica_url + command, json=payload, timeout=request_timeout
                 )
-                
+            except httpx.TransportError as e:
+                metrics.SANDBOX_REQUEST.observe(time.perf_counter() - started_at, endpoint=command, replica=replica_url, outcome="transport_error")
+                # 読み込みタイムアウトはサンドボックス側で処理中の可能性があるためリトライしない
+                timed_out = isinstance(e, httpx.TimeoutException) and not isinstance(e, httpx.ConnectTimeout)
+                if attempt >= retries or timed_out:
+                    raise
+                metrics.SANDBOX_RETRIES.inc(endpoint=command)
+                await asyncio.sleep(SANDBOX_RETRY_BACKOFF * (2 ** attempt))
+                continue
+            metrics.SANDBOX_REQUEST.observe(time.perf_counter() - started_at, endpoint=command, replica=replica_url, outcome=str(response.status_code))
+            if response.status_code in RETRYABLE_STATUS_CODES and attempt < retries:
+                metrics.SANDBOX_RETRIES.inc(endpoint=command)
+                await asyncio.sleep(SANDBOX_RETRY_BACKOFF * (2 ** attempt))
+                continue
+            return response
+
+    async def code_execution(
+        self,
+        python_code: str,
+        access_id: str,
+        snapshot: bool = True,
+        timeout: float = 30.0,
+        sample_rows: Optional[int] = None,
+    ):
+        """Pythonコードを実行する関数（sample_rowsを指定すると大きなテーブルを標本化して読み込む）"""
+        self.router.record_attempt(access_id, snapshot)
+        try:
+            response = await self._post(
+                "code",
+                {
+                    "code": python_code.replace("\\", "%@"),
+                    "id": access_id,
+                    "snapshot": snapshot,
+                    "sample_rows": sample_rows,
+                },
+                timeout=timeout,
+            )
             response.raise_for_status()  # HTTPエラーなら例外を投げる
 
             # --- code-runner からのレスポンスを処理 ---
@@ -26,8 +118,9 @@ class CodeService:
 
             if "error" in runner_result:
                 print(f"Error from code runner: {runner_result['error']}")
-                return {"code_error": runner_result['error']}
+                return {"code_error": runner_result['error'], "usage": runner_result.get("usage")}
 
+            self.router.record_execution(access_id, python_code, snapshot, sample_rows)
             print("Code executed successfully:")
             return {"result": runner_result}
 
@@ -44,12 +137,7 @@ class CodeService:
     async def code_rollback(self, access_id: str):
         """コードのロールバックを行う関数"""
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    CODE_RUNNER_URL + "rollback",
-                    json={"id": access_id}
-                )
-                
+            response = await self._post("rollback", {"id": access_id})
             response.raise_for_status()  # HTTPエラーなら例外を投げる
 
             rollback_result = response.json()
@@ -57,6 +145,7 @@ class CodeService:
                 print(f"Error during rollback: {rollback_result['error']}")
                 return {"error": rollback_result['error']}
 
+            self.router.record_rollback(access_id)
             print("Rollback executed successfully")
             return {"result": rollback_result}
 
@@ -70,12 +159,134 @@ class CodeService:
             print(f"An unexpected error occurred during rollback: {e}")
             return {"error": "An unexpected error during rollback"}
 
+    async def checkpoint_space(self, access_id: str, version: int):
+        """履歴のindexの開始時点の名前空間をサンドボックスに保存する関数"""
+        result = await self._post_namespace_command("checkpoint", {"id": access_id, "version": version})
+        if "result" in result:
+            self.router.record_version(access_id, version)
+        return result
+
+    async def revert_space(self, access_id: str, version: int):
+        """名前空間を履歴のindexの開始時点に戻す関数"""
+        result = await self._post_namespace_command("revert", {"id": access_id, "version": version})
+        if "result" in result:
+            self.router.record_revert(access_id, version)
+        return result
+
+    async def fork_space(self, access_id: str, fork_id: str):
+        """名前空間をフォークする関数（修正候補やサブ分析を元の名前空間を変えずに実行するため）"""
+        result = await self._post_namespace_command("fork", {"id": access_id, "fork_id": fork_id})
+        if "result" in result:
+            self.router.record_fork(access_id, fork_id)
+        return result
+
+    async def promote_fork(self, access_id: str, fork_id: str):
+        """フォークした名前空間を元の名前空間として採用する関数"""
+        result = await self._post_namespace_command("promote", {"id": access_id, "fork_id": fork_id})
+        if "result" in result:
+            self.router.record_promote(access_id, fork_id)
+        return result
+
+    async def merge_fork(self, access_id: str, fork_id: str, prefix: Optional[str] = None):
+        """
+        フォークで定義・再代入された変数を元の名前空間に取り込む関数
+        prefixを指定すると、先に取り込んだ変数と名前が衝突する変数は接頭辞を付けた名前で取り込む
+        """
+        result = await self._post_namespace_command(
+            "merge", {"id": access_id, "fork_id": fork_id, "prefix": prefix}
+        )
+        if "result" in result:
+            self.router.record_merge(access_id, fork_id, result["result"].get("renamed") or {})
+        return result
+
+    async def drop_space(self, access_id: str):
+        """名前空間を破棄する関数"""
+        result = await self._post_namespace_command("drop", {"id": access_id})
+        if "result" in result:
+            self.router.record_drop(access_id)
+        return result
+
+    async def prepare_space(self, access_id: str):
+        """最初のクエリの前に、サンドボックスに名前空間とDB接続を用意させる"""
+        return await self._post_namespace_command("prepare", {"id": access_id})
+
+    async def get_names(self, access_id: str) -> Optional[Set[str]]:
+        """名前空間に定義されている変数名を返す関数(取得できない場合はNone)"""
+        result = await self._post_namespace_command("names", {"id": access_id})
+        if "result" not in result:
+            return None
+        return set(result["result"].get("names", []))
+
+    async def interrupt(self, access_id: str):
+        """サンドボックスで実行中のコードを中断する関数"""
+        return await self._post_namespace_command("interrupt", {"id": access_id})
+
+    async def drain_replica(self, url: str):
+        """レプリカを切り離し、そのレプリカのspaceを別のレプリカで再構築する"""
+        if self._client is None:
+            await self.start()
+        moved = await self.router.drain(url, self._client)
+        for _ in moved:
+            metrics.SANDBOX_MIGRATIONS.inc(replica=url)
+        return moved
+
+    def invalidate_tables(self, table_names: List[str]):
+        """
+        テーブルの変更を全レプリカに通知し、SQLの結果キャッシュを無効にする(応答は待たない)
+        スレッドプールで実行される同期の処理からも呼ばれるため、イベントループに送信を登録する
+        """
+        if self._loop is None or self._loop.is_closed():
+            print("Sandbox client is not started; skipping SQL cache invalidation")
+            return
+        self._loop.call_soon_threadsafe(self._schedule_invalidation, list(table_names))
+
+    def _schedule_invalidation(self, table_names: List[str]):
+        task = asyncio.create_task(self._send_invalidation(table_names))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _send_invalidation(self, table_names: List[str]):
+        if self._client is None:
+            return
+        # 切り離し中のレプリカは新しいクエリを受けないため通知しない
+        urls = [url for url in self.router.urls if url not in self.router.draining]
+        await asyncio.gather(*(self._invalidate_replica(url, table_names) for url in urls))
+
+    async def _invalidate_replica(self, url: str, table_names: List[str]):
+        try:
+            response = await self._post_to(url, "invalidate", {"tables": table_names}, timeout=SANDBOX_INVALIDATE_TIMEOUT)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            print(f"Failed to invalidate SQL cache on sandbox {url}: {e}")
+
+    async def _post_namespace_command(self, command: str, payload: dict):
+        try:
+            response = await self._post(command, payload)
+            response.raise_for_status()
+
+            result = response.json()
+            if "error" in result:
+                print(f"Error during {command}: {result['error']}")
+                return {"error": result["error"]}
+            return {"result": result}
+
+        except httpx.HTTPStatusError as e:
+            print(f"HTTP connection error during {command}: {e}")
+            return {"error": f"HTTP connection error during {command}"}
+        except httpx.TimeoutException:
+            print(f"Request timed out error during {command}")
+            return {"error": f"Request timed out error during {command}"}
+        except Exception as e:
+            print(f"An unexpected error occurred during {command}: {e}")
+            return {"error": f"An unexpected error during {command}"}
+
     async def get_variable(self, request: VariableRetrievalResponse):
         """変数を取得するエンドポイント"""
-        endpoint_url = f"{CODE_RUNNER_URL}var"
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(endpoint_url, json={"id": request.id, "name": request.name})
+            response = await self._post(
+                "var",
+                {"id": request.id, "name": request.name, "offset": request.offset, "limit": request.limit},
+            )
 
             if response.status_code != 200:
                 return {"error": f"Code runner error: {response.status_code}", "detail": response.text}
@@ -86,10 +297,8 @@ class CodeService:
 
     async def get_variable_value(self, analysis_id: str, variable_name: str):
         """分析マネージャー用の変数取得メソッド"""
-        endpoint_url = f"{CODE_RUNNER_URL}var"
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(endpoint_url, json={"id": analysis_id, "name": variable_name})
+            response = await self._post("var", {"id": analysis_id, "name": variable_name})
 
             if response.status_code != 200:
                 return None
@@ -97,4 +306,9 @@ class CodeService:
             return response.json()
         except Exception as e:
             print(f"Error getting variable {variable_name}: {e}")
-            return None
\ No newline at end of file
+            return None
+
+
+# サンドボックスと通信する全ての処理で共有するインスタンス
+code_service = CodeService()
+on_tables_changed(code_service.invalidate_tables)
@@ -13,6 +13,7 @@ from sqlalchemy.orm import Session
 from sqlalchemy.exc import OperationalError
 from .database import engine
 from .utils.prompts import set_db_schema
+from .utils.table_versions import bump_table_versions
 import unicodedata
 
 # PostgreSQL予約語
@@ -379,6 +380,7 @@ class DataService:
                 )
             else:
                 set_db_schema()  # スキーマを更新
+                bump_table_versions(all_table_names)
 
             return {
                 "table_count": len(all_table_names),
@@ -405,6 +407,7 @@ class DataService:
                     status_code=400,
                     detail="No readable tables found. The external PostgreSQL database may have no tables or the connection string is invalid.",
                 )
+            bump_table_versions(table_names)
 
             return {
                 "table_count": len(table_names),
@@ -446,6 +449,7 @@ class DataService:
             # アップロードされたファイルを削除
             os.remove(uploaded_file_path)
             set_db_schema()  # スキーマを更新
+            bump_table_versions(table_names)
 
             return {
                 "table_count": len(table_names),
@@ -483,6 +487,7 @@ class DataService:
                 connection.commit()
 
             set_db_schema()  # スキーマを更新
+            bump_table_versions(table_names)
             return {"message": "Database reset successfully."}
 
         except ValueError as e:
@@ -528,6 +533,7 @@ class DataService:
 
             # スキーマを更新
             set_db_schema()
+            bump_table_versions([validated_name])
 
             return {"message": f"Table '{table_name}' deleted successfully."}
 
@@ -584,6 +590,7 @@ class DataService:
 
             # スキーマを更新
             set_db_schema()
+            bump_table_versions([validated_old_name, validated_new_name])
 
             return {"message": f"Table '{table_name}' has been renamed to '{new_table_name}'."}
 
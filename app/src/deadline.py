@@ -0,0 +1,33 @@
+import os
+import time
+from typing import Dict, Optional
+
+# 分析全体の締め切りと、フェーズごとの予算（秒）
+ANALYSIS_DEADLINE = float(os.getenv("ANALYSIS_DEADLINE", "300"))
+PHASE_BUDGETS = {
+    "llm": float(os.getenv("LLM_PHASE_BUDGET", "180")),
+    "execution": float(os.getenv("EXECUTION_PHASE_BUDGET", "60")),
+    "render": float(os.getenv("RENDER_PHASE_BUDGET", "30")),
+}
+
+
+class DeadlineBudget:
+    """分析ごとの締め切りを管理し、各フェーズの残り時間を計算する"""
+
+    def __init__(self, deadline: float = ANALYSIS_DEADLINE, phase_budgets: Optional[Dict[str, float]] = None):
+        self.started_at = time.monotonic()
+        self.deadline = deadline
+        self.phase_budgets = phase_budgets or PHASE_BUDGETS
+        self._phase_started: Dict[str, float] = {}
+
+    def start(self, phase: str):
+        """フェーズの開始時刻を記録（既に開始済みの場合は何もしない）"""
+        self._phase_started.setdefault(phase, time.monotonic())
+
+    def remaining(self, phase: str) -> float:
+        """フェーズの残り時間（フェーズの予算と分析全体の締め切りの小さい方）"""
+        now = time.monotonic()
+        self.start(phase)
+        phase_remaining = self.phase_budgets[phase] - (now - self._phase_started[phase])
+        total_remaining = self.deadline - (now - self.started_at)
+        return max(0.0, min(phase_remaining, total_remaining))
@@ -1,8 +1,10 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import asyncio
-from .routers import data_router, health_router, new_analysis_router,model_list_router
-from .utils.prompts import set_db_schema
+from .routers import data_router, health_router, new_analysis_router,model_list_router,metrics_router,sandbox_router
+from .utils.prompts import set_db_schema, get_registered_tables
+from .table_snapshots import ensure_snapshots, start_refresher
+from .code_service import code_service
 
 app = FastAPI()
 
@@ -19,9 +21,23 @@ app.include_router(data_router)
 app.include_router(health_router)
 app.include_router(new_analysis_router)
 app.include_router(model_list_router)
+app.include_router(metrics_router)
+app.include_router(sandbox_router)
 
 #アプリケーション起動時にデータベーススキーマを設定
 @app.on_event("startup")
 async def startup_event():
     # データベーススキーマを設定
-    set_db_schema()
\ No newline at end of file
+    set_db_schema()
+    # サンドボックスが読み込むテーブルのスナップショットを作成
+    ensure_snapshots(get_registered_tables())
+    # アプリを経由せずに変更されたテーブルのスナップショットを定期的に書き出し直す
+    start_refresher(get_registered_tables)
+    # サンドボックスとの接続プールを作成
+    await code_service.start()
+
+
+#アプリケーション終了時にサンドボックスとの接続を閉じる
+@app.on_event("shutdown")
+async def shutdown_event():
+    await code_service.close()
\ No newline at end of file
@@ -1,13 +1,19 @@
-from .requests import VariableRetrievalResponse, StartAnalysisRequest
-from .responses import ConnectionResponse, ErrorResponse, StartAnalysisResponse, GetReportResponse,GetSpaceResponse,CreateSpaceResponse
+from .requests import VariableRetrievalResponse, StartAnalysisRequest, DrainReplicaRequest, TablePageRequest
+from .responses import ConnectionResponse, ErrorResponse, StartAnalysisResponse, GetReportResponse,GetSpaceResponse,CreateSpaceResponse,CancelAnalysisResponse,SandboxReplicasResponse,DrainReplicaResponse,TablePageResponse
 
 __all__ = [
     "VariableRetrievalResponse",
     "StartAnalysisRequest",
+    "DrainReplicaRequest",
+    "TablePageRequest",
     "ConnectionResponse",
     "ErrorResponse",
     "StartAnalysisResponse",
     "GetReportResponse",
     "GetSpaceResponse",
-    "CreateSpaceResponse"
+    "CreateSpaceResponse",
+    "CancelAnalysisResponse",
+    "SandboxReplicasResponse",
+    "DrainReplicaResponse",
+    "TablePageResponse"
 ]
@@ -1,9 +1,17 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 class VariableRetrievalResponse(BaseModel):
     id: str
     name: str
+    offset: int = 0
+    limit: Optional[int] = None
+
+class TablePageRequest(BaseModel):
+    analysis_id: str
+    block: int
+    offset: int = 0
+    limit: Optional[int] = None
 
 class StartAnalysisRequest(BaseModel):
     space_id: str
@@ -12,3 +20,10 @@ class StartAnalysisRequest(BaseModel):
     mode: str = "standard"
     model: str = ""
     index: int = -1
+    priority: int = 0
+    streaming_execution: bool = False
+    # mode="approximate"の場合、正確な結果をバックグラウンドで計算して完了後に内容を置き換える
+    exact_followup: bool = False
+
+class DrainReplicaRequest(BaseModel):
+    url: str
@@ -14,6 +14,28 @@ class StartAnalysisResponse(BaseModel):
     id: Optional[str] = None
     error: Optional[str] = None
 
+class CancelAnalysisResponse(BaseModel):
+    id: str
+    cancelled: bool
+
+class SandboxReplica(BaseModel):
+    url: str
+    draining: bool
+    spaces: int
+
+class SandboxReplicasResponse(BaseModel):
+    replicas: List[SandboxReplica]
+
+class DrainReplicaResponse(BaseModel):
+    url: str
+    moved_spaces: List[str]
+
+class TablePageResponse(BaseModel):
+    table: str = "[]"
+    total_rows: int = 0
+    offset: int = 0
+    error: str = ""
+
 class CreateSpaceResponse(BaseModel):
     id: str
 
@@ -28,6 +50,11 @@ class GetReportResponse(BaseModel):
     python_code: str = ""
     content: List[Dict[str, Any]] = []
     steps: Optional[List[Dict[str, Any]]] = None
+    metrics: Optional[Dict[str, float]] = None
+    # 近似モードで標本化したテーブルとサンプリング率
+    sampling: Optional[List[Dict[str, Any]]] = None
+    # 正確な結果をバックグラウンドで計算中かどうか
+    exact_pending: bool = False
 
 class LLMMODEL(BaseModel):
     id: str
@@ -0,0 +1,323 @@
+import ast
+import asyncio
+import builtins
+import difflib
+import os
+import re
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DataError, ProgrammingError
+
+from .database import DATABASE_URL, engine
+from .utils.table_versions import on_tables_changed
+
+# サンドボックスで実行する前に生成コードを検査するかどうか
+PREFLIGHT = os.getenv("PREFLIGHT", "true").lower() == "true"
+# コード中のSQLを読み取り専用ロールでEXPLAINして検査するかどうか
+PREFLIGHT_EXPLAIN = os.getenv("PREFLIGHT_EXPLAIN", "false").lower() == "true"
+PREFLIGHT_EXPLAIN_TIMEOUT_MS = int(os.getenv("PREFLIGHT_EXPLAIN_TIMEOUT_MS", "2000"))
+# サンドボックスと同じ読み取り専用ロール（未設定の場合はアプリの接続情報を使う）
+DB_READER_USER = os.getenv("DB_READER_USER")
+DB_READER_PASSWORD = os.getenv("DB_READER_PASSWORD")
+
+# サンドボックスの名前空間に最初から定義されている名前
+PREDEFINED_NAMES = {"engine", "duck"}
+# 使われている場合は未定義の名前を判定できない呼び出し
+_DYNAMIC_SCOPE_CALLS = {"exec", "eval", "globals", "locals", "vars"}
+
+_SQL_START = re.compile(r"^\s*\(?\s*(select|with)\b", re.IGNORECASE)
+_SQL_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_SQL_COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+# FROMを含むがテーブルを参照しない構文
+_SQL_NON_TABLE_FROM = re.compile(
+    r"\b(?:extract|substring|trim|overlay)\s*\([^()]*\)|\bdistinct\s+from\b", re.IGNORECASE
+)
+_IDENTIFIER = r'(?:"[^"]+"|\w+)'
+# エイリアスとして扱わない直後のキーワード
+_SQL_KEYWORDS = {
+    "where", "join", "inner", "left", "right", "full", "cross", "natural", "on", "using",
+    "group", "order", "limit", "offset", "having", "union", "intersect", "except", "window",
+    "lateral", "tablesample", "fetch", "for", "returning", "select", "from", "as", "with",
+}
+_SQL_TABLE_REF = re.compile(
+    rf"\b(?:from|join)\s+({_IDENTIFIER}(?:\s*\.\s*{_IDENTIFIER})?)"
+    rf"(?:\s+(?:as\s+)?(?!(?:{'|'.join(_SQL_KEYWORDS)})\b)({_IDENTIFIER}))?",
+    re.IGNORECASE,
+)
+_SQL_CTE = re.compile(rf"({_IDENTIFIER})\s*(?:\([^()]*\))?\s+as\s+(?:not\s+)?(?:materialized\s+)?\(", re.IGNORECASE)
+_SQL_QUALIFIED_COLUMN = re.compile(rf"({_IDENTIFIER})\s*\.\s*({_IDENTIFIER}|\*)")
+_SQL_QUOTED = re.compile(r'(?<![.\w])"([^"]+)"(?!\s*\.)')
+# 出力列の別名（AS付きと、式の直後に引用符付きの名前を書く省略形）
+_SQL_AS_ALIAS = re.compile(rf"\bas\s+({_IDENTIFIER})", re.IGNORECASE)
+_SQL_IMPLICIT_ALIAS = re.compile(r'(\)|"[^"]+"|\b\w+)\s+(?="([^"]+)")')
+# 直後の引用符付きの名前を別名ではなく列の参照にするキーワード
+_SQL_EXPRESSION_KEYWORDS = _SQL_KEYWORDS | {
+    "by", "distinct", "all", "and", "or", "not", "in", "is", "like", "ilike", "between",
+    "case", "when", "then", "else", "end", "any", "some", "exists", "asc", "desc", "nulls", "into",
+    "values", "set", "update", "delete", "insert", "table", "over", "partition", "filter", "within",
+}
+_SQL_SUBQUERY = re.compile(r"\(\s*select\b", re.IGNORECASE)
+_SQL_PLACEHOLDER = re.compile(r"%\(|%s|(?<![:\w]):[A-Za-z_]|\?")
+
+# テーブル名(小文字) -> 列名(小文字)の集合
+_catalog: Optional[Dict[str, Set[str]]] = None
+_catalog_lock = threading.Lock()
+_reader_engine = None
+
+
+def get_catalog() -> Optional[Dict[str, Set[str]]]:
+    """データベースのテーブルと列の一覧（取得できない場合はNone）"""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            try:
+                inspector = inspect(engine)
+                _catalog = {
+                    table_name.lower(): {column["name"].lower() for column in inspector.get_columns(table_name)}
+                    for table_name in inspector.get_table_names()
+                }
+            except Exception as e:
+                print(f"Failed to load schema catalog for preflight: {e}")
+                return None
+        return _catalog
+
+
+def invalidate_catalog(table_names: List[str]):
+    global _catalog
+    with _catalog_lock:
+        _catalog = None
+
+
+def defined_names(code: str) -> Set[str]:
+    """コードで定義される名前（構文エラーの場合は空）"""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return set()
+    return _defined_names(tree)
+
+
+def _defined_names(tree: ast.AST) -> Set[str]:
+    # スコープは区別せず、どこかで定義されていれば定義済みとみなす
+    names: Set[str] = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                names.add(alias.asname or alias.name.split(".")[0])
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.MatchAs, ast.MatchStar)) and node.name:
+            names.add(node.name)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            names.add(node.rest)
+    return names
+
+
+def _undefined_names(tree: ast.AST, known_names: Set[str]) -> List[Tuple[str, str]]:
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and any(alias.name == "*" for alias in node.names):
+            return []
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _DYNAMIC_SCOPE_CALLS:
+            return []
+    defined = _defined_names(tree) | known_names | PREDEFINED_NAMES | set(dir(builtins))
+    problems = []
+    reported: Set[str] = set()
+    loads = sorted(
+        (node for node in ast.walk(tree) if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)),
+        key=lambda node: (node.lineno, node.col_offset),
+    )
+    for node in loads:
+        if node.id in defined or node.id in reported:
+            continue
+        reported.add(node.id)
+        problems.append(("name", f"{node.lineno}行目: 変数 `{node.id}` が定義されていません。{_suggest(node.id, defined)}"))
+    return problems
+
+
+def _sql_strings(tree: ast.AST) -> List[Tuple[int, str, bool]]:
+    """
+    SQLと思われる文字列リテラルの(行番号, SQL, duck.sqlに渡しているか)の一覧
+    f-stringなど実行時に決まるものと、docstringなど式文の文字列は除く
+    """
+    excluded = set()
+    columnar = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.JoinedStr):
+            excluded.update(id(value) for value in node.values)
+        elif isinstance(node, ast.Expr):
+            excluded.add(id(node.value))
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "sql" and node.args:
+            columnar.add(id(node.args[0]))
+    return [
+        (node.lineno, node.value, id(node) in columnar)
+        for node in ast.walk(tree)
+        if isinstance(node, ast.Constant)
+        and isinstance(node.value, str)
+        and id(node) not in excluded
+        and _SQL_START.match(node.value)
+    ]
+
+
+def _unquote(identifier: str) -> str:
+    return identifier[1:-1] if identifier.startswith('"') else identifier
+
+
+def _suggest(name: str, candidates: Iterable[str]) -> str:
+    matches = difflib.get_close_matches(name.lower(), [c.lower() for c in candidates], n=1)
+    return f"（`{matches[0]}` の誤りではありませんか？）" if matches else ""
+
+
+def _check_sql(
+    lineno: int, sql: str, catalog: Dict[str, Set[str]], python_names: Set[str]
+) -> Tuple[List[Tuple[str, str]], bool]:
+    """
+    SQLのテーブル名・列名をカタログと照合する
+    問題の一覧と、データベースで実行されるSQLか（EXPLAINの対象か）を返す
+    """
+    stripped = _SQL_NON_TABLE_FROM.sub(" ", _SQL_COMMENT.sub(" ", _SQL_LITERAL.sub("''", sql)))
+    ctes = {_unquote(match.group(1)).lower() for match in _SQL_CTE.finditer(stripped)}
+    lowered_python_names = {name.lower() for name in python_names}
+    problems = []
+    aliases: Dict[str, str] = {}
+    database_query = True
+    all_catalog_tables = True
+    for match in _SQL_TABLE_REF.finditer(stripped):
+        reference = match.group(1)
+        if "." in reference:
+            # スキーマ付きのテーブル（information_schemaなど）は検査しない
+            all_catalog_tables = False
+            continue
+        if stripped[match.end(1):].lstrip().startswith("("):
+            # generate_seriesなどのテーブル関数
+            all_catalog_tables = False
+            continue
+        table_name = _unquote(reference).lower()
+        if table_name in _SQL_KEYWORDS:
+            all_catalog_tables = False
+            continue
+        alias = match.group(2)
+        if alias:
+            aliases[_unquote(alias).lower()] = table_name
+        aliases.setdefault(table_name, table_name)
+        if table_name in catalog:
+            continue
+        all_catalog_tables = False
+        if table_name in ctes:
+            continue
+        if table_name in lowered_python_names:
+            # duck.sqlで名前空間のDataFrameを参照している
+            database_query = False
+            continue
+        problems.append(("table", f"{lineno}行目のSQL: テーブル `{_unquote(reference)}` は存在しません。{_suggest(table_name, catalog)}"))
+
+    for match in _SQL_QUALIFIED_COLUMN.finditer(stripped):
+        table_name = aliases.get(_unquote(match.group(1)).lower())
+        column = _unquote(match.group(2))
+        if table_name not in catalog or column == "*" or column.lower() in catalog[table_name]:
+            continue
+        problems.append(("column", f"{lineno}行目のSQL: テーブル `{table_name}` に列 `{column}` はありません。{_suggest(column, catalog[table_name])}"))
+
+    if aliases and all_catalog_tables and not _SQL_SUBQUERY.search(stripped):
+        # 参照しているテーブルがすべて分かり、サブクエリがない場合のみ引用符付きの列名を照合する
+        columns = set().union(*(catalog[table_name] for table_name in aliases.values()))
+        output_aliases = _output_aliases(stripped)
+        for quoted in dict.fromkeys(_SQL_QUOTED.findall(stripped)):
+            name = quoted.lower()
+            if name in columns or name in output_aliases or name in aliases or name in ctes:
+                continue
+            problems.append(("column", f"{lineno}行目のSQL: 列 `{quoted}` はありません。{_suggest(quoted, columns)}"))
+    return problems, database_query and not problems
+
+
+def _output_aliases(sql: str) -> Set[str]:
+    """SELECT句で付けた出力列の別名（ORDER BYなどで引用符付きで参照できる）"""
+    aliases = {_unquote(alias).lower() for alias in _SQL_AS_ALIAS.findall(sql)}
+    for previous, alias in _SQL_IMPLICIT_ALIAS.findall(sql):
+        if previous.lower() not in _SQL_EXPRESSION_KEYWORDS:
+            aliases.add(alias.lower())
+    return aliases
+
+
+def _get_reader_engine():
+    global _reader_engine
+    if _reader_engine is None:
+        url = make_url(DATABASE_URL)
+        if DB_READER_USER:
+            url = url.set(username=DB_READER_USER, password=DB_READER_PASSWORD)
+        _reader_engine = create_engine(url, pool_size=2, max_overflow=0, pool_pre_ping=True)
+    return _reader_engine
+
+
+def _explain(lineno: int, sql: str) -> List[Tuple[str, str]]:
+    """読み取り専用ロールでEXPLAINし、データベースが返したエラーを問題として返す"""
+    stripped = _SQL_COMMENT.sub(" ", _SQL_LITERAL.sub("''", sql)).strip().rstrip(";")
+    # パラメータ付きのSQLや複数の文は実行時まで検査できない
+    if _SQL_PLACEHOLDER.search(stripped) or ";" in stripped:
+        return []
+    reader = _get_reader_engine()
+    try:
+        with reader.connect() as connection:
+            with connection.begin():
+                if reader.dialect.name == "postgresql":
+                    connection.execute(text("SET TRANSACTION READ ONLY"))
+                    connection.execute(text(f"SET LOCAL statement_timeout = {PREFLIGHT_EXPLAIN_TIMEOUT_MS}"))
+                connection.execute(text("EXPLAIN " + sql.strip().rstrip(";")))
+    except (ProgrammingError, DataError) as e:
+        message = str(getattr(e, "orig", e)).strip().splitlines()[0]
+        return [("explain", f"{lineno}行目のSQL: {message}")]
+    except Exception as e:
+        # 接続できない・タイムアウトした場合は検査を省略する
+        print(f"Preflight EXPLAIN skipped: {e}")
+    return []
+
+
+def check_code(code: str, known_names: Iterable[str] = ()) -> List[Tuple[str, str]]:
+    """
+    生成コードをサンドボックスで実行する前に検査し、(種類, メッセージ)の一覧を返す
+    構文エラー、未定義の変数、SQLのテーブル名・列名の誤りを検出する
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return [("syntax", f"{e.lineno}行目: 構文エラー: {e.msg}")]
+
+    known = set(known_names)
+    problems = _undefined_names(tree, known)
+    catalog = get_catalog()
+    if catalog is None:
+        return problems
+    python_names = _defined_names(tree) | known | PREDEFINED_NAMES
+    for lineno, sql, columnar in _sql_strings(tree):
+        sql_problems, database_query = _check_sql(lineno, sql, catalog, python_names)
+        problems.extend(sql_problems)
+        # DuckDBのSQLは方言が異なるためPostgreSQLではEXPLAINしない
+        if PREFLIGHT_EXPLAIN and database_query and not columnar:
+            problems.extend(_explain(lineno, sql))
+    return problems
+
+
+async def preflight(code: str, known_names: Iterable[str] = ()) -> List[Tuple[str, str]]:
+    """check_codeをスレッドで実行する（カタログの取得とEXPLAINでイベントループを止めないため）"""
+    if not PREFLIGHT:
+        return []
+    return await asyncio.to_thread(check_code, code, list(known_names))
+
+
+def format_problems(problems: List[Tuple[str, str]]) -> str:
+    return "コードの実行前の検査で以下の問題が見つかりました。\n" + "\n".join(
+        f"- {message}" for _, message in problems
+    )
+
+
+on_tables_changed(invalidate_catalog)
@@ -0,0 +1,86 @@
+import copy
+import hashlib
+import json
+import os
+import re
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from .utils.prompts import get_registered_tables
+from .utils.table_versions import get_table_version, on_tables_changed
+
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "128"))
+
+
+def normalize_query(query: str) -> str:
+    """キャッシュキー用にクエリを正規化（空白の統一・小文字化）"""
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+class ResultCache:
+    """同じ質問に対する分析結果を再利用するためのLRUキャッシュ"""
+
+    def __init__(self, max_entries: int = RESULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def make_key(
+        self,
+        query: str,
+        tables: List[str],
+        model: str,
+        mode: str,
+        history: List[List[Dict]],
+    ) -> str:
+        """クエリ・テーブル集合とそのバージョン・モデル・スペース履歴からキーを作成"""
+        dependent_tables = sorted(set(tables) if tables else get_registered_tables())
+        key_source = {
+            "query": normalize_query(query),
+            "tables": [[t, get_table_version(t)] for t in dependent_tables],
+            "model": model,
+            "mode": mode,
+            "history": history,
+        }
+        encoded = json.dumps(key_source, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(
+        self,
+        key: str,
+        tables: List[str],
+        python_code: str,
+        full_response: str,
+        content: List[Dict[str, Any]],
+    ):
+        self._entries[key] = {
+            "tables": set(tables) if tables else set(get_registered_tables()),
+            "python_code": python_code,
+            "full_response": full_response,
+            # 呼び出し元が後から内容を書き換えてもキャッシュが変わらないようにコピーする
+            "content": copy.deepcopy(content),
+        }
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, key: str):
+        self._entries.pop(key, None)
+
+    def invalidate_tables(self, table_names: List[str]):
+        """変更されたテーブルに依存するエントリを削除"""
+        changed = set(table_names)
+        for key in [k for k, v in self._entries.items() if v["tables"] & changed]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+
+result_cache = ResultCache()
+on_tables_changed(result_cache.invalidate_tables)
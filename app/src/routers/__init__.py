@@ -2,10 +2,14 @@ from .data import router as data_router
 from .health import router as health_router
 from .new_analysis import router as new_analysis_router
 from .model_list import router as model_list_router
+from .metrics import router as metrics_router
+from .sandbox import router as sandbox_router
 
 __all__ = [
     "data_router",
     "health_router",
     "new_analysis_router",
-    "model_list_router"
+    "model_list_router",
+    "metrics_router",
+    "sandbox_router"
 ]
@@ -1,7 +1,8 @@
 from fastapi import APIRouter, HTTPException
-from ..models.requests import StartAnalysisRequest
-from ..models.responses import StartAnalysisResponse, GetReportResponse ,CreateSpaceResponse, GetSpaceResponse
-from ..analysis_manager import start_analysis, get_analysis_state, create_space, get_space
+from ..models.requests import StartAnalysisRequest, TablePageRequest
+from ..models.responses import StartAnalysisResponse, GetReportResponse ,CreateSpaceResponse, GetSpaceResponse, CancelAnalysisResponse, TablePageResponse
+from ..analysis_manager import start_analysis, get_analysis_state, create_space, get_space, cancel_analysis, get_table_page
+from ..scheduler import QueueFullError
 
 router = APIRouter()
 
@@ -11,12 +12,24 @@ async def start_analysis_endpoint(request: StartAnalysisRequest):
     try:
         analysis_id = start_analysis(request)
         return StartAnalysisResponse(id=analysis_id)
+    except QueueFullError as e:
+        # キューが満杯の場合は429を返す
+        raise HTTPException(status_code=429, detail=str(e))
     except ValueError as e:
         # バリデーションエラー
         return StartAnalysisResponse(error=str(e))
     except Exception as e:
         return StartAnalysisResponse(error=f"分析開始エラー: {str(e)}")
 
+@router.post("/cancel-analysis/{analysis_id}", response_model=CancelAnalysisResponse)
+async def cancel_analysis_endpoint(analysis_id: str):
+    """実行中の分析をキャンセルする"""
+    try:
+        cancelled = cancel_analysis(analysis_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return CancelAnalysisResponse(id=analysis_id, cancelled=cancelled)
+
 @router.get("/get-report", response_model=GetReportResponse)
 async def get_report(id: str):
     """分析結果を取得する"""
@@ -30,7 +43,10 @@ async def get_report(id: str):
             error=state.get("error", ""),
             python_code=state.get("python_code", ""),
             steps=state.get("steps", []),
-            content=state.get("content", [])
+            content=state.get("content", []),
+            metrics=state.get("metrics", {}),
+            sampling=state.get("sampling"),
+            exact_pending=state.get("exact_pending", False),
         )
     except Exception as e:
         return GetReportResponse(
@@ -43,12 +59,21 @@ async def get_report(id: str):
             steps=[]
         )
 
+@router.post("/get-table-page", response_model=TablePageResponse)
+async def get_table_page_endpoint(request: TablePageRequest):
+    """レポートの表の続きのページを取得する"""
+    try:
+        page = await get_table_page(request.analysis_id, request.block, request.offset, request.limit)
+        return TablePageResponse(**page)
+    except Exception as e:
+        return TablePageResponse(offset=request.offset, error=f"表の取得エラー: {str(e)}")
+
 # spaceの作成と取得
 @router.post("/create-space", response_model=CreateSpaceResponse)
 async def create_space_endpoint():
     """新しいスペースを作成する"""
     try:
-        space_id = create_space()
+        space_id = await create_space()
         return CreateSpaceResponse(id=space_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"スペース作成エラー: {str(e)}")
@@ -0,0 +1,34 @@
+from fastapi import APIRouter, HTTPException
+from ..models.requests import DrainReplicaRequest
+from ..models.responses import SandboxReplicasResponse, DrainReplicaResponse
+from ..code_service import code_service
+
+router = APIRouter()
+
+@router.get("/sandbox/replicas", response_model=SandboxReplicasResponse)
+async def get_replicas():
+    """サンドボックスのレプリカと割り当て済みのspace数を返す"""
+    return SandboxReplicasResponse(replicas=code_service.router.replicas())
+
+@router.post("/sandbox/drain", response_model=DrainReplicaResponse)
+async def drain_replica(request: DrainReplicaRequest):
+    """レプリカを切り離し、そのレプリカのspaceを別のレプリカで再構築する"""
+    try:
+        moved = await code_service.drain_replica(request.url)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except RuntimeError as e:
+        # 最後のレプリカは切り離せない
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to drain sandbox replica: {e}")
+    return DrainReplicaResponse(url=request.url, moved_spaces=moved)
+
+@router.post("/sandbox/undrain", response_model=DrainReplicaResponse)
+async def undrain_replica(request: DrainReplicaRequest):
+    """切り離したレプリカを新しいspaceの配置対象に戻す"""
+    try:
+        code_service.router.undrain(request.url)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return DrainReplicaResponse(url=request.url, moved_spaces=[])
@@ -0,0 +1,325 @@
+import asyncio
+import bisect
+import hashlib
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+import httpx
+
+# サンドボックスのレプリカ一覧（カンマ区切り）。未設定の場合はCODE_RUNNER_URLの1台のみ
+CODE_RUNNER_URLS = [
+    url.strip()
+    for url in os.getenv("CODE_RUNNER_URLS", os.getenv("CODE_RUNNER_URL") or "").split(",")
+    if url.strip()
+]
+# ハッシュリング上の仮想ノード数
+SANDBOX_VIRTUAL_NODES = int(os.getenv("SANDBOX_VIRTUAL_NODES", "64"))
+# 新しいspaceの配置時に/statusのキュー数を比較するレプリカ数
+SANDBOX_PLACEMENT_CANDIDATES = int(os.getenv("SANDBOX_PLACEMENT_CANDIDATES", "2"))
+SANDBOX_STATUS_TIMEOUT = 2.0
+# 再構築で送る1コマンドあたりのタイムアウト(秒)。応答しない再実行で切り離しが止まらないようにする
+SANDBOX_REBUILD_TIMEOUT = float(os.getenv("SANDBOX_REBUILD_TIMEOUT", "300"))
+# 名前空間ごとに保持する再構築用の実行記録の上限(超えたspaceは再構築せず空の名前空間で移す)
+SANDBOX_REBUILD_LOG_MAX_ENTRIES = int(os.getenv("SANDBOX_REBUILD_LOG_MAX_ENTRIES", "200"))
+
+
+def space_key(access_id: str) -> str:
+    """フォーク（"{space_id}:repair:xxxx"など）を元のspaceと同じレプリカに置くためのキー"""
+    return access_id.split(":", 1)[0]
+
+
+def _hash(value: str) -> int:
+    return int(hashlib.md5(value.encode("utf-8")).hexdigest(), 16)
+
+
+class SandboxRouter:
+    """
+    spaceをサンドボックスのレプリカに固定するルーター
+    コンシステントハッシュで候補を決め、新しいspaceは/statusのキュー数が少ない候補に配置する
+    レプリカを切り離す場合は、実行済みコードの記録を別のレプリカで再実行して名前空間を再構築する
+    """
+
+    def __init__(
+        self,
+        urls: List[str] = CODE_RUNNER_URLS,
+        virtual_nodes: int = SANDBOX_VIRTUAL_NODES,
+        placement_candidates: int = SANDBOX_PLACEMENT_CANDIDATES,
+    ):
+        self.urls = list(urls)
+        self.virtual_nodes = virtual_nodes
+        self.placement_candidates = placement_candidates
+        self.draining: Set[str] = set()
+        self._ring: List[Tuple[int, str]] = []
+        self._placements: Dict[str, str] = {}
+        self._migrating: Dict[str, asyncio.Event] = {}
+        # 名前空間の再構築用の実行記録 {access_id: [(code, snapshot, 履歴のindex, sample_rows), ...]}
+        self._code_log: Dict[str, List[Tuple[str, bool, Optional[int], Optional[int]]]] = {}
+        # 実行記録が上限を超えて再構築できなくなったspace
+        self._unrebuildable: Set[str] = set()
+        # spaceごとの現在の履歴のindex(最後に保存したスナップショット)
+        self._versions: Dict[str, int] = {}
+        # ロールバック時に戻る位置（最後にスナップショットを取った実行の直前）
+        self._checkpoints: Dict[str, int] = {}
+        # フォーク時点の元の記録の長さ
+        self._fork_bases: Dict[str, int] = {}
+        self._build_ring()
+
+    def _build_ring(self):
+        self._ring = sorted(
+            (_hash(f"{url}#{i}"), url)
+            for url in self.urls
+            if url not in self.draining
+            for i in range(self.virtual_nodes)
+        )
+
+    def _ring_candidates(self, key: str, count: int) -> List[str]:
+        """ハッシュリング上でキーの位置から時計回りに、重複しないレプリカを最大count台返す"""
+        if not self._ring:
+            return []
+        candidates: List[str] = []
+        start = bisect.bisect(self._ring, (_hash(key), ""))
+        for offset in range(len(self._ring)):
+            url = self._ring[(start + offset) % len(self._ring)][1]
+            if url not in candidates:
+                candidates.append(url)
+                if len(candidates) >= count:
+                    break
+        return candidates
+
+    def replicas(self) -> List[Dict[str, object]]:
+        return [
+            {
+                "url": url,
+                "draining": url in self.draining,
+                "spaces": sum(1 for placed in self._placements.values() if placed == url),
+            }
+            for url in self.urls
+        ]
+
+    async def resolve(self, access_id: str, client: httpx.AsyncClient) -> str:
+        """access_idのリクエストを送るレプリカのURLを返す（未配置のspaceはここで配置する）"""
+        key = space_key(access_id)
+        migrating = self._migrating.get(key)
+        if migrating is not None:
+            await migrating.wait()
+        url = self._placements.get(key)
+        if url is None:
+            url = await self._place(key, client)
+            self._placements.setdefault(key, url)
+            url = self._placements[key]
+        return url
+
+    async def _place(self, key: str, client: httpx.AsyncClient) -> str:
+        candidates = self._ring_candidates(key, self.placement_candidates)
+        if not candidates:
+            raise RuntimeError("No sandbox replica is available")
+        if len(candidates) == 1:
+            return candidates[0]
+        depths = await asyncio.gather(*(self._queue_depth(url, client) for url in candidates))
+        # キュー数が同じ場合はハッシュリング上の順序を優先する
+        best = min(range(len(candidates)), key=lambda i: (depths[i], i))
+        return candidates[best]
+
+    async def _queue_depth(self, url: str, client: httpx.AsyncClient) -> float:
+        try:
+            response = await client.get(url + "status", timeout=SANDBOX_STATUS_TIMEOUT)
+            response.raise_for_status()
+            return float(response.json().get("que", 0))
+        except Exception as e:
+            # 応答しないレプリカは候補から外す
+            print(f"Failed to get status from sandbox {url}: {e}")
+            return float("inf")
+
+    ### 名前空間の再構築用の記録 ###
+    def record_attempt(self, access_id: str, snapshot: bool):
+        """
+        /codeを送る前に呼ぶ。サンドボックスは実行の成否にかかわらず実行前にロールバック用の変数を保存するため、
+        失敗した実行の後の/rollbackでも、その実行の直前まで記録を戻すようにする
+        """
+        if space_key(access_id) in self._unrebuildable:
+            return
+        if snapshot or access_id not in self._checkpoints:
+            self._checkpoints[access_id] = len(self._code_log.get(access_id, []))
+
+    def record_execution(self, access_id: str, code: str, snapshot: bool, sample_rows: Optional[int] = None):
+        key = space_key(access_id)
+        if key in self._unrebuildable:
+            return
+        log = self._code_log.setdefault(access_id, [])
+        self._checkpoints.setdefault(access_id, len(log))
+        log.append((code, snapshot, self._versions.get(key), sample_rows))
+        if len(log) > SANDBOX_REBUILD_LOG_MAX_ENTRIES:
+            # 途中から再実行しても元の名前空間にはならないため、spaceとフォークの記録をすべて捨てる
+            print(f"Rebuild log of {key} exceeded {SANDBOX_REBUILD_LOG_MAX_ENTRIES} entries; it will not be rebuilt on drain")
+            self._unrebuildable.add(key)
+            for logged_id in [logged_id for logged_id in self._code_log if space_key(logged_id) == key]:
+                self._code_log.pop(logged_id, None)
+                self._checkpoints.pop(logged_id, None)
+                self._fork_bases.pop(logged_id, None)
+
+    def record_version(self, access_id: str, version: int):
+        self._versions[space_key(access_id)] = version
+
+    def record_revert(self, access_id: str, version: int):
+        """履歴のindex以降に実行したコードを記録から取り除く"""
+        log = self._code_log.get(access_id, [])
+        self._code_log[access_id] = [entry for entry in log if entry[2] is None or entry[2] < version]
+        self._checkpoints[access_id] = len(self._code_log[access_id])
+        self._versions[space_key(access_id)] = version
+
+    def record_rollback(self, access_id: str):
+        log = self._code_log.get(access_id)
+        if log is not None:
+            del log[self._checkpoints.get(access_id, len(log)):]
+
+    def record_fork(self, access_id: str, fork_id: str):
+        if space_key(access_id) in self._unrebuildable:
+            return
+        log = self._code_log.get(access_id, [])
+        self._code_log[fork_id] = list(log)
+        self._checkpoints[fork_id] = self._checkpoints.get(access_id, len(log))
+        self._fork_bases[fork_id] = len(log)
+
+    def record_promote(self, access_id: str, fork_id: str):
+        self._code_log[access_id] = self._code_log.pop(fork_id, [])
+        self._checkpoints[access_id] = self._checkpoints.pop(fork_id, 0)
+        self._fork_bases.pop(fork_id, None)
+
+    def record_merge(self, access_id: str, fork_id: str, renamed: Optional[Dict[str, str]] = None):
+        # mergeはフォークで定義・再代入された変数だけを取り込むため、再実行は近似になる
+        if space_key(access_id) in self._unrebuildable:
+            return
+        fork_log = self._code_log.get(fork_id, [])
+        base = self._fork_bases.get(fork_id, 0)
+        log = self._code_log.setdefault(access_id, [])
+        self._checkpoints[access_id] = len(log)
+        entries = fork_log[base:]
+        if renamed and entries:
+            # 名前が衝突して接頭辞付きで取り込んだ変数は、フォークのコードの実行後に付け替えて元の値に戻す
+            version = entries[-1][2]
+            saved = ", ".join(f"{name!r}: {name}" for name in renamed)
+            restore = "\n".join(f"{new_name} = {name}\n{name} = _merge_saved[{name!r}]" for name, new_name in renamed.items())
+            entries = (
+                [(f"_merge_saved = {{{saved}}}", False, version, None)]
+                + entries
+                + [(f"{restore}\ndel _merge_saved", False, version, None)]
+            )
+        log.extend(entries)
+
+    def record_drop(self, access_id: str):
+        self._code_log.pop(access_id, None)
+        self._checkpoints.pop(access_id, None)
+        self._fork_bases.pop(access_id, None)
+        if access_id == space_key(access_id):
+            self._placements.pop(access_id, None)
+            self._versions.pop(access_id, None)
+            self._unrebuildable.discard(access_id)
+
+    ### レプリカの切り離し ###
+    async def drain(self, url: str, client: httpx.AsyncClient) -> List[str]:
+        """
+        レプリカを新しい配置の対象から外し、そのレプリカのspaceを別のレプリカで再構築する
+        再構築したspaceのキーを返す
+        """
+        if url not in self.urls:
+            raise ValueError(f"Unknown sandbox replica: {url}")
+        if not any(other != url and other not in self.draining for other in self.urls):
+            raise RuntimeError(f"Cannot drain {url}: no other sandbox replica is available")
+        self.draining.add(url)
+        self._build_ring()
+        moved: List[str] = []
+        for key in [k for k, placed in self._placements.items() if placed == url]:
+            event = asyncio.Event()
+            self._migrating[key] = event
+            try:
+                new_url = await self._place(key, client)
+                await self._rebuild(key, url, new_url, client)
+                self._placements[key] = new_url
+                moved.append(key)
+            except Exception as e:
+                # 再構築できなかったspaceは元のレプリカに残し、他のspaceの移動を続ける
+                print(f"Failed to move {key} off sandbox {url}: {e}")
+            finally:
+                event.set()
+                self._migrating.pop(key, None)
+        return moved
+
+    def undrain(self, url: str):
+        """切り離したレプリカを新しい配置の対象に戻す"""
+        if url not in self.urls:
+            raise ValueError(f"Unknown sandbox replica: {url}")
+        self.draining.discard(url)
+        self._build_ring()
+
+    async def _rebuild(self, key: str, old_url: str, new_url: str, client: httpx.AsyncClient):
+        forks = [access_id for access_id in self._code_log if access_id != key and space_key(access_id) == key]
+        if key in self._unrebuildable:
+            print(f"Moving {key} to {new_url} without its namespace: the rebuild log exceeded its limit")
+        else:
+            try:
+                await self._replay(key, forks, new_url, client)
+            except Exception:
+                # 途中まで作った名前空間を残さない
+                for access_id in forks + [key]:
+                    await self._drop_quietly(client, new_url, access_id)
+                raise
+        # 元のレプリカの名前空間は破棄する（既に停止している場合は無視）
+        for access_id in forks + [key]:
+            await self._drop_quietly(client, old_url, access_id)
+
+    async def _replay(self, key: str, forks: List[str], url: str, client: httpx.AsyncClient):
+        """
+        元のspaceの記録を再実行し、各フォークはフォークした時点まで再実行したところでフォークする
+        その後で各フォークが独自に実行したコードを再実行する
+        """
+        log = self._code_log.get(key, [])
+        forks_at: Dict[int, List[str]] = {}
+        for fork_id in forks:
+            base = self._fork_bases.get(fork_id, 0)
+            # フォーク後に元のspaceをロールバックした場合など、記録が分岐している場合は空の状態からフォークする
+            if self._code_log[fork_id][:base] != log[:base]:
+                base = 0
+            forks_at.setdefault(base, []).append(fork_id)
+        replay_from: Dict[str, int] = {}
+        version = None
+        for position in range(len(log) + 1):
+            for fork_id in forks_at.get(position, []):
+                await self._send(client, url, "fork", {"id": key, "fork_id": fork_id})
+                replay_from[fork_id] = position
+            if position == len(log):
+                break
+            code, snapshot, entry_version, sample_rows = log[position]
+            # 履歴のindexごとのスナップショットも作り直す
+            if entry_version is not None and entry_version != version:
+                version = entry_version
+                await self._send(client, url, "checkpoint", {"id": key, "version": version})
+            await self._send_code(client, url, key, code, snapshot, sample_rows)
+        for fork_id in forks:
+            for code, snapshot, _, sample_rows in self._code_log[fork_id][replay_from[fork_id]:]:
+                await self._send_code(client, url, fork_id, code, snapshot, sample_rows)
+
+    async def _send_code(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        access_id: str,
+        code: str,
+        snapshot: bool,
+        sample_rows: Optional[int],
+    ):
+        payload = {"code": code.replace("\\", "%@"), "id": access_id, "snapshot": snapshot, "sample_rows": sample_rows}
+        return await self._send(client, url, "code", payload)
+
+    async def _drop_quietly(self, client: httpx.AsyncClient, url: str, access_id: str):
+        try:
+            await self._send(client, url, "drop", {"id": access_id})
+        except Exception as e:
+            print(f"Failed to drop {access_id} on sandbox {url}: {e}")
+
+    async def _send(self, client: httpx.AsyncClient, url: str, command: str, payload: dict):
+        response = await client.post(url + command, json=payload, timeout=SANDBOX_REBUILD_TIMEOUT)
+        response.raise_for_status()
+        result = response.json()
+        if "error" in result:
+            print(f"Error while rebuilding {payload['id']} ({command}): {result['error']}")
+        return result
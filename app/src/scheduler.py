@@ -0,0 +1,119 @@
+import asyncio
+import heapq
+import itertools
+import os
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional
+
+# 同時実行数とキュー長の上限（環境変数で上書き可能）
+MAX_CONCURRENT_PER_MODEL = int(os.getenv("MAX_CONCURRENT_PER_MODEL", "4"))
+MAX_CONCURRENT_SANDBOX = int(os.getenv("MAX_CONCURRENT_SANDBOX", "4"))
+MAX_QUEUED_ANALYSES = int(os.getenv("MAX_QUEUED_ANALYSES", "32"))
+
+
+class QueueFullError(Exception):
+    """キューが満杯で分析を受け付けられない場合の例外"""
+
+
+class _Ticket:
+    def __init__(
+        self,
+        model: str,
+        analysis_id: str,
+        priority: int,
+        seq: int,
+        on_position: Optional[Callable[[int], None]],
+    ):
+        self.model = model
+        self.analysis_id = analysis_id
+        self.priority = priority
+        self.seq = seq
+        self.on_position = on_position
+        self.ready = asyncio.Event()
+
+    def __lt__(self, other: "_Ticket") -> bool:
+        # priorityが大きいものを優先し、同じ優先度ならFIFO
+        return (-self.priority, self.seq) < (-other.priority, other.seq)
+
+
+class AnalysisScheduler:
+    """モデルごと・サンドボックスごとの同時実行数を制御する分析スケジューラ"""
+
+    def __init__(
+        self,
+        max_per_model: int = MAX_CONCURRENT_PER_MODEL,
+        max_sandbox: int = MAX_CONCURRENT_SANDBOX,
+        max_queued: int = MAX_QUEUED_ANALYSES,
+    ):
+        self.max_per_model = max_per_model
+        self.max_queued = max_queued
+        self._running: Dict[str, int] = {}
+        self._queues: Dict[str, List[_Ticket]] = {}
+        self._seq = itertools.count()
+        self._sandbox_slots = asyncio.Semaphore(max_sandbox)
+
+    def queued_count(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def is_full(self) -> bool:
+        return self.queued_count() >= self.max_queued
+
+    def submit(
+        self,
+        model: str,
+        analysis_id: str,
+        job: Callable[[], Awaitable[None]],
+        priority: int = 0,
+        on_position: Optional[Callable[[int], None]] = None,
+    ) -> asyncio.Task:
+        """分析ジョブをキューに追加し、スロットが空き次第実行するタスクを返す"""
+        if self.is_full():
+            raise QueueFullError("Analysis queue is full. Please try again later.")
+        ticket = _Ticket(model, analysis_id, priority, next(self._seq), on_position)
+        heapq.heappush(self._queues.setdefault(model, []), ticket)
+        self._dispatch(model)
+        return asyncio.create_task(self._run(ticket, job))
+
+    async def _run(self, ticket: _Ticket, job: Callable[[], Awaitable[None]]):
+        try:
+            await ticket.ready.wait()
+        except asyncio.CancelledError:
+            # 待機中にキャンセルされた場合はキューから取り除く
+            self._remove(ticket)
+            raise
+        try:
+            await job()
+        finally:
+            self._running[ticket.model] -= 1
+            self._dispatch(ticket.model)
+
+    def _remove(self, ticket: _Ticket):
+        queue = self._queues.get(ticket.model, [])
+        if ticket in queue:
+            queue.remove(ticket)
+            heapq.heapify(queue)
+            self._notify_positions(ticket.model)
+        elif ticket.ready.is_set():
+            # スロット割り当て直後にキャンセルされた場合はスロットを返却
+            self._running[ticket.model] -= 1
+            self._dispatch(ticket.model)
+
+    def _dispatch(self, model: str):
+        """空きスロットがあればキューの先頭から実行を許可する"""
+        queue = self._queues.get(model, [])
+        while queue and self._running.get(model, 0) < self.max_per_model:
+            ticket = heapq.heappop(queue)
+            self._running[model] = self._running.get(model, 0) + 1
+            ticket.ready.set()
+        self._notify_positions(model)
+
+    def _notify_positions(self, model: str):
+        for position, ticket in enumerate(sorted(self._queues.get(model, [])), start=1):
+            if ticket.on_position:
+                ticket.on_position(position)
+
+    @asynccontextmanager
+    async def sandbox_slot(self):
+        """サンドボックスへの同時実行数を制限するコンテキスト"""
+        async with self._sandbox_slots:
+            yield
@@ -0,0 +1,139 @@
+import ast
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# 直前の文の続きであり、新しいトップレベル文の開始とはみなさない行頭
+_CONTINUATION_PREFIXES = ("else", "elif", "except", "finally", "case", ")", "]", "}", "#", "@")
+
+
+def split_complete_statements(code: str) -> int:
+    """
+    ストリーミング中のコードから、構文的に完結したトップレベル文の末尾位置を返す
+    (完結した文がなければ0)
+    """
+    # 改行まで届いた行だけを対象にする
+    complete = code[: code.rfind("\n") + 1]
+    boundary = 0
+    offset = 0
+    for line in complete.splitlines(keepends=True):
+        if (
+            offset > 0
+            and line.strip()
+            and not line[0].isspace()
+            and not line.lstrip().startswith(_CONTINUATION_PREFIXES)
+        ):
+            # 次のトップレベル文が始まっている → それより前が完結しているか確認
+            try:
+                ast.parse(complete[:offset])
+                boundary = offset
+            except SyntaxError:
+                pass
+        offset += len(line)
+    return boundary
+
+
+class StatementStreamExecutor:
+    """
+    <python>ブロックを受信しながら、完結したトップレベル文から順にサンドボックスで実行する
+    失敗した場合はロールバックしてブロック全体の実行にフォールバックする
+    checkを渡すと、文を実行する前に(文, それまでに実行した文)で検査し、問題のメッセージが返れば実行しない
+    interruptを渡すと、</python>に到達せずに終了した場合にサンドボックスで実行中の文を中断する
+    """
+
+    def __init__(
+        self,
+        execute: Callable[[str, bool], Awaitable[Dict[str, Any]]],
+        rollback: Callable[[], Awaitable[Dict[str, Any]]],
+        check: Optional[Callable[[str, str], Awaitable[str]]] = None,
+        interrupt: Optional[Callable[[], Awaitable[Dict[str, Any]]]] = None,
+    ):
+        self._execute = execute
+        self._rollback = rollback
+        self._check = check
+        self._interrupt = interrupt
+        self._finishing = False
+        self._sent = 0
+        self._queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        self._executed: List[str] = []
+        self.failed = False
+        # 実行前の検査で見つかった問題（ブロックの文を1つも実行せずに検査で失敗した場合のみ設定する）
+        # 設定されている場合は名前空間が変わっていないため、呼び出し元はロールバックしない
+        self.check_error = ""
+
+    def feed(self, code: str):
+        """受信済みのコード（</python>より前）を渡し、新しく完結した文を実行キューに入れる"""
+        if self.failed:
+            return
+        boundary = split_complete_statements(code[self._sent:])
+        if boundary == 0:
+            return
+        statements = code[self._sent : self._sent + boundary]
+        self._sent += boundary
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+        self._queue.put_nowait(statements)
+
+    async def _run(self):
+        while True:
+            statements = await self._queue.get()
+            if statements is None:
+                return
+            if self._check is not None and await self._check(statements, "".join(self._executed)):
+                # 検査で問題が見つかった文は実行せず、ブロック全体の検査と実行に任せる
+                self.failed = True
+                return
+            # 最初の実行時のみロールバック用のスナップショットを取る
+            # (実行中に中断された文も名前空間を変えている可能性があるため、送信前に実行済みとして記録する)
+            snapshot = not self._executed
+            self._executed.append(statements)
+            result = await self._execute(statements, snapshot)
+            if result and ("error" in result or "code_error" in result):
+                self.failed = True
+                return
+
+    async def finish(self, full_code: str) -> Dict[str, Any]:
+        """</python>到達時に呼び出し、残りの文を実行して最終的な実行結果を返す"""
+        self._finishing = True
+        if self._worker is not None:
+            if not self.failed:
+                self._queue.put_nowait(None)
+            await self._worker
+        if self.failed:
+            # 途中の文が失敗した場合は、ロールバックしてブロック全体を実行し直す
+            print("Streaming execution failed, falling back to whole-block execution")
+            if self._executed:
+                await self._rollback()
+                self._executed = []
+            return await self._checked_execute(full_code, "")
+        remaining = full_code[self._sent:]
+        if not remaining.strip():
+            return {"result": {"ok": "code executed successfully"}}
+        return await self._checked_execute(remaining, "".join(self._executed))
+
+    async def _checked_execute(self, code: str, preceding: str) -> Dict[str, Any]:
+        if self._check is not None:
+            error = await self._check(code, preceding)
+            if error:
+                # 実行済みの文がある場合は、呼び出し元のロールバックで戻す
+                if not self._executed:
+                    self.check_error = error
+                return {"code_error": error}
+        return await self._execute(code, not self._executed)
+
+    async def abort(self):
+        """
+        ストリームが</python>に到達せずに終了した場合に実行待ちの文を破棄し、実行中の文を中断する
+        途中まで実行した文があれば名前空間をロールバックする(finishを呼び出した後は何もしない)
+        """
+        if self._finishing:
+            return
+        self._finishing = True
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            if self._interrupt is not None:
+                await self._interrupt()
+        if self._executed:
+            await self._rollback()
+            self._executed = []
@@ -0,0 +1,179 @@
+import os
+import time
+import threading
+from typing import Callable, List, Optional
+from urllib.parse import quote
+
+import pandas as pd
+import pyarrow as pa
+from sqlalchemy import inspect
+from quelmap_table_changes import table_change_counters
+
+from .database import engine
+from .utils.table_versions import get_table_version, on_tables_changed
+
+# サンドボックスと共有するテーブルのスナップショット(Arrow形式)の保存先
+TABLE_SNAPSHOT_DIR = os.getenv("TABLE_SNAPSHOT_DIR", "/tmp/quelmap-table-snapshots")
+TABLE_SNAPSHOTS = os.getenv("TABLE_SNAPSHOTS", "true").lower() == "true"
+# 書き出し時に一度に読み込む行数(テーブル全体をメモリに載せないようにする)
+TABLE_SNAPSHOT_CHUNK_ROWS = int(os.getenv("TABLE_SNAPSHOT_CHUNK_ROWS", "50000"))
+# スナップショットの有効期限(秒、0は無期限)。サンドボックスは期限を過ぎたスナップショットを使わない
+TABLE_SNAPSHOT_TTL = float(os.getenv("TABLE_SNAPSHOT_TTL", "600"))
+# アプリを経由しないテーブルの変更と有効期限を確認して書き出し直す間隔(秒、0は確認しない)
+TABLE_SNAPSHOT_CHECK_INTERVAL = float(os.getenv("TABLE_SNAPSHOT_CHECK_INTERVAL", "60"))
+# 書き出し時のテーブルの変更の累計を記録するArrowのスキーマのメタデータのキー(サンドボックス側と同じ)
+TABLE_CHANGES_METADATA = b"quelmap_table_changes"
+
+
+def snapshot_path(table_name: str) -> str:
+    """テーブルのスナップショットのパス(サンドボックス側と同じ命名)"""
+    return os.path.join(TABLE_SNAPSHOT_DIR, quote(table_name, safe="") + ".arrow")
+
+
+def table_changes(table_name: str) -> Optional[str]:
+    """アプリを経由しない変更も含めたテーブルの変更の累計(PostgreSQL以外や取得できない場合はNone)"""
+    if engine.dialect.name != "postgresql":
+        return None
+    try:
+        connection = engine.raw_connection()
+        try:
+            return table_change_counters(connection, [table_name]).get(table_name)
+        finally:
+            connection.close()
+    except Exception as e:
+        print(f"Failed to check changes of {table_name}: {e}")
+        return None
+
+
+def _with_changes(table: pa.Table, changes: Optional[str]) -> pa.Table:
+    if changes is None:
+        return table
+    return table.replace_schema_metadata({**(table.schema.metadata or {}), TABLE_CHANGES_METADATA: changes.encode()})
+
+
+def _recorded_changes(path: str) -> Optional[str]:
+    """スナップショットに記録した書き出し時のテーブルの変更の累計"""
+    try:
+        metadata = pa.ipc.open_file(pa.memory_map(path)).schema.metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return None
+    changes = metadata.get(TABLE_CHANGES_METADATA)
+    return changes.decode() if changes is not None else None
+
+
+def export_table(table_name: str) -> bool:
+    """
+    テーブルをTABLE_SNAPSHOT_CHUNK_ROWS行ずつ読み込み、Arrow形式で書き出す
+    書き出し中にテーブルが変更された場合は、古いデータのスナップショットを残さない
+    """
+    version = get_table_version(table_name)
+    # 読み込みより前の値を記録する(読み込み中に変更された場合はサンドボックスがスナップショットを使わない)
+    changes = table_changes(table_name)
+    path = snapshot_path(table_name)
+    staging = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(TABLE_SNAPSHOT_DIR, exist_ok=True)
+        with engine.connect().execution_options(stream_results=True) as connection:
+            with pa.OSFile(staging, "wb") as f:
+                writer = None
+                try:
+                    for chunk in pd.read_sql_table(table_name, connection, chunksize=TABLE_SNAPSHOT_CHUNK_ROWS):
+                        if writer is None:
+                            table = _with_changes(pa.Table.from_pandas(chunk, preserve_index=False), changes)
+                            writer = pa.ipc.new_file(f, table.schema)
+                            writer.write_table(table)
+                        else:
+                            # 最初のチャンクの列の型に揃える(揃えられない場合は例外で書き出しをやめる)
+                            writer.write_table(pa.Table.from_pandas(chunk, schema=table.schema, preserve_index=False))
+                    if writer is None:
+                        # 行がないテーブルは列だけのスナップショットにする
+                        table = _with_changes(
+                            pa.Table.from_pandas(pd.read_sql_table(table_name, connection), preserve_index=False), changes
+                        )
+                        writer = pa.ipc.new_file(f, table.schema)
+                        writer.write_table(table)
+                finally:
+                    if writer is not None:
+                        writer.close()
+        if get_table_version(table_name) != version:
+            os.remove(staging)
+            return False
+        os.replace(staging, path)
+        return True
+    except Exception as e:
+        print(f"Failed to export snapshot of {table_name}: {e}")
+        if os.path.exists(staging):
+            os.remove(staging)
+        return False
+
+
+def _refresh_changed(get_table_names: Callable[[], List[str]]):
+    """アプリを経由せずに変更されたテーブルと、有効期限が近いテーブルのスナップショットを書き出し直す"""
+    refresh = []
+    for table_name in get_table_names():
+        path = snapshot_path(table_name)
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            continue
+        expiring = TABLE_SNAPSHOT_TTL and age > TABLE_SNAPSHOT_TTL - TABLE_SNAPSHOT_CHECK_INTERVAL
+        if expiring or table_changes(table_name) != _recorded_changes(path):
+            refresh.append(table_name)
+    if refresh:
+        _export_existing(refresh)
+
+
+def start_refresher(get_table_names: Callable[[], List[str]]):
+    """スナップショットの変更の確認と書き出し直しを定期的に行うスレッドを開始する"""
+    if not TABLE_SNAPSHOTS or not TABLE_SNAPSHOT_CHECK_INTERVAL:
+        return
+
+    def _run():
+        while True:
+            time.sleep(TABLE_SNAPSHOT_CHECK_INTERVAL)
+            try:
+                _refresh_changed(get_table_names)
+            except Exception as e:
+                print(f"Failed to refresh table snapshots: {e}")
+
+    threading.Thread(target=_run, daemon=True).start()
+
+
+def remove_snapshots(table_names: List[str]):
+    for table_name in table_names:
+        try:
+            os.remove(snapshot_path(table_name))
+        except FileNotFoundError:
+            pass
+
+
+def refresh_snapshots(table_names: List[str]):
+    """変更されたテーブルの古いスナップショットを削除し、バックグラウンドで書き出し直す"""
+    if not TABLE_SNAPSHOTS:
+        return
+    remove_snapshots(table_names)
+    threading.Thread(target=_export_existing, args=(list(table_names),), daemon=True).start()
+
+
+def ensure_snapshots(table_names: List[str]):
+    """スナップショットがないテーブルをバックグラウンドで書き出す(起動時に使用)"""
+    if not TABLE_SNAPSHOTS:
+        return
+    missing = [table_name for table_name in table_names if not os.path.exists(snapshot_path(table_name))]
+    if missing:
+        threading.Thread(target=_export_existing, args=(missing,), daemon=True).start()
+
+
+def _export_existing(table_names: List[str]):
+    # 削除・名前変更で存在しなくなったテーブルは書き出さない
+    try:
+        existing = set(inspect(engine).get_table_names())
+    except Exception as e:
+        print(f"Failed to list tables for snapshots: {e}")
+        return
+    for table_name in table_names:
+        if table_name in existing:
+            export_table(table_name)
+
+
+on_tables_changed(refresh_snapshots)
@@ -1,13 +1,17 @@
-from .prompts import get_db_embedded_prompt, set_db_schema, is_database_registered
+from .prompts import get_db_embedded_prompt, get_agentic_plan_prompt, set_db_schema, is_database_registered
 from .reports import save_report
 from .llm_models import get_model_list, get_openai_client,get_model_by_id
+from .tables import columnar_to_records, table_records
 
 __all__ = [
     "get_db_embedded_prompt",
+    "get_agentic_plan_prompt",
     "set_db_schema",
     "is_database_registered",
     "save_report",
     "get_model_list",
     "get_openai_client",
     "get_model_by_id",
+    "columnar_to_records",
+    "table_records",
 ]
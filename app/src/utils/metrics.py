@@ -0,0 +1,16 @@
+# Histogram/Counter/Gaugeの実装はサンドボックスと共通(shared/quelmap_metrics.py)
+from quelmap_metrics import DEFAULT_BUCKETS, Counter, Gauge, Histogram, register, render_metrics
+
+# 分析の各フェーズのメトリクス
+QUEUE_WAIT = register(Histogram("quelmap_analysis_queue_wait_seconds", "Time an analysis waited in the scheduler queue", labels=("model",)))
+TIME_TO_FIRST_TOKEN = register(Histogram("quelmap_analysis_time_to_first_token_seconds", "Time until the first token of the model response", labels=("model",)))
+TOKENS_PER_SECOND = register(Histogram("quelmap_analysis_tokens_per_second", "Streaming generation speed", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500), labels=("model",)))
+CODE_EXECUTION = register(Histogram("quelmap_analysis_code_execution_seconds", "Sandbox code execution time per analysis"))
+REPAIR_COUNT = register(Histogram("quelmap_analysis_repair_count", "Number of code repair rounds per analysis", buckets=(0, 1, 2, 3, 5)))
+VARIABLE_FETCH = register(Histogram("quelmap_analysis_variable_fetch_seconds", "Time spent fetching report variables from the sandbox"))
+CONTENT_RENDER = register(Histogram("quelmap_analysis_content_render_seconds", "Time spent rendering report content"))
+ANALYSES_TOTAL = register(Counter("quelmap_analyses_total", "Finished analyses by outcome", labels=("outcome",)))
+SANDBOX_REQUEST = register(Histogram("quelmap_sandbox_request_seconds", "Latency of HTTP calls to the sandbox", labels=("endpoint", "replica", "outcome")))
+SANDBOX_RETRIES = register(Counter("quelmap_sandbox_retries_total", "Retried HTTP calls to the sandbox", labels=("endpoint",)))
+PREFLIGHT_PROBLEMS = register(Counter("quelmap_preflight_problems_total", "Problems found in generated code before sandbox execution", labels=("kind",)))
+SANDBOX_MIGRATIONS = register(Counter("quelmap_sandbox_migrated_spaces_total", "Spaces rebuilt on another replica after a drain", labels=("replica",)))
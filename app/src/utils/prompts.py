@@ -8,14 +8,22 @@ with open(os.path.join(prompts_dir, "prompt-v3.txt"), "r", encoding="utf-8") as
     PromptText = f.read()
 with open(os.path.join(prompts_dir, "prompt-v3+.txt"), "r", encoding="utf-8") as f:
     PromptText_with_Example = f.read()
+with open(os.path.join(prompts_dir, "agentic-plan.txt"), "r", encoding="utf-8") as f:
+    AgenticPlanPromptText = f.read()
+with open(os.path.join(prompts_dir, "columnar-engine.txt"), "r", encoding="utf-8") as f:
+    ColumnarEnginePromptText = f.read()
+
+# サンドボックスで埋め込みの列指向SQLエンジン(duck)が有効な場合は、使い方をプロンプトに追加する
+SANDBOX_DUCKDB = os.getenv("SANDBOX_DUCKDB", "false").lower() == "true"
+if SANDBOX_DUCKDB:
+    PromptText = PromptText.replace("\n### Reporting Guidelines", ColumnarEnginePromptText + "\n### Reporting Guidelines", 1)
+    PromptText_with_Example = PromptText_with_Example.replace("\n### Reporting Guidelines", ColumnarEnginePromptText + "\n### Reporting Guidelines", 1)
 
 dbinfo_dir = os.path.join(prompts_dir, "dbinfo")
 databaseinfo = {}
 
-def get_db_embedded_prompt(tables = []):
-    """
-    DBのテーブル情報を取得し、プロンプトに埋め込む関数
-    """
+def _build_dbinfo(tables = []):
+    """指定されたテーブル（空の場合は全テーブル）のスキーマ情報を連結する"""
     dbinfo = ""
     if len(tables) == 0:
         # 全てのテーブル情報を取得
@@ -24,14 +32,32 @@ def get_db_embedded_prompt(tables = []):
         if table in databaseinfo:
             dbinfo += databaseinfo[table]
             dbinfo += "\n\n"
+    return dbinfo
+
+def get_db_embedded_prompt(tables = []):
+    """
+    DBのテーブル情報を取得し、プロンプトに埋め込む関数
+    """
+    dbinfo = _build_dbinfo(tables)
     return [PromptText_with_Example.replace("@databaseinfo", dbinfo), PromptText.replace("@databaseinfo", dbinfo)]
 
+def get_agentic_plan_prompt(tables = [], max_steps = 4):
+    """
+    エージェント型分析で質問をサブ質問に分解するためのプロンプトを返す関数
+    """
+    dbinfo = _build_dbinfo(tables)
+    return AgenticPlanPromptText.replace("@databaseinfo", dbinfo).replace("@max_steps", str(max_steps))
+
 def set_db_schema():
     global databaseinfo
     databaseinfo = db_to_schema_main(engine)
     if "error" in databaseinfo:
         print("Error retrieving database schema:", databaseinfo["error"])
 
+def get_registered_tables():
+    """スキーマが登録されているテーブル名の一覧を取得"""
+    return [table for table in databaseinfo.keys() if table != "error"]
+
 def is_database_registered() -> bool:
     """データベースが登録されているかチェック"""
     return len(databaseinfo) > 0
@@ -0,0 +1,29 @@
+from typing import Callable, Dict, Iterable, List
+
+# テーブルごとのデータバージョン（DataServiceで変更されるたびに加算）
+table_versions: Dict[str, int] = {}
+
+# テーブル変更時に呼び出されるコールバック
+_listeners: List[Callable[[List[str]], None]] = []
+
+
+def get_table_version(table_name: str) -> int:
+    """指定されたテーブルの現在のバージョンを取得"""
+    return table_versions.get(table_name, 0)
+
+
+def on_tables_changed(callback: Callable[[List[str]], None]):
+    """テーブル変更時のコールバックを登録"""
+    _listeners.append(callback)
+
+
+def bump_table_versions(table_names: Iterable[str]):
+    """テーブルのバージョンを更新し、登録されたコールバックに通知する"""
+    changed = list(dict.fromkeys(table_names))
+    for table_name in changed:
+        table_versions[table_name] = table_versions.get(table_name, 0) + 1
+    for callback in _listeners:
+        try:
+            callback(changed)
+        except Exception as e:
+            print(f"Error notifying table change: {e}")
@@ -0,0 +1,17 @@
+import json
+from typing import Any, Dict
+
+
+def columnar_to_records(data: str) -> str:
+    """サンドボックスの列指向のJSONを、フロントエンドが扱う行指向(records)のJSONに変換する"""
+    table = json.loads(data)
+    columns = table["columns"]
+    records = [dict(zip(columns, row)) for row in zip(*table["data"])]
+    return json.dumps(records, ensure_ascii=False)
+
+
+def table_records(var_content: Dict[str, Any]) -> str:
+    """/varの表データを行指向のJSONにする(列指向でない場合はそのまま返す)"""
+    if var_content.get("format") == "columnar":
+        return columnar_to_records(var_content["data"])
+    return var_content["data"]
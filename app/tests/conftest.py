@@ -0,0 +1,8 @@
+import os
+import sys
+
+# src.databaseはimport時にエンジンを作成するため、接続しないSQLiteを指定しておく
+os.environ.setdefault("USER_DATABASE_URL", "sqlite://")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+# サンドボックスと共通のモジュール(イメージではsrcと同じ場所にコピーされる)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "shared"))
@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from src import analysis_manager, deadline
+from src.code_service import code_service
+from src.deadline import DeadlineBudget
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(deadline.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def sandbox(monkeypatch):
+    timeouts = []
+    dropped = []
+
+    async def execute_code(python_code, access_id, budget, **kwargs):
+        timeouts.append(budget.remaining("execution"))
+        return {"result": {}}
+
+    async def parse_response_to_content(full_response, access_id, ignore_errors=True):
+        return [{"type": "markdown", "content": "exact"}]
+
+    async def promote_fork(space_id, fork_id):
+        return {"result": {}}
+
+    async def drop_space(access_id):
+        dropped.append(access_id)
+        return {"result": {}}
+
+    monkeypatch.setattr(analysis_manager, "_execute_code", execute_code)
+    monkeypatch.setattr(analysis_manager, "_parse_response_to_content", parse_response_to_content)
+    monkeypatch.setattr(code_service, "promote_fork", promote_fork)
+    monkeypatch.setattr(code_service, "drop_space", drop_space)
+    monkeypatch.setattr(analysis_manager, "analysis_states", {"a1": {"exact_pending": True, "sampling": []}})
+    monkeypatch.setattr(analysis_manager, "spaces", {"space": ["a1"]})
+    return timeouts, dropped
+
+
+def test_exact_followup_is_not_bounded_by_the_approximate_run(clock, sandbox):
+    timeouts, dropped = sandbox
+    approximate = DeadlineBudget()
+    approximate.start("execution")
+    # 近似の分析で締め切りの大半を使い切った後に正確な結果の計算を始める
+    clock[0] += deadline.ANALYSIS_DEADLINE - 1
+    assert approximate.remaining("execution") == 0
+
+    asyncio.run(analysis_manager._run_exact_followup("space", "a1", "space:exact", "x = 1", "<report></report>"))
+
+    assert timeouts == [min(analysis_manager.EXACT_FOLLOWUP_EXECUTION_BUDGET, analysis_manager.EXACT_FOLLOWUP_DEADLINE)]
+    state = analysis_manager.analysis_states["a1"]
+    assert state["content"] == [{"type": "markdown", "content": "exact"}]
+    assert state["exact_pending"] is False
+    assert "sampling" not in state
+    # 採用したフォークは破棄しない
+    assert dropped == []
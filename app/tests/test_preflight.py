@@ -0,0 +1,130 @@
+import ast
+import asyncio
+
+import pytest
+
+from src.preflight import _check_sql, _undefined_names
+
+CATALOG = {
+    "orders": {"id", "customer_id", "amount", "ordered_at"},
+    "customers": {"id", "name", "region"},
+}
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT * FROM orders",
+        "SELECT o.amount, c.name FROM orders o JOIN customers c ON c.id = o.customer_id",
+        "SELECT o.amount FROM orders AS o WHERE o.amount > 0",
+        'SELECT "amount" FROM orders',
+        # AS付きの別名をORDER BYで引用符付きで参照する
+        'SELECT customer_id, sum(amount) AS total FROM orders GROUP BY customer_id ORDER BY "total"',
+        'SELECT customer_id, sum(amount) AS "Total" FROM orders GROUP BY customer_id ORDER BY "Total"',
+        # ASを省略した別名
+        'SELECT count(*) "n" FROM orders',
+        'SELECT "amount" "value" FROM orders ORDER BY "value"',
+        "WITH recent AS (SELECT * FROM orders) SELECT * FROM recent",
+        "SELECT extract(year FROM ordered_at) FROM orders",
+        "SELECT * FROM generate_series(1, 10)",
+        "SELECT * FROM information_schema.tables",
+        "SELECT * FROM orders WHERE note = 'from nowhere'",
+        "SELECT * FROM orders -- FROM missing_table",
+    ],
+)
+def test_check_sql_accepts_valid_sql(sql):
+    problems, _ = _check_sql(1, sql, CATALOG, set())
+    assert problems == []
+
+
+@pytest.mark.parametrize(
+    "sql, kind, name",
+    [
+        ("SELECT * FROM order_items", "table", "order_items"),
+        ("SELECT * FROM orders JOIN customer ON customer.id = orders.customer_id", "table", "customer"),
+        ("SELECT o.amont FROM orders o", "column", "amont"),
+        ("SELECT c.nmae FROM orders o JOIN customers c ON c.id = o.customer_id", "column", "nmae"),
+        ('SELECT "amont" FROM orders', "column", "amont"),
+        ('SELECT "amount" FROM orders ORDER BY "amont"', "column", "amont"),
+    ],
+)
+def test_check_sql_reports_unknown_names(sql, kind, name):
+    problems, database_query = _check_sql(1, sql, CATALOG, set())
+    assert [problem_kind for problem_kind, _ in problems] == [kind]
+    assert f"`{name}`" in problems[0][1]
+    assert not database_query
+
+
+@pytest.mark.parametrize(
+    "sql, python_names, database_query",
+    [
+        ("SELECT * FROM orders", set(), True),
+        # duck.sqlで名前空間のDataFrameを参照している
+        ("SELECT * FROM df", {"df"}, False),
+        ("WITH t AS (SELECT 1) SELECT * FROM t", set(), True),
+    ],
+)
+def test_check_sql_database_query(sql, python_names, database_query):
+    problems, result = _check_sql(1, sql, CATALOG, python_names)
+    assert problems == []
+    assert result is database_query
+
+
+@pytest.mark.parametrize(
+    "code, known, undefined",
+    [
+        ("x = 1\nprint(x)", set(), []),
+        ("print(y)", set(), ["y"]),
+        ("print(y)", {"y"}, []),
+        ("df = pd.read_sql('SELECT 1', engine)", set(), ["pd"]),
+        ("import pandas as pd\ndf = pd.read_sql('SELECT 1', engine)", set(), []),
+        ("def f(a):\n    return a + b\n", set(), ["b"]),
+        ("for i in range(3):\n    total = i\nprint(total)", set(), []),
+        ("[v for v in range(3)]", set(), []),
+        ("try:\n    pass\nexcept Exception as e:\n    print(e)", set(), []),
+        ("print(a, b, a)", set(), ["a", "b"]),
+        # 動的に名前を定義するコードは判定しない
+        ("from os import *\nprint(getcwd())", set(), []),
+        ("exec('z = 1')\nprint(z)", set(), []),
+        ("match point:\n    case (px, py):\n        print(px, py)", {"point"}, []),
+    ],
+)
+def test_undefined_names(code, known, undefined):
+    problems = _undefined_names(ast.parse(code), known)
+    assert [kind for kind, _ in problems] == ["name"] * len(undefined)
+    for name, (_, message) in zip(undefined, problems):
+        assert f"`{name}`" in message
+
+
+def test_merged_names_from_the_sandbox_are_known(monkeypatch):
+    from src import analysis_manager
+    from src.code_service import code_service
+
+    async def get_names(access_id):
+        # サブ分析の取り込みで名前が衝突し、接頭辞を付けて取り込んだ変数
+        return {"res", "step2_res"}
+
+    monkeypatch.setattr(code_service, "get_names", get_names)
+    monkeypatch.setattr(
+        analysis_manager,
+        "space_history",
+        {"space": [[{"role": "user", "content": "q"}, {"role": "assistant", "content": "<python>res = 1</python>"}]]},
+    )
+    assert asyncio.run(analysis_manager._preflight_error("print(res, step2_res)", "space")) == ""
+
+
+def test_history_names_are_known_without_the_sandbox(monkeypatch):
+    from src import analysis_manager
+    from src.code_service import code_service
+
+    async def get_names(access_id):
+        return None
+
+    monkeypatch.setattr(code_service, "get_names", get_names)
+    monkeypatch.setattr(
+        analysis_manager,
+        "space_history",
+        {"space": [[{"role": "user", "content": "q"}, {"role": "assistant", "content": "<python>res = 1</python>"}]]},
+    )
+    assert asyncio.run(analysis_manager._preflight_error("print(res)", "space")) == ""
+    assert "`step2_res`" in asyncio.run(analysis_manager._preflight_error("print(step2_res)", "space"))
@@ -0,0 +1,89 @@
+import pytest
+
+from src.result_cache import ResultCache, normalize_query
+from src.utils import table_versions
+
+
+@pytest.fixture(autouse=True)
+def versions(monkeypatch):
+    monkeypatch.setattr(table_versions, "table_versions", {})
+
+
+def _key(cache, query="売上の合計", tables=("orders",), model="m", mode="analysis", history=()):
+    return cache.make_key(query, list(tables), model, mode, list(history))
+
+
+def test_queries_differing_in_whitespace_and_case_share_a_key():
+    cache = ResultCache()
+    assert normalize_query("  Total\n  Sales ") == "total sales"
+    assert _key(cache, "Total  Sales") == _key(cache, " total sales\n")
+
+
+def test_table_order_does_not_change_the_key():
+    cache = ResultCache()
+    assert _key(cache, tables=["orders", "customers"]) == _key(cache, tables=["customers", "orders", "orders"])
+
+
+@pytest.mark.parametrize(
+    "changes",
+    [
+        {"query": "売上の平均"},
+        {"tables": ["customers"]},
+        {"model": "other"},
+        {"mode": "deep"},
+        {"history": [[{"type": "markdown", "content": "前の分析"}]]},
+    ],
+)
+def test_inputs_that_change_the_answer_change_the_key(changes):
+    cache = ResultCache()
+    assert _key(cache, **changes) != _key(cache)
+
+
+def test_key_changes_when_a_dependent_table_changes():
+    cache = ResultCache()
+    before = _key(cache)
+    table_versions.bump_table_versions(["customers"])
+    assert _key(cache) == before
+    table_versions.bump_table_versions(["orders"])
+    assert _key(cache) != before
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResultCache(max_entries=2)
+    cache.put("a", ["orders"], "a = 1", "", [])
+    cache.put("b", ["orders"], "b = 1", "", [])
+    # 参照したエントリは最近使ったものとして扱う
+    assert cache.get("a")["python_code"] == "a = 1"
+    cache.put("c", ["orders"], "c = 1", "", [])
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_putting_an_existing_key_refreshes_it():
+    cache = ResultCache(max_entries=2)
+    cache.put("a", ["orders"], "a = 1", "", [])
+    cache.put("b", ["orders"], "b = 1", "", [])
+    cache.put("a", ["orders"], "a = 2", "", [])
+    cache.put("c", ["orders"], "c = 1", "", [])
+    assert cache.get("b") is None
+    assert cache.get("a")["python_code"] == "a = 2"
+
+
+def test_stored_content_is_not_shared_with_the_caller():
+    cache = ResultCache()
+    content = [{"type": "table", "source": {"id": "space"}}]
+    cache.put("a", ["orders"], "", "", content)
+    content[0]["source"]["id"] = "other"
+    assert cache.get("a")["content"][0]["source"]["id"] == "space"
+
+
+def test_only_entries_depending_on_changed_tables_are_invalidated():
+    cache = ResultCache()
+    cache.put("orders", ["orders"], "", "", [])
+    cache.put("both", ["orders", "customers"], "", "", [])
+    cache.put("customers", ["customers"], "", "", [])
+    cache.invalidate_tables(["orders"])
+    assert cache.get("orders") is None
+    assert cache.get("both") is None
+    assert cache.get("customers") is not None
@@ -0,0 +1,190 @@
+import asyncio
+
+import pytest
+
+from src.sandbox_router import SandboxRouter
+
+
+class _Replica:
+    """再構築で送られたコマンドを記録するサンドボックスのレプリカ"""
+
+    def __init__(self):
+        self.requests = []
+
+    async def post(self, url, json, timeout=None):
+        self.requests.append((url, url.rsplit("/", 1)[-1], json))
+        return _Response()
+
+
+class _Response:
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {"ok": "done"}
+
+
+def _replayed_code(replica, url="http://new/"):
+    return [(payload["id"], payload["code"]) for sent_url, command, payload in replica.requests if sent_url == url + "code"]
+
+
+def _rebuild(router, key):
+    replica = _Replica()
+    router._placements[key] = "http://old/"
+    asyncio.run(router._rebuild(key, "http://old/", "http://new/", replica))
+    return replica
+
+
+def test_rollback_after_failed_run_keeps_earlier_statements():
+    router = SandboxRouter(urls=["http://old/", "http://new/"])
+    router.record_attempt("space", True)
+    router.record_execution("space", "a = 1", True)
+    # 失敗した実行は記録されないが、サンドボックスはその直前の状態をロールバック用に保存している
+    router.record_attempt("space", True)
+    router.record_rollback("space")
+    assert _replayed_code(_rebuild(router, "space")) == [("space", "a = 1")]
+
+
+def test_fork_repair_after_failed_run_survives_merge():
+    router = SandboxRouter(urls=["http://old/", "http://new/"])
+    router.record_attempt("space", True)
+    router.record_execution("space", "a = 1", True)
+    router.record_fork("space", "space:step:1")
+    router.record_attempt("space:step:1", True)
+    router.record_execution("space:step:1", "b = a + 1", True)
+    # フォークでの実行が失敗し、ロールバックしてから修正したコードを実行する
+    router.record_attempt("space:step:1", True)
+    router.record_rollback("space:step:1")
+    router.record_attempt("space:step:1", True)
+    router.record_execution("space:step:1", "c = b * 2", True)
+    router.record_merge("space", "space:step:1")
+    router.record_drop("space:step:1")
+    assert _replayed_code(_rebuild(router, "space")) == [
+        ("space", "a = 1"),
+        ("space", "b = a + 1"),
+        ("space", "c = b * 2"),
+    ]
+
+
+def test_rollback_of_streamed_statements_returns_to_first_statement():
+    router = SandboxRouter(urls=["http://old/", "http://new/"])
+    router.record_attempt("space", True)
+    router.record_execution("space", "a = 1", True)
+    router.record_attempt("space", True)
+    router.record_execution("space", "b = 2", True)
+    # 文単位の実行はスナップショットを最初の文でのみ取る
+    router.record_attempt("space", False)
+    router.record_execution("space", "c = 3", False)
+    router.record_rollback("space")
+    assert _replayed_code(_rebuild(router, "space")) == [("space", "a = 1")]
+
+
+class _Client:
+    """/statusのキュー数を返し、それ以外の送信を記録するクライアント"""
+
+    def __init__(self, depths=None):
+        self.depths = depths or {}
+        self.requests = []
+
+    async def get(self, url, timeout=None):
+        base = url[: -len("status")]
+        if self.depths.get(base) is None:
+            raise ConnectionError(base)
+        return _Status(self.depths[base])
+
+    async def post(self, url, json, timeout=None):
+        self.requests.append((url, url.rsplit("/", 1)[-1], json))
+        return _Response()
+
+
+class _Status(_Response):
+    def __init__(self, que):
+        self.que = que
+
+    def json(self):
+        return {"que": self.que}
+
+
+URLS = ["http://a/", "http://b/", "http://c/"]
+
+
+def test_keys_keep_their_candidates_when_another_replica_leaves():
+    router = SandboxRouter(urls=URLS, placement_candidates=1)
+    keys = [f"space{i}" for i in range(200)]
+    before = {key: router._ring_candidates(key, 1)[0] for key in keys}
+    # 3台ならどのレプリカにも配置される
+    assert set(before.values()) == set(URLS)
+    router.draining.add("http://c/")
+    router._build_ring()
+    after = {key: router._ring_candidates(key, 1)[0] for key in keys}
+    # 切り離したレプリカのキーだけが移動する
+    assert all(after[key] == before[key] for key in keys if before[key] != "http://c/")
+    assert "http://c/" not in after.values()
+
+
+def test_forks_are_placed_with_their_space():
+    router = SandboxRouter(urls=URLS)
+    client = _Client({url: 0 for url in URLS})
+    url = asyncio.run(router.resolve("space", client))
+    assert asyncio.run(router.resolve("space:step:1", client)) == url
+    assert asyncio.run(router.resolve("space:repair:ab12", client)) == url
+
+
+def test_new_spaces_go_to_the_less_busy_candidate():
+    router = SandboxRouter(urls=URLS, placement_candidates=2)
+    first, second = router._ring_candidates("space", 2)
+    assert asyncio.run(router.resolve("space", _Client({first: 5, second: 1}))) == second
+    # 配置した後はキュー数が変わっても同じレプリカを使う
+    assert asyncio.run(router.resolve("space", _Client({first: 0, second: 9}))) == second
+
+
+def test_unreachable_candidates_are_skipped():
+    router = SandboxRouter(urls=URLS, placement_candidates=2)
+    first, second = router._ring_candidates("space", 2)
+    assert asyncio.run(router.resolve("space", _Client({second: 3}))) == second
+
+
+def test_drain_rebuilds_spaces_on_another_replica():
+    router = SandboxRouter(urls=URLS, placement_candidates=1)
+    client = _Client({url: 0 for url in URLS})
+    old = asyncio.run(router.resolve("space", client))
+    router.record_attempt("space", True)
+    router.record_execution("space", "a = 1", True)
+    router.record_fork("space", "space:step:1")
+    router.record_attempt("space:step:1", True)
+    router.record_execution("space:step:1", "b = a + 1", True)
+
+    assert asyncio.run(router.drain(old, client)) == ["space"]
+    new = asyncio.run(router.resolve("space", client))
+    assert new != old
+    assert _replayed_code(client, new) == [("space", "a = 1"), ("space:step:1", "b = a + 1")]
+    assert [json for url, command, json in client.requests if url == new + "fork"] == [
+        {"id": "space", "fork_id": "space:step:1"}
+    ]
+    # 元のレプリカの名前空間は破棄する
+    assert {json["id"] for url, command, json in client.requests if url == old + "drop"} == {"space", "space:step:1"}
+    # 切り離したレプリカには新しいspaceを配置しない
+    assert all(asyncio.run(router.resolve(f"new{i}", client)) != old for i in range(50))
+    assert next(replica for replica in router.replicas() if replica["url"] == old) == {
+        "url": old,
+        "draining": True,
+        "spaces": 0,
+    }
+
+
+def test_undrain_makes_a_replica_available_again():
+    router = SandboxRouter(urls=URLS, placement_candidates=1)
+    client = _Client({url: 0 for url in URLS})
+    asyncio.run(router.drain("http://a/", client))
+    router.undrain("http://a/")
+    assert any(asyncio.run(router.resolve(f"space{i}", client)) == "http://a/" for i in range(50))
+
+
+def test_last_replica_cannot_be_drained():
+    router = SandboxRouter(urls=["http://a/", "http://b/"])
+    client = _Client()
+    asyncio.run(router.drain("http://a/", client))
+    with pytest.raises(RuntimeError):
+        asyncio.run(router.drain("http://b/", client))
+    with pytest.raises(ValueError):
+        asyncio.run(router.drain("http://unknown/", client))
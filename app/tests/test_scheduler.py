@@ -0,0 +1,157 @@
+import asyncio
+
+import pytest
+
+from src.scheduler import AnalysisScheduler, QueueFullError
+
+
+class _Jobs:
+    """開始した順序を記録し、releaseされるまで終わらない分析ジョブ"""
+
+    def __init__(self):
+        self.started = []
+        self._events = {}
+
+    def job(self, name):
+        event = self._events[name] = asyncio.Event()
+
+        async def run():
+            self.started.append(name)
+            await event.wait()
+
+        return run
+
+    def release(self, name):
+        self._events[name].set()
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_jobs_beyond_the_model_limit_wait_for_a_slot():
+    async def scenario():
+        scheduler = AnalysisScheduler(max_per_model=2, max_sandbox=1, max_queued=10)
+        jobs = _Jobs()
+        tasks = [scheduler.submit("m", name, jobs.job(name)) for name in ("a", "b", "c")]
+        await _settle()
+        assert jobs.started == ["a", "b"]
+        assert scheduler.queued_count() == 1
+        jobs.release("a")
+        await _settle()
+        assert jobs.started == ["a", "b", "c"]
+        jobs.release("b")
+        jobs.release("c")
+        await asyncio.gather(*tasks)
+        assert scheduler.queued_count() == 0
+
+    asyncio.run(scenario())
+
+
+def test_models_have_separate_limits():
+    async def scenario():
+        scheduler = AnalysisScheduler(max_per_model=1, max_sandbox=1, max_queued=10)
+        jobs = _Jobs()
+        tasks = [scheduler.submit("m1", "a", jobs.job("a")), scheduler.submit("m2", "b", jobs.job("b"))]
+        await _settle()
+        assert jobs.started == ["a", "b"]
+        jobs.release("a")
+        jobs.release("b")
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_higher_priority_runs_first_and_equal_priority_is_fifo():
+    async def scenario():
+        scheduler = AnalysisScheduler(max_per_model=1, max_sandbox=1, max_queued=10)
+        jobs = _Jobs()
+        tasks = [scheduler.submit("m", "running", jobs.job("running"))]
+        tasks.append(scheduler.submit("m", "low1", jobs.job("low1")))
+        tasks.append(scheduler.submit("m", "low2", jobs.job("low2")))
+        tasks.append(scheduler.submit("m", "high", jobs.job("high"), priority=1))
+        for name in ("running", "high", "low1", "low2"):
+            await _settle()
+            assert jobs.started[-1] == name
+            jobs.release(name)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_queue_positions_are_reported():
+    async def scenario():
+        scheduler = AnalysisScheduler(max_per_model=1, max_sandbox=1, max_queued=10)
+        jobs = _Jobs()
+        positions = {"b": [], "c": []}
+        tasks = [scheduler.submit("m", "a", jobs.job("a"))]
+        tasks.append(scheduler.submit("m", "b", jobs.job("b"), on_position=positions["b"].append))
+        tasks.append(scheduler.submit("m", "c", jobs.job("c"), on_position=positions["c"].append))
+        assert positions["b"][-1] == 1
+        assert positions["c"][-1] == 2
+        jobs.release("a")
+        await _settle()
+        # bが実行を始めるとcが先頭になる
+        assert positions["c"][-1] == 1
+        jobs.release("b")
+        jobs.release("c")
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_rejects_new_jobs():
+    async def scenario():
+        scheduler = AnalysisScheduler(max_per_model=1, max_sandbox=1, max_queued=1)
+        jobs = _Jobs()
+        tasks = [scheduler.submit("m", "a", jobs.job("a")), scheduler.submit("m", "b", jobs.job("b"))]
+        assert scheduler.is_full()
+        with pytest.raises(QueueFullError):
+            scheduler.submit("m", "c", jobs.job("c"))
+        jobs.release("a")
+        jobs.release("b")
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_jobs_leave_the_queue_and_free_their_slot():
+    async def scenario():
+        scheduler = AnalysisScheduler(max_per_model=1, max_sandbox=1, max_queued=10)
+        jobs = _Jobs()
+        running = scheduler.submit("m", "a", jobs.job("a"))
+        waiting = scheduler.submit("m", "b", jobs.job("b"))
+        last = scheduler.submit("m", "c", jobs.job("c"))
+        await _settle()
+        waiting.cancel()
+        await _settle()
+        assert scheduler.queued_count() == 1
+        # 実行中のジョブをキャンセルした場合もスロットを返却する
+        running.cancel()
+        await _settle()
+        assert jobs.started == ["a", "c"]
+        jobs.release("c")
+        await last
+        assert scheduler._running["m"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_sandbox_slots_limit_concurrent_executions():
+    async def scenario():
+        scheduler = AnalysisScheduler(max_per_model=4, max_sandbox=2, max_queued=10)
+        active = []
+        peak = []
+
+        async def execute():
+            async with scheduler.sandbox_slot():
+                active.append(1)
+                peak.append(len(active))
+                await asyncio.sleep(0.01)
+                active.pop()
+
+        await asyncio.gather(*(execute() for _ in range(5)))
+        assert max(peak) == 2
+
+    asyncio.run(scenario())
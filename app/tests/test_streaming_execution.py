@@ -0,0 +1,121 @@
+import asyncio
+
+from src.streaming_execution import StatementStreamExecutor, split_complete_statements
+
+
+def test_incomplete_last_line_is_not_split():
+    assert split_complete_statements("x = 1\ny = 2") == 0
+    # 最後の完結した行は次の行で続く可能性があるため、その前までを区切る
+    assert split_complete_statements("x = 1\ny = 2\nz") == len("x = 1\n")
+
+
+def test_multiline_string_is_not_split():
+    head = 'x = """\nfoo\n\nbar = 1\n'
+    # 文字列の中の「トップレベル文に見える行」で区切らない
+    assert split_complete_statements(head) == 0
+    assert split_complete_statements(head + '"""\n') == 0
+    assert split_complete_statements(head + '"""\ny = 2\n') == len(head + '"""\n')
+
+
+def test_decorator_stays_with_its_definition():
+    assert split_complete_statements("@decorator\n") == 0
+    assert split_complete_statements("@decorator\ndef f():\n") == 0
+    code = "a = 1\n@decorator\ndef f():\n    return 1\n"
+    assert split_complete_statements(code) == 0
+    assert split_complete_statements(code + "b = f()\n") == len(code)
+
+
+def test_if_else_split_across_chunks():
+    chunks = ["if x:\n", "    y = 1\n", "else:\n", "    y = 2\n", "z = 3\n"]
+    received = ""
+    boundaries = []
+    for chunk in chunks:
+        received += chunk
+        boundaries.append(split_complete_statements(received))
+    # elseが届いてもifの本体で区切らず、次のトップレベル文が届いてからif/else全体を区切る
+    assert boundaries == [0, 0, 0, 0, len("".join(chunks[:4]))]
+
+
+def test_try_except_and_comments_are_continuations():
+    code = "try:\n    a = 1\n# comment\nexcept Exception:\n    a = 2\nfinally:\n    b = 1\n"
+    assert split_complete_statements(code) == 0
+    assert split_complete_statements(code + "c = 3\n") == len(code)
+
+
+class _Sandbox:
+    def __init__(self, block_on=None):
+        self.executed = []
+        self.calls = []
+        self.block_on = block_on
+
+    async def execute(self, code, snapshot):
+        self.calls.append(("execute", code, snapshot))
+        if self.block_on is not None and self.block_on in code:
+            await asyncio.sleep(3600)
+        self.executed.append(code)
+        return {"result": {"ok": "code executed successfully"}}
+
+    async def rollback(self):
+        self.calls.append(("rollback",))
+        return {"result": {}}
+
+    async def interrupt(self):
+        self.calls.append(("interrupt",))
+        return {"result": {}}
+
+
+def _run_stream(sandbox, chunks, finish=True):
+    async def run():
+        executor = StatementStreamExecutor(sandbox.execute, sandbox.rollback, interrupt=sandbox.interrupt)
+        received = ""
+        for chunk in chunks:
+            received += chunk
+            executor.feed(received)
+            await asyncio.sleep(0)
+        if finish:
+            return await executor.finish(received)
+        await asyncio.sleep(0)
+        await executor.abort()
+
+    return asyncio.run(run())
+
+
+def test_executor_runs_if_else_as_one_statement():
+    sandbox = _Sandbox()
+    result = _run_stream(sandbox, ["if x:\n", "    y = 1\n", "else:\n", "    y = 2\n", "z = 3\n"])
+    assert "code_error" not in result
+    assert sandbox.executed == ["if x:\n    y = 1\nelse:\n    y = 2\n", "z = 3\n"]
+    # スナップショットは最初の実行でのみ取る
+    assert [call[2] for call in sandbox.calls] == [True, False]
+
+
+def test_abort_rolls_back_executed_statements():
+    sandbox = _Sandbox()
+    _run_stream(sandbox, ["a = 1\n", "b = 2\n", "c ="], finish=False)
+    assert sandbox.executed == ["a = 1\n"]
+    assert sandbox.calls[-1] == ("rollback",)
+
+
+def test_abort_interrupts_running_statement_before_rollback():
+    sandbox = _Sandbox(block_on="slow")
+    _run_stream(sandbox, ["slow()\n", "b = 2\n"], finish=False)
+    assert sandbox.calls[-2:] == [("interrupt",), ("rollback",)]
+
+
+def test_abort_without_executed_statements_does_nothing():
+    sandbox = _Sandbox()
+    _run_stream(sandbox, ["a = (\n", "    1,\n"], finish=False)
+    assert sandbox.calls == []
+
+
+def test_abort_after_finish_keeps_the_result():
+    sandbox = _Sandbox()
+
+    async def run():
+        executor = StatementStreamExecutor(sandbox.execute, sandbox.rollback, interrupt=sandbox.interrupt)
+        executor.feed("a = 1\nb = 2\n")
+        await executor.finish("a = 1\nb = 2\n")
+        await executor.abort()
+
+    asyncio.run(run())
+    assert ("rollback",) not in sandbox.calls
@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+from src import analysis_manager
+from src.analysis_manager import _restore_cached_result, get_table_page
+from src.code_service import code_service
+from src.deadline import DeadlineBudget
+from src.models.requests import StartAnalysisRequest
+
+
+@pytest.fixture
+def sandbox(monkeypatch):
+    calls = []
+
+    async def get_variable(request):
+        calls.append((request.id, request.name, request.offset, request.limit))
+        return {"result": [{"type": "table", "columns": ["a"], "data": [[1]], "total_rows": 5000, "offset": request.offset}]}
+
+    async def get_names(access_id):
+        return {"df"}
+
+    monkeypatch.setattr(code_service, "get_variable", get_variable)
+    monkeypatch.setattr(code_service, "get_names", get_names)
+    monkeypatch.setattr(analysis_manager, "analysis_states", {})
+    monkeypatch.setattr(analysis_manager, "space_history", {"space": []})
+    return calls
+
+
+def _table(source=None):
+    block = {"type": "table", "table": "[]", "total_rows": 5000}
+    if source is not None:
+        block["source"] = source
+    return block
+
+
+def test_page_is_read_from_the_stored_source(sandbox):
+    analysis_manager.analysis_states["a1"] = {"content": [{"type": "markdown"}, _table({"id": "space", "name": "df", "item": 0})]}
+    page = asyncio.run(get_table_page("a1", 1, offset=1000, limit=10 ** 9))
+    assert page["offset"] == 1000
+    # 取得先はクライアントの指定ではなく記録したsourceを使い、行数は上限で切り詰める
+    assert sandbox == [("space", "df", 1000, analysis_manager.TABLE_PAGE_MAX_ROWS)]
+
+
+@pytest.mark.parametrize("block", [0, 2, -1])
+def test_blocks_without_a_paged_table_are_rejected(sandbox, block):
+    analysis_manager.analysis_states["a1"] = {"content": [{"type": "markdown"}, _table()]}
+    with pytest.raises(ValueError):
+        asyncio.run(get_table_page("a1", block))
+    assert sandbox == []
+
+
+def test_expression_sources_are_not_evaluated(sandbox):
+    analysis_manager.analysis_states["a1"] = {
+        "content": [_table({"id": "space", "name": "__import__('os').system('id')", "item": 0})]
+    }
+    with pytest.raises(ValueError):
+        asyncio.run(get_table_page("a1", 0))
+    assert sandbox == []
+
+
+def test_cached_result_points_tables_at_the_current_space(sandbox):
+    cached = {
+        "python_code": "",
+        "full_response": "",
+        "content": [_table({"id": "old", "name": "df", "item": 0}), _table({"id": "old", "name": "gone", "item": 0})],
+    }
+    analysis_manager.analysis_states["a2"] = {"metrics": {}}
+    request = StartAnalysisRequest(space_id="space", query="q")
+    assert asyncio.run(_restore_cached_result("space", "a2", request, cached, DeadlineBudget()))
+    content = analysis_manager.analysis_states["a2"]["content"]
+    assert content[0]["source"]["id"] == "space"
+    # 現在のスペースにない変数の表は続きのページを取得しない
+    assert "source" not in content[1]
+    # キャッシュの項目は書き換えない
+    assert cached["content"][0]["source"]["id"] == "old"
+    assert "source" in cached["content"][1]
@@ -0,0 +1,68 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from src import table_snapshots
+from src.database import engine
+
+
+@pytest.fixture
+def snapshot_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(table_snapshots, "TABLE_SNAPSHOT_DIR", str(tmp_path))
+    monkeypatch.setattr(table_snapshots, "TABLE_SNAPSHOT_CHUNK_ROWS", 3)
+    frame = pd.DataFrame({"id": range(10), "amount": [1.5, None] * 5, "name": list("abcdefghij")})
+    frame.to_sql("orders", engine, index=False, if_exists="replace")
+    return frame
+
+
+def _read(table_name):
+    with pa.memory_map(table_snapshots.snapshot_path(table_name)) as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+def test_export_streams_the_table_in_chunks(snapshot_dir, monkeypatch):
+    chunk_sizes = []
+    read_sql_table = pd.read_sql_table
+
+    def counting_read_sql_table(*args, **kwargs):
+        chunks = read_sql_table(*args, **kwargs)
+        for chunk in chunks:
+            chunk_sizes.append(len(chunk))
+            yield chunk
+
+    monkeypatch.setattr(table_snapshots.pd, "read_sql_table", counting_read_sql_table)
+    assert table_snapshots.export_table("orders")
+    # テーブル全体を一度に読み込まない
+    assert chunk_sizes == [3, 3, 3, 1]
+    pd.testing.assert_frame_equal(_read("orders"), snapshot_dir)
+
+
+def test_export_records_table_changes(snapshot_dir, monkeypatch):
+    monkeypatch.setattr(table_snapshots, "table_changes", lambda table_name: "16384:10")
+    assert table_snapshots.export_table("orders")
+    assert table_snapshots._recorded_changes(table_snapshots.snapshot_path("orders")) == "16384:10"
+
+
+def test_refresher_reexports_changed_and_expiring_tables(snapshot_dir, monkeypatch):
+    monkeypatch.setattr(table_snapshots, "table_changes", lambda table_name: "16384:10")
+    assert table_snapshots.export_table("orders")
+    exported = []
+    monkeypatch.setattr(table_snapshots, "_export_existing", exported.extend)
+
+    table_snapshots._refresh_changed(lambda: ["orders", "missing"])
+    assert exported == []
+
+    # アプリを経由せずに変更された
+    monkeypatch.setattr(table_snapshots, "table_changes", lambda table_name: "16384:11")
+    table_snapshots._refresh_changed(lambda: ["orders"])
+    assert exported == ["orders"]
+
+    # 有効期限が近い
+    monkeypatch.setattr(table_snapshots, "table_changes", lambda table_name: "16384:10")
+    path = table_snapshots.snapshot_path("orders")
+    expired = os.path.getmtime(path) - table_snapshots.TABLE_SNAPSHOT_TTL
+    os.utime(path, (expired, expired))
+    table_snapshots._refresh_changed(lambda: ["orders"])
+    assert exported == ["orders", "orders"]
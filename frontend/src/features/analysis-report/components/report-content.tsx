@@ -2,6 +2,8 @@ import { Download, ChevronDown, Printer, RotateCcwIcon,Code } from 'lucide-react
 import {
   type ReportContent as ReportContentType,
   type ActionStep,
+  type TablePage,
+  fetchRemainingTableRows,
 } from '@/hooks/use-analysis'
 import { Badge } from '@/components/ui/badge'
 import { Button } from '@/components/ui/button'
@@ -21,11 +23,13 @@ import {
   TooltipProvider,
   TooltipTrigger,
 } from '@/components/ui/tooltip'
-import { useRef } from 'react'
+import { useRef, useState } from 'react'
+import { toast } from 'sonner'
 import { useReactToPrint } from 'react-to-print'
 // import { A } from 'node_modules/@faker-js/faker/dist/airline-CLphikKp';
 
 interface ReportContentProps {
+  analysisId: string
   content: ReportContentType[]
   pythonCode?: string
   steps?: ActionStep[]
@@ -39,6 +43,7 @@ interface ReportContentProps {
 
 
 export function ReportContent({
+  analysisId,
   content,
   pythonCode,
   steps,
@@ -139,6 +144,7 @@ export function ReportContent({
           <ContentBlock
             key={index}
             block={block}
+            page={{ analysisId, block: index }}
             onShowSidePanel={onShowSidePanel}
           />
         ))}
@@ -182,6 +188,7 @@ export function ReportContent({
 
 interface ContentBlockProps {
   block: ReportContentType
+  page: TablePage
   onShowSidePanel: (content: {
     type: 'code' | 'table' | 'step'
     content: string
@@ -234,7 +241,7 @@ function StepItem({ step, stepNumber, onShowSidePanel }: StepItemProps) {
   )
 }
 
-function ContentBlock({ block, onShowSidePanel }: ContentBlockProps) {
+function ContentBlock({ block, page, onShowSidePanel }: ContentBlockProps) {
   switch (block.type) {
     case 'markdown':
       return <MarkdownBlock content={block.content} />
@@ -243,11 +250,18 @@ function ContentBlock({ block, onShowSidePanel }: ContentBlockProps) {
       return <VariableBlock data={block.data} />
 
     case 'image':
-      return <ImageBlock base64={block.base64} />
+      return (
+        <ImageBlock base64={block.base64} mimeType={block.mime_type} downsampled={block.downsampled} />
+      )
 
     case 'table':
       return (
-        <TableBlock table={block.table} onShowSidePanel={onShowSidePanel} />
+        <TableBlock
+          table={block.table}
+          totalRows={block.total_rows}
+          page={block.source ? page : undefined}
+          onShowSidePanel={onShowSidePanel}
+        />
       )
 
     default:
@@ -275,11 +289,19 @@ function VariableBlock({ data }: { data: string }) {
   )
 }
 
-function ImageBlock({ base64 }: { base64: string }) {
+function ImageBlock({
+  base64,
+  mimeType = 'image/png',
+  downsampled,
+}: {
+  base64: string
+  mimeType?: string
+  downsampled?: { kind: string; points: number; rendered_points: number }[]
+}) {
   const downloadImage = () => {
     const link = document.createElement('a')
-    link.href = `data:image/png;base64,${base64}`
-    link.download = `chart_${Date.now()}.png`
+    link.href = `data:${mimeType};base64,${base64}`
+    link.download = `chart_${Date.now()}.${mimeType.split('/')[1].split('+')[0]}`
     link.click()
   }
 
@@ -287,12 +309,21 @@ function ImageBlock({ base64 }: { base64: string }) {
     <div>
       <ImageZoom>
         <img
-          src={`data:image/png;base64,${base64}`}
+          src={`data:${mimeType};base64,${base64}`}
           alt='Analysis Chart'
           className='h-auto w-full rounded border'
         />
       </ImageZoom>
-      <div className='mt-2 flex justify-end'>
+      <div className='mt-2 flex items-center justify-end gap-2'>
+        {downsampled && downsampled.length > 0 && (
+          // Large series were decimated to the image resolution when rendering
+          <span className='text-muted-foreground mr-auto text-xs'>
+            Downsampled for display:{' '}
+            {downsampled
+              .map((series) => `${series.points.toLocaleString()} → ${series.rendered_points.toLocaleString()} points`)
+              .join(', ')}
+          </span>
+        )}
         <Button
           variant='outline'
           size='sm'
@@ -309,9 +340,13 @@ function ImageBlock({ base64 }: { base64: string }) {
 
 function TableBlock({
   table,
+  totalRows,
+  page,
   onShowSidePanel,
 }: {
   table: string
+  totalRows?: number
+  page?: TablePage
   onShowSidePanel: (content: {
     type: 'code' | 'table' | 'step'
     content: string
@@ -326,6 +361,8 @@ function TableBlock({
   const data = JSON.parse(table) as any[]
   const columns = data.length > 0 ? Object.keys(data[0]) : []
   const maxRows = 4
+  // Large tables only embed their first page, so prefer the total row count from the API
+  const rowCount = totalRows ?? data.length
   const previewData = data.slice(0, maxRows + 1)
 
   // Convert JSON to CSV
@@ -355,13 +392,48 @@ function TableBlock({
     ]
     return csvRows.join('\n')
   }
+
+  const [loadingRows, setLoadingRows] = useState(false)
+  // Rows loaded the first time the table was opened, reused when it is opened again
+  const loadedRows = useRef<any[] | null>(null)
+
+  // Only the first page is embedded, so fetch further rows (up to TABLE_ROW_LIMIT) when the table is opened
+  const showTable = async () => {
+    if (!page || rowCount <= data.length) {
+      onShowSidePanel({ type: 'table', content: convertToCSV(data) })
+      return
+    }
+    if (loadedRows.current) {
+      onShowSidePanel({ type: 'table', content: convertToCSV(loadedRows.current) })
+      return
+    }
+    if (loadingRows) return
+    setLoadingRows(true)
+    try {
+      const rows = await fetchRemainingTableRows(page, data, rowCount)
+      loadedRows.current = rows
+      if (rows.length < rowCount) {
+        toast.info(
+          `Showing the first ${rows.length.toLocaleString()} of ${rowCount.toLocaleString()} rows.`
+        )
+      }
+      onShowSidePanel({ type: 'table', content: convertToCSV(rows) })
+    } catch (error) {
+      console.error('Failed to fetch table rows:', error)
+      toast.error(
+        `Could not load all ${rowCount.toLocaleString()} rows. Showing only the first ${data.length.toLocaleString()} rows.`
+      )
+      onShowSidePanel({ type: 'table', content: convertToCSV(data) })
+    } finally {
+      setLoadingRows(false)
+    }
+  }
+
   return (
     <div>
       <div
-        className='relative transition hover:shadow'
-        onClick={() =>
-          onShowSidePanel({ type: 'table', content: convertToCSV(data) })
-        }
+        className={`relative transition hover:shadow ${loadingRows ? 'cursor-wait opacity-70' : ''}`}
+        onClick={showTable}
       >
         <div className='mb-5 max-h-96 overflow-auto rounded-xl border print:shadow-none transition-all hover:shadow-md'>
           {/* <p>{data.length} rows of data</p> */}
@@ -387,10 +459,10 @@ function TableBlock({
               ))}
             </TableBody>
           </Table>
-          {data.length > maxRows && (
+          {rowCount > maxRows && (
             <div className="print:hidden pointer-events-none absolute inset-x-0 bottom-0 h-16 rounded-b-xl bg-gradient-to-t from-background via-background/80 to-transparent">
               <div className="text-muted-foreground absolute bottom-2 mt-2 w-full text-center text-sm">
-                ... showing {data.length - maxRows} more rows
+                ... showing {rowCount - maxRows} more rows
               </div>
             </div>
           )}
@@ -236,6 +236,7 @@ function AnalysisReportItem({
         transition={{ duration: 0.4, delay: 0.1 }}
       >
         <ReportContent 
+          analysisId={analysisId}
           content={report.content}
           pythonCode={report.python_code}
           steps={report.steps}
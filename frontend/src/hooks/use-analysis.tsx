@@ -12,6 +12,8 @@ export interface StartAnalysisParams {
   mode?: string
   model?: string
   index?: number
+  // mode が 'approximate' の場合、正確な結果をバックグラウンドで計算して置き換える
+  exact_followup?: boolean
 }
 
 // 分析開始のレスポンス
@@ -40,6 +42,10 @@ export interface ReportResponse {
   content: ReportContent[]
   steps: ActionStep[]
   followups?: FollowupContent[]
+  // 近似モードで標本化したテーブルとサンプリング率
+  sampling?: { table: string; percent: number }[] | null
+  // 正確な結果をバックグラウンドで計算中かどうか
+  exact_pending?: boolean
 }
 
 export interface FollowupContent {
@@ -74,8 +80,60 @@ export interface ModelListResponse {
 export type ReportContent =
   | { type: 'markdown'; content: string }
   | { type: 'variable'; data: string }
-  | { type: 'image'; base64: string }
-  | { type: 'table'; table: string }
+  | {
+      type: 'image'
+      base64: string
+      mime_type?: string
+      downsampled?: { kind: string; points: number; rendered_points: number }[]
+    }
+  | {
+      type: 'table'
+      table: string
+      total_rows?: number
+      source?: { id: string; name: string; item: number }
+    }
+
+// レポートの表の続きのページの取得先(分析IDとレポート内のブロックの位置)
+export interface TablePage {
+  analysisId: string
+  block: number
+}
+
+// レポートの表のページ取得のレスポンス
+export interface TablePageResponse {
+  table: string
+  total_rows: number
+  offset: number
+  error: string
+}
+
+// 1回のリクエストで取得する行数と、レポートの表を開いたときに読み込む最大行数
+export const TABLE_PAGE_ROWS = 10000
+export const TABLE_ROW_LIMIT = 100000
+
+// レポートに最初のページだけが埋め込まれた表の続きを取得し、TABLE_ROW_LIMIT行までを返す
+export const fetchRemainingTableRows = async (
+  page: TablePage,
+  firstPage: any[],
+  totalRows: number
+): Promise<any[]> => {
+  const rows = [...firstPage]
+  const target = Math.min(totalRows, TABLE_ROW_LIMIT)
+  while (rows.length < target) {
+    const response = await axios.post<TablePageResponse>(`${API_BASE_URL}/get-table-page`, {
+      analysis_id: page.analysisId,
+      block: page.block,
+      offset: rows.length,
+      limit: Math.min(TABLE_PAGE_ROWS, target - rows.length),
+    })
+    if (response.data.error) throw new Error(response.data.error)
+    const rowsOfPage = JSON.parse(response.data.table) as any[]
+    // 変数が変わって行が減った場合などに無限ループしないようにする
+    if (rowsOfPage.length === 0) break
+    rows.push(...rowsOfPage)
+  }
+  return rows
+}
 
 // モデルリスト取得API (base_url, api_key をクエリパラメータで渡す)
 const getModelList = async (params: { base_url?: string; api_key?: string }): Promise<ModelListResponse> => {
@@ -108,6 +166,7 @@ const startAnalysis = async (params: StartAnalysisParams): Promise<StartAnalysis
       mode: params.mode || 'standard',
       model: params.model || '',
       index: params.index,
+      exact_followup: params.exact_followup || false,
   })
   return response.data
 }
@@ -176,7 +235,9 @@ export const useReport = (id: string, enabled: boolean = true) => {
     enabled: enabled && !!id,
     refetchInterval: (query) => {
       // doneがfalseの場合は1000ミリ秒後に再取得
-      return query.state.data?.done === false ? 1000 : false
+      if (query.state.data?.done === false) return 1000
+      // 近似の結果を表示中に正確な結果を計算している場合は間隔を空けて再取得
+      return query.state.data?.exact_pending ? 3000 : false
     },
     refetchIntervalInBackground: true,
   })
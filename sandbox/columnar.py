@@ -0,0 +1,79 @@
+import os
+import sys
+import pandas as pd
+import pyarrow as pa
+from sql_cache import read_table, referenced_tables
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# 名前空間に埋め込みの列指向SQLエンジン(DuckDB)を`duck`として置くかどうか
+SANDBOX_DUCKDB = os.getenv("SANDBOX_DUCKDB", "false").lower() == "true"
+# DuckDBのクエリ実行スレッド数とメモリの上限
+SANDBOX_DUCKDB_THREADS = int(os.getenv("SANDBOX_DUCKDB_THREADS", str(os.cpu_count() or 1)))
+SANDBOX_DUCKDB_MEMORY_LIMIT = os.getenv("SANDBOX_DUCKDB_MEMORY_LIMIT", "2GB")
+
+# カーネルごとのインスタンス(install時に作成)
+_instance = None
+
+
+class ColumnarEngine:
+    """
+    DuckDBで取り込み済みのテーブルと名前空間のDataFrameにSQLを実行する
+    テーブルはスナップショット(なければPostgreSQL)から、DataFrameは呼び出し元の変数から読み込む
+    """
+
+    def __init__(self):
+        self._database = duckdb.connect(
+            ":memory:",
+            config={"threads": SANDBOX_DUCKDB_THREADS, "memory_limit": SANDBOX_DUCKDB_MEMORY_LIMIT},
+        )
+
+    def sql(self, query, params=None):
+        """SQLを実行して結果をDataFrameで返す"""
+        caller = sys._getframe(1)
+        variables = {**caller.f_globals, **caller.f_locals}
+        lowered = {name.lower(): value for name, value in variables.items()}
+        # 接続はスレッド間で共有できないため、呼び出しごとにカーソルを作成する
+        cursor = self._database.cursor()
+        try:
+            for table_name in referenced_tables(query):
+                value = variables.get(table_name, lowered.get(table_name.lower()))
+                if not isinstance(value, (pd.DataFrame, pa.Table)):
+                    try:
+                        value = read_table(table_name)
+                    except Exception:
+                        # CTEの名前などテーブルでないものはDuckDBに解決させる
+                        continue
+                cursor.register(table_name, value)
+            return cursor.execute(query, params).df()
+        finally:
+            cursor.close()
+
+    # 名前空間のスナップショット・フォーク・退避ではカーネルのインスタンスを共有する
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (get_engine, ())
+
+
+def get_engine():
+    return _instance
+
+
+def install():
+    """DuckDBが有効な場合、カーネルのインスタンスを作成する"""
+    global _instance
+    if not SANDBOX_DUCKDB:
+        return None
+    if duckdb is None:
+        print("SANDBOX_DUCKDB is enabled but duckdb is not installed")
+        return None
+    _instance = ColumnarEngine()
+    return _instance
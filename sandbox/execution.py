@@ -0,0 +1,189 @@
+import re
+import time
+import threading
+import traceback
+import metrics
+import sampling
+import kernel_state as state
+from kernel_state import (
+    STRAGE, STRAGE_ROLLBACK, FORKS, PREPARED, NOT_EXECUTED, RUNNING_THREADS, RUNNING_THREADS_LOCK, KERNEL_EXEC_LOCK,
+    EXEC_GENERATION, RESOURCE_SAMPLE_INTERVAL, ExecutionInterrupted, new_namespace, exec_lock, set_running, set_async_exc,
+    interrupt_execution, observe,
+)
+from snapshots import snapshot_namespace, forget_snapshot, latest_snapshot, take_version
+
+# 上限を超えた実行の停止は親プロセスのkernel_managerがカーネルごと行い、ここでは使用量の計測だけを行う
+
+
+def execute_code(payload):
+    access_id = payload["id"]
+    was_fork = access_id in FORKS
+    # 同じIDへの実行と、同じカーネルのスペースとフォークの実行は順番に処理する
+    wait_started_at = time.perf_counter()
+    with exec_lock(access_id), KERNEL_EXEC_LOCK:
+        observe("EXEC_WAIT_SECONDS", time.perf_counter() - wait_started_at)
+        # 待っている間にフォークが破棄された場合は実行しない
+        if was_fork and access_id not in FORKS:
+            return {"error": "Fork was dropped before execution", "id": access_id}
+        return _run_code(payload)
+
+
+def _run_code(payload):
+    access_id = payload["id"]
+    if access_id in STRAGE and STRAGE[access_id] is not None:
+        localvars = STRAGE[access_id]
+    else:
+        localvars = new_namespace()
+
+    # 履歴のindexが指定されている場合はその開始時点の名前空間を保存
+    if payload.get("version") is not None:
+        take_version(access_id, payload["version"])
+
+    # ロールバック用の変数を保存(変更されたオブジェクトだけをコピーする)
+    if payload.get("snapshot", True) or access_id not in STRAGE_ROLLBACK:
+        previous = STRAGE_ROLLBACK.get(access_id)
+        STRAGE_ROLLBACK[access_id] = snapshot_namespace(localvars, latest_snapshot(access_id))
+        forget_snapshot(previous)
+
+    #コードの前処理
+    code = payload["code"]
+    #バックスラッシュを戻す
+    code = code.replace("%@", "\\")
+    #engine = で始まる行を削除
+    code = re.sub(r'^engine\s*=.*\n?', '', code, flags=re.MULTILINE)
+
+    set_running(access_id, True)
+    is_fork = access_id in FORKS
+    # 名前空間の最初の実行かどうか(事前作成の効果の計測用)
+    first_execution = access_id not in STRAGE or access_id in NOT_EXECUTED
+    NOT_EXECUTED.discard(access_id)
+    state.exec_generation = next(EXEC_GENERATION) + 1
+
+    #コードの実行
+    thread_id = threading.get_ident()
+    with RUNNING_THREADS_LOCK:
+        RUNNING_THREADS[access_id] = thread_id
+    state.local.db_rows = 0
+    # 近似モードでは行数の予算に合わせて大きなテーブルを標本化する
+    sampling.begin(payload.get("sample_rows"))
+    monitor = _ExecutionMonitor(thread_id)
+    exec_started_at = time.perf_counter()
+    try:
+        try:
+            with monitor:
+                exec(code, localvars)
+        finally:
+            with RUNNING_THREADS_LOCK:
+                RUNNING_THREADS.pop(access_id, None)
+                # 実行完了直後に届いた中断要求を取り消す
+                set_async_exc(thread_id, None)
+            samples = sampling.end()
+    except ExecutionInterrupted:
+        usage = _record_usage(monitor, exec_started_at, "interrupted")
+        set_running(access_id, False)
+        return {"error": "Execution interrupted", "id": access_id, "usage": usage}
+    except Exception as e:
+        usage = _record_usage(monitor, exec_started_at, "error")
+        set_running(access_id, False)
+        return {"error": str(e), "trace": traceback.format_exc(), "id": access_id, "usage": usage}
+    usage = _record_usage(monitor, exec_started_at, "ok")
+    if first_execution:
+        prepared = "true" if access_id in PREPARED else "false"
+        observe("FIRST_EXEC_SECONDS", usage["wall_seconds"], prepared=prepared)
+
+    # 実行中にフォークが破棄された場合は保存しない
+    if is_fork and access_id not in FORKS:
+        set_running(access_id, None)
+        return {"error": "Fork was dropped during execution", "id": access_id, "usage": usage}
+
+    #変数の保存
+    STRAGE[access_id] = localvars
+    set_running(access_id, False)
+    result = {"ok": "code executed successfully", "usage": usage}
+    if samples:
+        result["sampling"] = samples
+    return result
+
+
+def _record_usage(monitor, exec_started_at, outcome):
+    """実行ごとの資源使用量を計測値として記録し、結果に含める形で返す"""
+    usage = monitor.usage(time.perf_counter() - exec_started_at)
+    observe("EXEC_SECONDS", usage["wall_seconds"], outcome=outcome)
+    observe("EXEC_CPU_SECONDS", usage["cpu_seconds"], outcome=outcome)
+    observe("EXEC_PEAK_RSS_DELTA_BYTES", max(0, usage["peak_rss_delta_bytes"]))
+    observe("EXEC_DB_ROWS", usage["db_rows"])
+    return usage
+
+
+class _ExecutionMonitor:
+    """実行中のスレッドのCPU時間とカーネルのメモリ使用量を計測する"""
+
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.clock = time.pthread_getcpuclockid(thread_id)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.started_cpu = time.clock_gettime(self.clock)
+        self.started_rss = self.peak_rss = metrics.current_rss_bytes()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        return False
+
+    def cpu_seconds(self):
+        return time.clock_gettime(self.clock) - self.started_cpu
+
+    def _sample(self):
+        self.peak_rss = max(self.peak_rss, metrics.current_rss_bytes())
+
+    def _run(self):
+        while not self._stop.wait(RESOURCE_SAMPLE_INTERVAL):
+            self._sample()
+
+    def usage(self, wall_seconds):
+        return {
+            "wall_seconds": wall_seconds,
+            "cpu_seconds": self.cpu_seconds(),
+            "peak_rss_delta_bytes": self.peak_rss - self.started_rss,
+            "db_rows": getattr(state.local, "db_rows", 0),
+        }
+
+
+def count_db_rows(conn, cursor, statement, parameters, context, executemany):
+    # 実行中のコードが取得した行数を数える(SELECT以外のrowcountは変更行数のため除く)
+    if cursor.rowcount > 0 and cursor.description is not None:
+        state.local.db_rows = getattr(state.local, "db_rows", 0) + cursor.rowcount
+
+
+def prepare(payload):
+    """最初のクエリの前に名前空間を作成し、データベースへの接続を確立しておく"""
+    access_id = payload["id"]
+    started_at = time.perf_counter()
+    with exec_lock(access_id):
+        if access_id in STRAGE:
+            return {"ok": "namespace already exists"}
+        STRAGE[access_id] = new_namespace()
+        PREPARED.add(access_id)
+        NOT_EXECUTED.add(access_id)
+        set_running(access_id, False)
+    if state.engine is not None:
+        try:
+            # 接続はengineのプールに残り、最初のpd.read_sql_queryで再利用される
+            with state.engine.connect():
+                pass
+        except Exception as e:
+            print(f"Failed to open database connection for {access_id}: {e}")
+    observe("PREPARE_SECONDS", time.perf_counter() - started_at)
+    return {"ok": "namespace prepared"}
+
+
+def interrupt(payload):
+    if interrupt_execution(payload["id"]):
+        return {"ok": "execution interrupted"}
+    return {"ok": "no running execution"}
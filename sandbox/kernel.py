@@ -0,0 +1,159 @@
+import os
+import sys
+import types
+import resource
+import threading
+import traceback
+import pandas as pd
+import numpy as np
+from sqlalchemy import create_engine, event
+import sql_cache
+import columnar
+import scan_guard
+import sampling
+import kernel_state as state
+from kernel_state import (
+    STRAGE, STRAGE_ROLLBACK, STRAGE_VERSIONS, IS_RUNNING, EXEC_LOCKS, EXEC_LOCKS_GUARD, FORKS, FORK_BASES, PREPARED,
+    NOT_EXECUTED, space_key, set_running, interrupt_execution, observe,
+)
+import execution
+import snapshots
+import serialization
+import persistence
+
+# カーネル(スペースごとのワーカープロセス)のエントリーポイントとコマンドの振り分け
+# 状態はkernel_state、実行はexecution、スナップショットとフォークはsnapshots、
+# /varの変換はserialization、退避と復元はpersistence、親プロセス側の管理はkernel_managerにある
+
+# カーネルのアドレス空間の上限(MB)。超える確保はMemoryErrorになる(0は無制限)
+SANDBOX_KERNEL_ADDRESS_SPACE_MB = int(os.getenv("SANDBOX_KERNEL_ADDRESS_SPACE_MB", "0"))
+# pandasのCopy-on-Writeを有効にし、DataFrameのスナップショットを変更されるまでコピーしない
+SANDBOX_PANDAS_COPY_ON_WRITE = os.getenv("SANDBOX_PANDAS_COPY_ON_WRITE", "true").lower() == "true"
+
+
+def _drop(payload):
+    access_id = payload["id"]
+    interrupt_execution(access_id)
+    discarded = [STRAGE.pop(access_id, None), STRAGE_ROLLBACK.pop(access_id, None)]
+    snapshots.forget_snapshot(discarded[1])
+    for snapshot in STRAGE_VERSIONS.pop(access_id, {}).values():
+        snapshots.forget_snapshot(snapshot)
+        discarded.append(snapshot)
+    FORKS.pop(access_id, None)
+    FORK_BASES.pop(access_id, None)
+    PREPARED.discard(access_id)
+    NOT_EXECUTED.discard(access_id)
+    with EXEC_LOCKS_GUARD:
+        EXEC_LOCKS.pop(access_id, None)
+    if not IS_RUNNING.get(access_id):
+        set_running(access_id, None)
+    # 元のスペースを破棄した場合は、変数に代入されずにpyplotに残っているFigureも閉じる
+    serialization.release_figures(discarded, unreferenced=access_id == space_key(access_id))
+    return {"ok": "namespace dropped successfully", "remaining": len(STRAGE)}
+
+
+def _names(payload):
+    """名前空間に定義されている変数名を返す(アプリ側でのレポートの表や未定義の名前の検査に使う)"""
+    namespace = STRAGE.get(payload["id"])
+    if namespace is None:
+        return {"error": "namespace not found"}
+    return {"ok": "names listed", "names": sorted(name for name in list(namespace) if name != "__builtins__")}
+
+
+def _value_bytes(value):
+    """変数のメモリ使用量(DataFrameなどは中身を含めて計算する)"""
+    try:
+        if isinstance(value, pd.DataFrame):
+            return int(value.memory_usage(deep=True).sum())
+        if isinstance(value, (pd.Series, pd.Index)):
+            return int(value.memory_usage(deep=True))
+        if isinstance(value, np.ndarray):
+            return int(value.nbytes)
+        if value is state.engine or isinstance(value, types.ModuleType):
+            return 0
+        return sys.getsizeof(value)
+    except Exception:
+        return 0
+
+
+def _namespace_bytes():
+    """カーネルが保持する全名前空間のメモリ使用量(ロールバック用と共有している変数は1回だけ数える)"""
+    seen = set()
+    total = 0
+    version_snapshots = [snapshot for versions in list(STRAGE_VERSIONS.values()) for snapshot in list(versions.values())]
+    for namespaces in (STRAGE, STRAGE_ROLLBACK, dict(enumerate(version_snapshots))):
+        for namespace in list(namespaces.values()):
+            for name, value in list((namespace or {}).items()):
+                if name == "__builtins__" or id(value) in seen:
+                    continue
+                seen.add(id(value))
+                total += _value_bytes(value)
+    return total
+
+
+# 名前空間を変更するコマンド(実行後にメモリ使用量を計算し直す)
+MUTATING_COMMANDS = {"code", "rollback", "fork", "promote", "merge", "drop", "import", "checkpoint", "revert", "prepare"}
+
+_HANDLERS = {
+    "code": execution.execute_code,
+    "rollback": snapshots.rollback,
+    "fork": snapshots.fork,
+    "promote": snapshots.promote,
+    "merge": snapshots.merge,
+    "drop": _drop,
+    "interrupt": execution.interrupt,
+    "checkpoint": snapshots.checkpoint,
+    "revert": snapshots.revert,
+    "prepare": execution.prepare,
+    "var": serialization.get_variable,
+    "names": _names,
+    "export": persistence.export_state,
+    "import": persistence.import_state,
+}
+
+
+def _kernel_main(conn, database_url):
+    """カーネルのメインループ。リクエストごとにスレッドで処理し、結果をパイプで返す"""
+    if SANDBOX_KERNEL_ADDRESS_SPACE_MB:
+        # 上限を超える確保はカーネルごと終了させずにMemoryErrorにする
+        limit = SANDBOX_KERNEL_ADDRESS_SPACE_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if SANDBOX_PANDAS_COPY_ON_WRITE:
+        try:
+            pd.set_option("mode.copy_on_write", True)
+        except Exception as e:
+            print(f"pandas Copy-on-Write is not available: {e}")
+    try:
+        state.engine = create_engine(database_url, connect_args={"connect_timeout": 5})
+    except Exception as e:
+        print(f"Error creating database engine in kernel: {e}")
+        state.engine = None
+    if state.engine is not None:
+        event.listen(state.engine, "after_cursor_execute", execution.count_db_rows)
+    # engineでのpd.read_sql*の結果をカーネル間で共有するキャッシュに保存する
+    sql_cache.install(state.engine, observe, sampling.row_budget)
+    # 近似モードでは大きなテーブルを標本化し、その後で結果が大きすぎるクエリを拒否する
+    sampling.install(state.engine)
+    scan_guard.install(state.engine, observe)
+    state.duck = columnar.install()
+    send_lock = threading.Lock()
+
+    def _reply(request_id, command, payload):
+        state.local.observations = []
+        try:
+            result = _HANDLERS[command](payload)
+        except Exception as e:
+            result = {"error": str(e), "trace": traceback.format_exc()}
+        namespace_bytes = _namespace_bytes() if command in MUTATING_COMMANDS else None
+        with send_lock:
+            conn.send((request_id, result, state.local.observations, namespace_bytes))
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if message is None:
+            break
+        request_id, command, payload = message
+        threading.Thread(target=_reply, args=(request_id, command, payload), daemon=True).start()
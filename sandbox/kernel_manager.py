@@ -0,0 +1,488 @@
+import os
+import hashlib
+import itertools
+import multiprocessing
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import metrics
+from kernel import MUTATING_COMMANDS, _kernel_main
+from kernel_state import RESOURCE_SAMPLE_INTERVAL, space_key
+
+# 同時に起動しておくカーネル(スペースごとのワーカープロセス)の上限
+SANDBOX_MAX_KERNELS = int(os.getenv("SANDBOX_MAX_KERNELS", str(max(2, (os.cpu_count() or 1) * 2))))
+# 待機させておく起動済みカーネルの数
+SANDBOX_SPARE_KERNELS = int(os.getenv("SANDBOX_SPARE_KERNELS", "2"))
+# 追い出したカーネルの名前空間を保存するディレクトリ
+SANDBOX_SPILL_DIR = os.getenv("SANDBOX_SPILL_DIR", "/tmp/quelmap-spill")
+# 稼働中のスペースの名前空間を退避先に定期的に保存する間隔(秒、0の場合は定期保存しない)
+# 退避先をボリュームにしておくと、コンテナの再起動後に最初のアクセスで復元される
+SANDBOX_CHECKPOINT_INTERVAL = float(os.getenv("SANDBOX_CHECKPOINT_INTERVAL", "60"))
+# 終了時に全スペースの名前空間を保存するかどうか
+SANDBOX_CHECKPOINT_ON_SHUTDOWN = os.getenv("SANDBOX_CHECKPOINT_ON_SHUTDOWN", "true").lower() == "true"
+# 全カーネルの名前空間の合計メモリの上限(MB)。超えた場合は使われていないカーネルから退避する
+SANDBOX_MEMORY_BUDGET_MB = int(os.getenv("SANDBOX_MEMORY_BUDGET_MB", "4096"))
+KERNEL_SHUTDOWN_TIMEOUT = 5
+# 1回の実行でカーネルが使ってよいCPU時間(秒)とメモリ増加量(MB)(0は無制限)
+# 超えた場合はカーネルのプロセスを強制終了し、次のリクエストで最後に保存した名前空間から起動し直す
+SANDBOX_EXEC_CPU_LIMIT = float(os.getenv("SANDBOX_EXEC_CPU_LIMIT", "0"))
+SANDBOX_EXEC_MEMORY_LIMIT_MB = int(os.getenv("SANDBOX_EXEC_MEMORY_LIMIT_MB", "0"))
+# 名前空間を変更するコマンドが成功するたびに、応答する前に名前空間を退避先に保存するかどうか
+# (上限を超えてカーネルを強制終了しても、直前の実行までの名前空間から起動し直せる。上限を設定した場合の既定は有効)
+SANDBOX_CHECKPOINT_AFTER_RUN = os.getenv(
+    "SANDBOX_CHECKPOINT_AFTER_RUN", "true" if SANDBOX_EXEC_CPU_LIMIT or SANDBOX_EXEC_MEMORY_LIMIT_MB else "false"
+).lower() == "true"
+# 成功後に保存するコマンド(フォークは保存しないため、フォークの作成と実行では保存しない)
+CHECKPOINT_AFTER_COMMANDS = {"code", "rollback", "promote", "merge", "checkpoint", "revert"}
+
+
+### 親プロセス(APIサーバー)側のカーネル管理 ###
+class ExecutionQueueStats:
+    """
+    スペースごとの実行待ち・実行中の数
+    同じIDへの実行はカーネル内で直列化されるため、IDごとに1件を実行中、残りを待ちとして数える
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    @contextmanager
+    def track(self, access_id):
+        with self._lock:
+            self._in_flight[access_id] = self._in_flight.get(access_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight[access_id] -= 1
+                if self._in_flight[access_id] == 0:
+                    del self._in_flight[access_id]
+
+    def total(self):
+        with self._lock:
+            return sum(self._in_flight.values())
+
+    def waiting(self):
+        with self._lock:
+            return sum(count - 1 for count in self._in_flight.values())
+
+    def by_space(self):
+        stats = {}
+        with self._lock:
+            for access_id, count in self._in_flight.items():
+                space = stats.setdefault(space_key(access_id), {"running": 0, "queued": 0})
+                space["running"] += 1
+                space["queued"] += count - 1
+        return stats
+
+
+class _Kernel:
+    """1つのワーカープロセスとの通信を管理する"""
+
+    def __init__(self, context, database_url):
+        parent_conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_kernel_main, args=(child_conn, database_url), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.key = None
+        self.inflight = 0
+        self.alive = True
+        # 強制終了した理由(待機中のリクエストに返すエラー)
+        self.exit_reason = None
+        # カーネルが保持する名前空間のメモリ使用量(名前空間を変更するコマンドの後に更新)
+        self.namespace_bytes = 0
+        self._ids = itertools.count()
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def call(self, command, payload, timeout=None):
+        request_id = next(self._ids)
+        waiter = [threading.Event(), None]
+        with self._pending_lock:
+            if not self.alive:
+                return {"error": "Kernel is not running"}
+            self._pending[request_id] = waiter
+        try:
+            with self._send_lock:
+                self.conn.send((request_id, command, payload))
+        except (OSError, ValueError) as e:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            return {"error": f"Failed to send request to kernel: {e}"}
+        if not waiter[0].wait(timeout):
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            return {"error": "Kernel did not respond in time"}
+        return waiter[1]
+
+    def _read_loop(self):
+        while True:
+            try:
+                request_id, result, observations, namespace_bytes = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            if namespace_bytes is not None:
+                self.namespace_bytes = namespace_bytes
+            for metric_name, value, labels in observations:
+                metric = getattr(metrics, metric_name)
+                if isinstance(metric, metrics.Counter):
+                    metric.inc(value, **labels)
+                else:
+                    metric.observe(value, **labels)
+            with self._pending_lock:
+                waiter = self._pending.pop(request_id, None)
+            if waiter is not None:
+                waiter[1] = result
+                waiter[0].set()
+        # カーネルが終了した場合は待機中のリクエストをすべてエラーにする
+        with self._pending_lock:
+            self.alive = False
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for waiter in pending:
+            waiter[1] = {"error": self.exit_reason or "Kernel exited unexpectedly"}
+            waiter[0].set()
+
+    def kill(self, reason):
+        """カーネルのプロセスを強制終了する(C拡張の中で止まっている処理もまとめて止める)"""
+        self.exit_reason = reason
+        self.process.kill()
+
+    def shutdown(self):
+        try:
+            with self._send_lock:
+                self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(KERNEL_SHUTDOWN_TIMEOUT)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+    def rss_bytes(self):
+        try:
+            with open(f"/proc/{self.process.pid}/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            return 0
+
+    def cpu_seconds(self):
+        """カーネルのプロセス全体(全スレッド)が使ったCPU時間"""
+        try:
+            with open(f"/proc/{self.process.pid}/stat") as f:
+                # 2番目の項目(コマンド名)は空白を含むことがあるため、閉じ括弧より後ろを分割する
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, IndexError):
+            return 0.0
+
+
+class _ResourceWatchdog:
+    """
+    コードの実行中にカーネルのCPU時間とメモリ使用量を監視し、上限を超えた場合はカーネルを強制終了する
+    カーネルはスペースごとのプロセスのため、プロセス全体の使用量で判定する
+    """
+
+    def __init__(self, kernel):
+        self.kernel = kernel
+        self.exceeded = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.started_cpu = self.kernel.cpu_seconds()
+        self.started_rss = self.kernel.rss_bytes()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def _run(self):
+        while not self._stop.wait(RESOURCE_SAMPLE_INTERVAL):
+            if SANDBOX_EXEC_CPU_LIMIT and self.kernel.cpu_seconds() - self.started_cpu > SANDBOX_EXEC_CPU_LIMIT:
+                self.exceeded = "cpu"
+                message = f"Execution exceeded the CPU time limit of {SANDBOX_EXEC_CPU_LIMIT}s"
+            elif SANDBOX_EXEC_MEMORY_LIMIT_MB and self.kernel.rss_bytes() - self.started_rss > SANDBOX_EXEC_MEMORY_LIMIT_MB * 1024 * 1024:
+                self.exceeded = "memory"
+                message = f"Execution exceeded the memory limit of {SANDBOX_EXEC_MEMORY_LIMIT_MB}MB"
+            else:
+                continue
+            metrics.EXEC_LIMIT_EXCEEDED.inc(limit=self.exceeded)
+            self.kernel.kill(f"{message}; the kernel was stopped and restarts from the namespace before this execution")
+            return
+
+
+class KernelManager:
+    """
+    スペースごとにカーネルを割り当てる
+    カーネルはpandas/numpy/matplotlibを読み込み済みのforkserverから起動し、
+    カーネル数または名前空間の合計メモリが上限を超えた場合は、
+    最も長く使われていないカーネルの名前空間をディスクに退避して終了する
+    """
+
+    def __init__(
+        self,
+        database_url,
+        max_kernels=SANDBOX_MAX_KERNELS,
+        spare_kernels=SANDBOX_SPARE_KERNELS,
+        spill_dir=SANDBOX_SPILL_DIR,
+        memory_budget=SANDBOX_MEMORY_BUDGET_MB * 1024 * 1024,
+    ):
+        self.database_url = database_url
+        self.max_kernels = max_kernels
+        self.memory_budget = memory_budget
+        self.spare_kernels = spare_kernels
+        self.spill_dir = spill_dir
+        self._context = None
+        self._kernels = OrderedDict()
+        self._spares = []
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._evicting = {}
+        # 前回の保存後に名前空間が変更されたスペース
+        self._dirty = set()
+        # 上限を超えて強制終了したカーネルで実行していたID(復元後のロールバック先を実行前の名前空間にする)
+        self._killed_runs = {}
+        self._stopping = threading.Event()
+
+    def start(self):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        # 書き出しの途中で終了した保存は使わない
+        for name in os.listdir(self.spill_dir):
+            if name.endswith(".tmp"):
+                shutil.rmtree(os.path.join(self.spill_dir, name), ignore_errors=True)
+        self._context = multiprocessing.get_context("forkserver")
+        # forkserverに重いライブラリを読み込ませて初期化を済ませておき、カーネルはそこからforkする
+        self._context.set_forkserver_preload(["kernel", "warmup"])
+        self._fill_spares()
+        if SANDBOX_CHECKPOINT_INTERVAL > 0:
+            threading.Thread(target=self._checkpoint_loop, daemon=True).start()
+
+    def shutdown(self):
+        self._stopping.set()
+        if SANDBOX_CHECKPOINT_ON_SHUTDOWN:
+            # 再起動後に最初のアクセスで復元できるよう、稼働中のスペースをすべて保存する
+            self._checkpoint_all()
+        with self._lock:
+            kernels = list(self._kernels.values()) + self._spares
+            self._kernels.clear()
+            self._spares = []
+        for kernel in kernels:
+            kernel.shutdown()
+
+    def kernel_count(self):
+        return len(self._kernels)
+
+    def rss_bytes(self):
+        with self._lock:
+            kernels = list(self._kernels.values()) + self._spares
+        return sum(kernel.rss_bytes() for kernel in kernels)
+
+    def namespace_bytes(self):
+        with self._lock:
+            return sum(kernel.namespace_bytes for kernel in self._kernels.values())
+
+    def memory_by_space(self):
+        with self._lock:
+            return {key: kernel.namespace_bytes for key, kernel in self._kernels.items()}
+
+    def call(self, access_id, command, payload):
+        """access_idのスペースを担当するカーネルでコマンドを実行する"""
+        key = space_key(access_id)
+        if command in ("drop", "interrupt") and not self._has_kernel(key):
+            # 起動していないカーネルのために新しくプロセスを立ち上げない
+            if command == "drop" and access_id == key:
+                self._remove_spill(key)
+                return {"ok": "namespace dropped successfully"}
+            if command == "interrupt":
+                return {"ok": "no running execution"}
+        kernel = self._acquire(key)
+        try:
+            if command == "code" and (SANDBOX_EXEC_CPU_LIMIT or SANDBOX_EXEC_MEMORY_LIMIT_MB):
+                with _ResourceWatchdog(kernel) as watchdog:
+                    result = kernel.call(command, payload)
+                if watchdog.exceeded and payload.get("snapshot", True):
+                    with self._lock:
+                        self._killed_runs.setdefault(key, set()).add(access_id)
+            else:
+                result = kernel.call(command, payload)
+            if command in MUTATING_COMMANDS:
+                with self._lock:
+                    self._dirty.add(key)
+            if SANDBOX_CHECKPOINT_AFTER_RUN and command in CHECKPOINT_AFTER_COMMANDS and access_id == key and "error" not in result:
+                self._write_checkpoint(key, kernel)
+        finally:
+            with self._lock:
+                kernel.inflight -= 1
+                # メモリ上限を超えた場合は他のスペースのカーネルを退避する
+                victims = self._pick_victims(protect=key)
+        for victim in victims:
+            self._evict(victim)
+        if command == "drop" and access_id == key and result.get("remaining") == 0:
+            self._release(key, kernel)
+            # 削除したスペースが再起動後に復元されないようにする
+            self._remove_spill(key)
+        return result
+
+    def _has_kernel(self, key):
+        with self._lock:
+            return self._live(key) is not None or os.path.exists(self._spill_path(key))
+
+    def _live(self, key):
+        kernel = self._kernels.get(key)
+        if kernel is not None and not kernel.alive:
+            del self._kernels[key]
+            return None
+        return kernel
+
+    def _acquire(self, key):
+        with self._lock:
+            kernel = self._live(key)
+            if kernel is not None:
+                self._kernels.move_to_end(key)
+                kernel.inflight += 1
+                return kernel
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                kernel = self._live(key)
+                if kernel is not None:
+                    self._kernels.move_to_end(key)
+                    kernel.inflight += 1
+                    return kernel
+                evicting = self._evicting.get(key)
+                spare = self._spares.pop() if self._spares else None
+            # 追い出し中の場合は保存が終わるのを待ってから読み込む
+            if evicting is not None:
+                evicting.wait()
+            kernel = spare if spare is not None and spare.alive else _Kernel(self._context, self.database_url)
+            kernel.key = key
+            self._restore(kernel, key)
+            with self._lock:
+                self._kernels[key] = kernel
+                kernel.inflight += 1
+                victims = self._pick_victims(protect=key)
+        for victim in victims:
+            self._evict(victim)
+        threading.Thread(target=self._fill_spares, daemon=True).start()
+        return kernel
+
+    def _pick_victims(self, protect=None):
+        """
+        カーネル数とメモリの上限を超えた分だけ、実行中でないカーネルを古い順に選ぶ
+        (ロックを取得して呼び出す。protectのカーネルは選ばない)
+        """
+        victims = []
+        total_bytes = sum(kernel.namespace_bytes for kernel in self._kernels.values())
+        for key, kernel in list(self._kernels.items()):
+            if len(self._kernels) <= self.max_kernels and total_bytes <= self.memory_budget:
+                break
+            if kernel.inflight == 0 and key != protect:
+                del self._kernels[key]
+                self._evicting[key] = threading.Event()
+                total_bytes -= kernel.namespace_bytes
+                victims.append(kernel)
+        return victims
+
+    def _evict(self, kernel):
+        try:
+            result = kernel.call("export", {"path": self._spill_path(kernel.key)})
+            if "error" in result:
+                # 退避できなかった場合は名前空間を失わないようにカーネルを残す
+                print(f"Failed to spill kernel {kernel.key}: {result['error']}")
+                with self._lock:
+                    self._kernels[kernel.key] = kernel
+                    self._kernels.move_to_end(kernel.key, last=False)
+                return
+            kernel.shutdown()
+            metrics.KERNEL_EVICTIONS.inc()
+        finally:
+            with self._lock:
+                self._evicting.pop(kernel.key).set()
+
+    def _checkpoint_loop(self):
+        while not self._stopping.wait(SANDBOX_CHECKPOINT_INTERVAL):
+            self._checkpoint_all()
+
+    def _checkpoint_all(self):
+        """実行中でないカーネルのうち、保存後に変更されたか保存がないものの名前空間を退避先に保存する"""
+        with self._lock:
+            targets = []
+            for key, kernel in self._kernels.items():
+                if kernel.inflight > 0 or not kernel.alive:
+                    continue
+                if key not in self._dirty and os.path.exists(self._spill_path(key)):
+                    continue
+                # 保存中に追い出されないようにする
+                kernel.inflight += 1
+                self._dirty.discard(key)
+                targets.append((key, kernel))
+        for key, kernel in targets:
+            self._checkpoint(key, kernel)
+
+    def _checkpoint(self, key, kernel):
+        try:
+            self._write_checkpoint(key, kernel)
+        finally:
+            with self._lock:
+                kernel.inflight -= 1
+
+    def _write_checkpoint(self, key, kernel):
+        """名前空間を退避先に保存する(カーネルのinflightを増やした状態で呼び出す)"""
+        start = time.perf_counter()
+        with self._lock:
+            self._dirty.discard(key)
+        result = kernel.call("export", {"path": self._spill_path(key)})
+        outcome = "error" if "error" in result else "ok"
+        if outcome == "error":
+            print(f"Failed to checkpoint kernel {key}: {result['error']}")
+            with self._lock:
+                self._dirty.add(key)
+        metrics.CHECKPOINT_SECONDS.observe(time.perf_counter() - start)
+        metrics.CHECKPOINTS.inc(outcome=outcome)
+
+    def _release(self, key, kernel):
+        """名前空間がなくなったカーネルを終了する"""
+        with self._lock:
+            if self._kernels.get(key) is not kernel or kernel.inflight > 0:
+                return
+            del self._kernels[key]
+        kernel.shutdown()
+
+    def _restore(self, kernel, key):
+        path = self._spill_path(key)
+        with self._lock:
+            killed_runs = self._killed_runs.pop(key, set())
+        if not os.path.exists(path):
+            return
+        result = kernel.call("import", {"path": path, "reset_rollback": sorted(killed_runs)})
+        if "error" in result:
+            print(f"Failed to restore kernel {key}: {result['error']}")
+        # 保存を続ける場合は、次の保存までにカーネルが異常終了したときのために残しておく
+        if SANDBOX_CHECKPOINT_INTERVAL <= 0 and not SANDBOX_CHECKPOINT_AFTER_RUN:
+            self._remove_spill(key)
+
+    def _fill_spares(self):
+        while True:
+            with self._lock:
+                if len(self._spares) >= self.spare_kernels:
+                    return
+            kernel = _Kernel(self._context, self.database_url)
+            with self._lock:
+                self._spares.append(kernel)
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def _remove_spill(self, key):
+        shutil.rmtree(self._spill_path(key), ignore_errors=True)
@@ -0,0 +1,116 @@
+import ctypes
+import itertools
+import threading
+
+# /varや/rollbackで実行完了を待つ最大秒数
+WAIT_FOR_EXECUTION_TIMEOUT = 10
+# 実行中のCPU時間・メモリ使用量を確認する間隔(秒)
+# カーネル側の計測と、親プロセス側の上限の監視(kernel_manager)で共有する
+RESOURCE_SAMPLE_INTERVAL = 0.05
+
+
+def space_key(access_id):
+    """フォーク("{space_id}:repair:xxxx"など)を元のスペースと同じカーネルで扱うためのキー"""
+    return access_id.split(":", 1)[0]
+
+
+### カーネル(ワーカープロセス)側の状態 ###
+STRAGE = {}
+STRAGE_ROLLBACK = {}
+# 履歴のindexごとの名前空間のスナップショット {access_id: {version: {変数名: 値}}}
+STRAGE_VERSIONS = {}
+# スナップショットの各変数の指紋 {id(スナップショット): {変数名: (元のオブジェクトのid, 指紋)}}
+SNAPSHOT_FINGERPRINTS = {}
+
+IS_RUNNING = {}
+# IS_RUNNINGの変化を待つための条件変数
+RUNNING_CONDITION = threading.Condition()
+
+# IDごとの実行ロック(同じ名前空間への実行を直列化する)
+EXEC_LOCKS = {}
+EXEC_LOCKS_GUARD = threading.Lock()
+# カーネル内のコードの実行を1つずつにするロック
+# フォークは元のスペースと同じプロセスのスレッドで実行されるため、同時に実行してもGILで並列にはならず、
+# pyplotの現在のFigureなどのプロセス全体の状態を共有して結果が混ざる
+KERNEL_EXEC_LOCK = threading.Lock()
+
+# フォークされた名前空間のID -> フォーク時点の変数の束縛(マージ時の差分検出用)
+FORKS = {}
+# フォークされた名前空間のID -> フォーク時点のフォーク元の変数の束縛(マージ時の名前の衝突検出用)
+FORK_BASES = {}
+
+# /prepareで事前に作成した名前空間と、まだコードを実行していない名前空間のID
+PREPARED = set()
+NOT_EXECUTED = set()
+
+# 実行中のコードのスレッドID(中断用)
+RUNNING_THREADS = {}
+RUNNING_THREADS_LOCK = threading.Lock()
+
+# コードを実行するたびに増える世代(Figureが変更された可能性があるかの判定に使う)
+EXEC_GENERATION = itertools.count()
+exec_generation = 0
+
+engine = None
+# 埋め込みの列指向SQLエンジン(SANDBOX_DUCKDBが有効な場合のみ)
+duck = None
+
+# 親プロセスのメトリクスに反映する計測値(リクエストごと)
+local = threading.local()
+
+
+def new_namespace():
+    """新しい名前空間(engineと、有効な場合はduckを定義済み)"""
+    namespace = {"engine": engine}
+    if duck is not None:
+        namespace["duck"] = duck
+    return namespace
+
+
+def observe(metric_name, value, **labels):
+    # 生成コードが作成したスレッドからのクエリなど、リクエストの外での記録は捨てる
+    observations = getattr(local, "observations", None)
+    if observations is not None:
+        observations.append((metric_name, value, labels))
+
+
+class ExecutionInterrupted(BaseException):
+    """/interrupt によってコードの実行が中断されたことを示す例外
+    (生成コードの try...except Exception で握りつぶされないようにBaseExceptionを継承)"""
+
+
+def set_async_exc(thread_id, exc):
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_ulong(thread_id), ctypes.py_object(exc) if exc is not None else None
+    )
+
+
+def interrupt_execution(access_id):
+    """実行中のスレッドに例外を送り込んで実行を中断する"""
+    with RUNNING_THREADS_LOCK:
+        thread_id = RUNNING_THREADS.get(access_id)
+        if thread_id is None:
+            return False
+        set_async_exc(thread_id, ExecutionInterrupted)
+        return True
+
+
+def exec_lock(access_id):
+    with EXEC_LOCKS_GUARD:
+        return EXEC_LOCKS.setdefault(access_id, threading.Lock())
+
+
+def set_running(access_id, running):
+    """実行状態を更新し、完了を待っているリクエストを起こす(Noneの場合は状態を削除)"""
+    with RUNNING_CONDITION:
+        if running is None:
+            IS_RUNNING.pop(access_id, None)
+        else:
+            IS_RUNNING[access_id] = running
+        RUNNING_CONDITION.notify_all()
+
+
+def wait_until_idle(access_id, timeout=WAIT_FOR_EXECUTION_TIMEOUT):
+    """実行中のコードが完了するまで待つ(タイムアウトした場合はFalse)"""
+    with RUNNING_CONDITION:
+        return RUNNING_CONDITION.wait_for(lambda: not IS_RUNNING.get(access_id), timeout)
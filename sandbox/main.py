@@ -1,17 +1,13 @@
 import os
-import io
-import traceback
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
-import pandas as pd
-import numpy as np
+from typing import List, Optional
 from sqlalchemy import create_engine
-import json 
-import re
-import matplotlib.pyplot as plt
-import japanize_matplotlib
-import base64
-import time
+import metrics
+import sql_cache
+import scan_guard
+from kernel_manager import KernelManager, ExecutionQueueStats
 
 app = FastAPI()
 
@@ -34,161 +30,170 @@ except Exception as e:
     engine = None
 
 ### コンテナの状態管理 ###
-QUE = 0
-STRAGE = {}
-STRAGE_ROLLBACK = {}
+# スペースごとの実行待ち・実行中の数
+queue_stats = ExecutionQueueStats()
 
-IS_RUNNING = {}
+# スペースごとのワーカープロセス(カーネル)の管理
+kernels = KernelManager(DATABASE_URL)
+
+
+@app.on_event("startup")
+def startup_event():
+    kernels.start()
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    kernels.shutdown()
+
+
+metrics.register(metrics.Gauge("quelmap_sandbox_rss_bytes", "Resident memory of the sandbox process and its kernels", lambda: metrics.current_rss_bytes() + kernels.rss_bytes()))
+metrics.register(metrics.Gauge("quelmap_sandbox_spaces", "Number of spaces with a live kernel", kernels.kernel_count))
+metrics.register(metrics.Gauge("quelmap_sandbox_namespace_bytes", "Memory held by the namespaces of live kernels", kernels.namespace_bytes))
+metrics.register(metrics.Gauge("quelmap_sandbox_queue", "Number of executions in progress or waiting", queue_stats.total))
+metrics.register(metrics.Gauge("quelmap_sandbox_scan_max_rows", "Row ceiling for a single query result (0 = unlimited)", lambda: scan_guard.SANDBOX_SCAN_MAX_ROWS))
+metrics.register(metrics.Gauge("quelmap_sandbox_scan_max_bytes", "Byte ceiling for a single query result (0 = unlimited)", lambda: scan_guard.SANDBOX_SCAN_MAX_MB * 1024 * 1024))
+metrics.register(metrics.Gauge("quelmap_sandbox_waiting_executions", "Number of executions waiting for an earlier execution on the same namespace", queue_stats.waiting))
 
 
 ### エンドポイント　###
-# コンテナのキューの数を返す
+# コンテナのキューの数を返す(queはスペース配置に使う合計値)
 @app.get("/status")
 def get_status():
-    return {"que": QUE}
+    return {
+        "que": queue_stats.total(),
+        "kernels": kernels.kernel_count(),
+        "spaces": queue_stats.by_space(),
+        "memory": kernels.memory_by_space(),
+    }
+
+# Prometheus形式のメトリクスを返す
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render_metrics(), media_type="text/plain; version=0.0.4")
 
 #コードの実行
 class CodeExecutionRequest(BaseModel):
     id :str
     code: str
+    # Falseの場合はロールバック用の変数を保存しない(文単位のストリーミング実行で使用)
+    snapshot: bool = True
+    # 履歴のindex(指定された場合は実行前にその時点の名前空間を保存し、/revertで戻せるようにする)
+    version: Optional[int] = None
+    # 近似モードの行数の予算(指定された場合、大きなテーブルはTABLESAMPLEで読み込む)
+    sample_rows: Optional[int] = None
 @app.post("/code")
 def execute_code(request: CodeExecutionRequest):
     if engine is None:
         raise HTTPException(status_code=503, detail="Database connection not available")
-    global QUE
-    global STRAGE
-    global STRAGE_ROLLBACK
-    global IS_RUNNING
-    QUE += 1
-    if request.id in STRAGE and STRAGE[request.id] is not None:
-        localvars = STRAGE[request.id]
-    else:
-        localvars = {"engine": engine }
-
-    # ロールバック用の変数を保存
-    STRAGE_ROLLBACK[request.id] = localvars.copy()
-
-    #コードの前処理
-    code = request.code
-    #バックスラッシュを戻す
-    code = code.replace("%@", "\\")
-    #engine = で始まる行を削除
-    code = re.sub(r'^engine\s*=.*\n?', '', code, flags=re.MULTILINE)
-
-    IS_RUNNING[request.id] = True
-
-    #コードの実行
-    try:
-        exec(code, localvars)
-    except Exception as e:
-        QUE -= 1
-        IS_RUNNING[request.id] = False
-        return {"error": str(e), "trace": traceback.format_exc(), "id": request.id}
-
-    #変数の保存
-    STRAGE[request.id] = localvars
-    QUE -= 1
-    IS_RUNNING[request.id] = False
-    return {"ok": "code executed successfully"}
+    with queue_stats.track(request.id):
+        # スペースのカーネルで実行する(スペースごとに別プロセスのため並列に実行される)
+        return kernels.call(
+            request.id,
+            "code",
+            {
+                "id": request.id,
+                "code": request.code,
+                "snapshot": request.snapshot,
+                "version": request.version,
+                "sample_rows": request.sample_rows,
+            },
+        )
 
 #変数をロールバック(アクションモデルが実行中にエラーが発生した場合など)
 class VariableRollbackRequest(BaseModel):
     id: str
 @app.post("/rollback")
 def rollback_variable(request: VariableRollbackRequest):
-    global STRAGE
-    global STRAGE_ROLLBACK
-    global IS_RUNNING
-    if request.id not in STRAGE or request.id not in STRAGE_ROLLBACK:
-        return {"error": "Id not found"}
-    
-    # IS_RUNNING[request.id] = Falseなら完了するまで待つ
-    timeout = 10
-    start_time = time.time()
-    while IS_RUNNING[request.id] and (time.time() - start_time) < timeout:
-        pass
-    if IS_RUNNING[request.id]:
-        return {"error": "Code is still running, please try again later"}
-    
-    # ロールバック
-    STRAGE[request.id] = STRAGE_ROLLBACK[request.id]
-    return {"ok": "variables rolled back successfully"}
+    return kernels.call(request.id, "rollback", {"id": request.id})
+
+#履歴のindexの開始時点の名前空間を保存
+class VersionRequest(BaseModel):
+    id: str
+    version: int
+@app.post("/checkpoint")
+def checkpoint_namespace(request: VersionRequest):
+    return kernels.call(request.id, "checkpoint", {"id": request.id, "version": request.version})
+
+#名前空間を履歴のindexの開始時点に戻す(コードを再実行せずにスナップショットから復元)
+@app.post("/revert")
+def revert_namespace(request: VersionRequest):
+    return kernels.call(request.id, "revert", {"id": request.id, "version": request.version})
+
+#名前空間のフォーク(修正候補やサブ分析を元の名前空間を変えずに実行するため。実行はカーネル内で1つずつ)
+class ForkRequest(BaseModel):
+    id: str
+    fork_id: str
+@app.post("/fork")
+def fork_namespace(request: ForkRequest):
+    return kernels.call(request.id, "fork", {"id": request.id, "fork_id": request.fork_id})
+
+#フォークした名前空間を元のIDの名前空間として採用する
+@app.post("/promote")
+def promote_fork(request: ForkRequest):
+    return kernels.call(request.id, "promote", {"id": request.id, "fork_id": request.fork_id})
+
+#フォークで新たに定義・再代入された変数だけを元の名前空間に取り込む(サブ分析の結果統合用)
+#prefixを指定すると、先に取り込んだ変数と名前が衝突する変数は接頭辞を付けて取り込む
+class MergeRequest(ForkRequest):
+    prefix: Optional[str] = None
+@app.post("/merge")
+def merge_fork(request: MergeRequest):
+    return kernels.call(request.id, "merge", {"id": request.id, "fork_id": request.fork_id, "prefix": request.prefix})
+
+#名前空間の破棄
+class DropRequest(BaseModel):
+    id: str
+@app.post("/drop")
+def drop_namespace(request: DropRequest):
+    return kernels.call(request.id, "drop", {"id": request.id})
+
+#スペース作成時に名前空間とDB接続を事前に用意する
+@app.post("/prepare")
+def prepare_namespace(request: DropRequest):
+    return kernels.call(request.id, "prepare", {"id": request.id})
+
+#実行中のコードを中断(分析のキャンセルやタイムアウト時)
+@app.post("/interrupt")
+def interrupt_execution(request: DropRequest):
+    return kernels.call(request.id, "interrupt", {"id": request.id})
 
 
 #保存された変数の取得
 class VariableRetrievalResponse(BaseModel):
     id: str
     name: str
+    # DataFrameを返す範囲(limitを省略した場合は1ページ分)
+    offset: int = 0
+    limit: Optional[int] = None
+    # Figureの画像の形式(png/webp/svg)とDPI(省略した場合は環境変数の既定値)
+    format: Optional[str] = None
+    dpi: Optional[float] = None
 @app.post("/var")
 def get_variable(request: VariableRetrievalResponse):
-    global STRAGE
-    global IS_RUNNING
-    if request.id not in STRAGE or request.id not in IS_RUNNING:
-        return {"error": "Id not found"}
-    
-    # IS_RUNNING[request.id] = Falseなら完了するまで待つ
-    timeout = 10
-    start_time = time.time()
-    while IS_RUNNING[request.id] and (time.time() - start_time) < timeout:
-        pass
-    if IS_RUNNING[request.id]:
-        return {"error": "Code is still running, please try again later"}
-    
-    currentstrage = STRAGE[request.id]
-
-    # :.の対策
-    if ":." in request.name:
-        requestcode = f"f'''{{{request.name}}}'''"
-    else:
-        requestcode = request.name
-
-    # evalで"df.shape"や"df.columns"を実行できるようにする(dfなどの変数はcurrentstrageに入っている)
-    try:
-        result = eval(requestcode, {}, currentstrage)
-    except Exception as e:
-        if "error" in request.name or "log" in request.name:
-            return {"data": "", "type": "string"}
-        return {"error": "エラー: " + str(e)}
-    
-    def _to_json(result):
-        if isinstance(result, pd.DataFrame):
-            # indexが意味のある値を持っているかチェック
-            df_copy = result.copy()
-            if not df_copy.index.equals(pd.RangeIndex(len(df_copy))):
-                # indexが意味のある値を持っている場合、先頭に空のカラム名でindexを追加
-                df_copy.insert(0, '', df_copy.index)
-            return {"data": df_copy.to_json(orient="records"), "type": "table"}
-        elif isinstance(result, pd.Series):
-            # Seriesの場合もindexをチェック
-            series_copy = result.copy()
-            df_from_series = pd.DataFrame([series_copy])
-            if not series_copy.index.equals(pd.RangeIndex(len(series_copy))):
-                # indexが意味のある値を持っている場合、先頭に空のカラム名でindexを追加
-                df_from_series.insert(0, '', series_copy.index)
-            return {"data": df_from_series.to_json(orient="records"), "type": "table"}
-        # 2. pltグラフの時: base64画像にして返す
-        elif isinstance(result, plt.Figure):
-            buf = io.BytesIO()
-            result.savefig(buf, format='jpeg')
-            buf.seek(0)
-            base64_image = base64.b64encode(buf.getvalue()).decode('utf-8')
-            plt.close(result)  # メモリリークを防ぐためにFigureを閉じる
-            return {"data": base64_image, "type": "image"}
-        # 3. それ以外の時 : 文字列にして返す
-        else:
-            return {"data": str(result), "type": "string"}
-    
-    if isinstance(result, list):
-        # リストの場合は、各要素をJSONに変換
-        result_data = [_to_json(item) for item in result]
-    elif isinstance(result, dict):
-        # 辞書の場合は、各キーをStringにして値をJSONに変換
-        result_data = []
-        for key, value in result.items():
-            result_data.append({"data": str(key), "type": "string"})
-            result_data.append(_to_json(value))
-    else:
-        # 単一のオブジェクトの場合は、直接JSONに変換
-        result_data = [_to_json(result)]
-    
-    return {"result": result_data}
+    return kernels.call(
+        request.id,
+        "var",
+        {
+            "id": request.id,
+            "name": request.name,
+            "offset": request.offset,
+            "limit": request.limit,
+            "format": request.format,
+            "dpi": request.dpi,
+        },
+    )
+
+#名前空間に定義されている変数名の取得
+@app.post("/names")
+def get_names(request: DropRequest):
+    return kernels.call(request.id, "names", {"id": request.id})
+
+
+#テーブルが変更された場合にSQLの結果キャッシュを無効にする
+class InvalidateRequest(BaseModel):
+    tables: List[str]
+@app.post("/invalidate")
+def invalidate_tables(request: InvalidateRequest):
+    sql_cache.bump_table_versions(request.tables)
+    return {"ok": "tables invalidated", "tables": request.tables}
@@ -0,0 +1,33 @@
+import os
+# Histogram/Counter/Gaugeの実装はAPIサーバーと共通(shared/quelmap_metrics.py)
+from quelmap_metrics import DEFAULT_BUCKETS, Counter, Gauge, Histogram, register, render_metrics
+
+
+def current_rss_bytes() -> int:
+    """プロセスの現在の常駐メモリ量(バイト)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+# サンドボックスのメトリクス
+EXEC_SECONDS = register(Histogram("quelmap_sandbox_exec_seconds", "Code execution time in the sandbox", labels=("outcome",)))
+EXEC_CPU_SECONDS = register(Histogram("quelmap_sandbox_exec_cpu_seconds", "CPU time of the executing thread per code execution", labels=("outcome",)))
+EXEC_PEAK_RSS_DELTA_BYTES = register(Histogram("quelmap_sandbox_exec_peak_rss_delta_bytes", "Peak kernel memory growth during a code execution", buckets=tuple(2 ** i * 1024 * 1024 for i in range(0, 14))))
+EXEC_DB_ROWS = register(Histogram("quelmap_sandbox_exec_db_rows", "Rows fetched from the database per code execution", buckets=(0, 10, 100, 1000, 10000, 100000, 1000000, 10000000)))
+EXEC_LIMIT_EXCEEDED = register(Counter("quelmap_sandbox_exec_limit_exceeded_total", "Code executions stopped for exceeding a resource limit", labels=("limit",)))
+FIRST_EXEC_SECONDS = register(Histogram("quelmap_sandbox_first_exec_seconds", "Execution time of the first code run in a namespace, by whether the namespace was prepared in advance", labels=("prepared",)))
+PREPARE_SECONDS = register(Histogram("quelmap_sandbox_prepare_seconds", "Time spent preparing a namespace and its database connection before the first query"))
+EXEC_WAIT_SECONDS = register(Histogram("quelmap_sandbox_exec_wait_seconds", "Time an execution waited for an earlier execution on the same namespace"))
+SERIALIZATION_SECONDS = register(Histogram("quelmap_sandbox_serialization_seconds", "Time spent serializing a variable for /var", labels=("type",)))
+SQL_CACHE_LOOKUPS = register(Counter("quelmap_sandbox_sql_cache_lookups_total", "pd.read_sql* calls on the sandbox engine by outcome (snapshot, hit, miss, bypass)", labels=("result",)))
+SCAN_ESTIMATED_ROWS = register(Histogram("quelmap_sandbox_scan_estimated_rows", "Estimated result rows of queries checked by the scan guard", buckets=(10, 100, 1000, 10000, 100000, 1000000, 10000000, 100000000, 1000000000), labels=("source",)))
+SCAN_GUARD_REJECTIONS = register(Counter("quelmap_sandbox_scan_guard_rejections_total", "Queries refused for exceeding the scan ceiling", labels=("limit", "source")))
+FIGURE_DOWNSAMPLED_SERIES = register(Counter("quelmap_sandbox_figure_downsampled_series_total", "Plot series decimated to the output resolution before rendering", labels=("kind",)))
+FIGURE_DOWNSAMPLED_POINTS = register(Counter("quelmap_sandbox_figure_downsampled_points_total", "Points dropped from plot series before rendering", labels=("kind",)))
+FIGURE_RENDERS = register(Counter("quelmap_sandbox_figure_renders_total", "Figure renders for /var by format and render cache result", labels=("format", "cache")))
+KERNEL_EVICTIONS = register(Counter("quelmap_sandbox_kernel_evictions_total", "Kernels spilled to disk and stopped to stay under the kernel cap"))
+CHECKPOINTS = register(Counter("quelmap_sandbox_checkpoints_total", "Kernel namespace checkpoints written to the spill directory", labels=("outcome",)))
+CHECKPOINT_SECONDS = register(Histogram("quelmap_sandbox_checkpoint_seconds", "Time spent writing a kernel namespace checkpoint"))
@@ -0,0 +1,175 @@
+import os
+import types
+import pickle
+import shutil
+import importlib
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import kernel_state as state
+from kernel_state import STRAGE, STRAGE_ROLLBACK, STRAGE_VERSIONS, FORKS, exec_lock, set_running
+from snapshots import fingerprint, snapshot_namespace, latest_snapshot, forget_snapshot
+
+# 前回書き出した変数のファイル {保存先: {id(変数): (型, 指紋, ファイル名)}}
+# 次の保存では指紋が変わっていない変数を書き直さず、前回のファイルをハードリンクする
+EXPORTED_FILES = {}
+
+
+def _write_arrow(frame, path):
+    table = pa.Table.from_pandas(frame)
+    with pa.OSFile(path, "wb") as f:
+        with pa.ipc.new_file(f, table.schema) as writer:
+            writer.write_table(table)
+
+
+def _read_arrow(path):
+    with pa.OSFile(path, "rb") as f:
+        table = pa.ipc.open_file(f).read_all()
+    # ゼロコピーで読み込んだ列は読み取り専用になるため、書き込めるDataFrameにする
+    frame = table.to_pandas()
+    if any(not block.values.flags.writeable for block in frame._mgr.blocks if isinstance(block.values, np.ndarray)):
+        frame = frame.copy()
+    return frame
+
+
+def _reuse_file(previous, directory, value, value_fingerprint, filename):
+    """前回の保存から変わっていない変数のファイルを今回の保存先にリンクし、(タグ, ファイル名)を返す"""
+    exported = previous["files"].get(id(value))
+    if value_fingerprint is None or exported is None or exported[:2] != (type(value), value_fingerprint):
+        return None
+    tag, old_filename = exported[2]
+    extension = ".arrow" if tag == "arrow" else ".pkl"
+    try:
+        os.link(os.path.join(previous["directory"], old_filename + extension), os.path.join(directory, filename + extension))
+    except OSError:
+        return None
+    return tag
+
+
+def _dump_namespace(directory, records, written, access_id, kind, namespace, previous, exported):
+    """
+    名前空間の変数をディレクトリに書き出す
+    DataFrameはArrow(IPC形式)、それ以外はpickleで保存し、pickleできない変数は捨てる
+    前回の保存から指紋が変わっていない変数は書き直さずに前回のファイルを使う
+    """
+    for name, value in namespace.items():
+        if name == "__builtins__":
+            continue
+        if value is state.engine:
+            records.append((access_id, kind, name, "engine", None))
+            continue
+        if isinstance(value, types.ModuleType):
+            records.append((access_id, kind, name, "module", value.__name__))
+            continue
+        # ロールバック用の名前空間と共有している変数は1回だけ書き出す(読み込み時も同じオブジェクトにする)
+        if id(value) in written:
+            records.append((access_id, kind, name, "shared", written[id(value)]))
+            continue
+        filename = f"{len(written)}"
+        value_fingerprint = fingerprint(value)
+        tag = _reuse_file(previous, directory, value, value_fingerprint, filename)
+        if tag is not None:
+            written[id(value)] = filename
+            exported[id(value)] = (type(value), value_fingerprint, (tag, filename))
+            records.append((access_id, kind, name, tag, filename))
+            continue
+        if isinstance(value, pd.DataFrame):
+            try:
+                _write_arrow(value, os.path.join(directory, filename + ".arrow"))
+                written[id(value)] = filename
+                exported[id(value)] = (type(value), value_fingerprint, ("arrow", filename))
+                records.append((access_id, kind, name, "arrow", filename))
+                continue
+            except Exception:
+                # 列名が文字列でない・型が混在しているなどArrowにできない場合はpickleで保存する
+                pass
+        pickle_path = os.path.join(directory, filename + ".pkl")
+        try:
+            with open(pickle_path, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            print(f"Skipping variable {name} of {access_id} while spilling: {e}")
+            os.remove(pickle_path)
+            continue
+        written[id(value)] = filename
+        exported[id(value)] = (type(value), value_fingerprint, ("pickle", filename))
+        records.append((access_id, kind, name, "pickle", filename))
+
+
+def export_state(payload):
+    """
+    フォーク以外の名前空間をディレクトリに保存する(カーネルの追い出し前と定期保存で使用)
+    実行中のコードの途中の状態を保存しないよう、名前空間ごとに実行の完了を待ってから書き出す
+    """
+    directory = payload["path"]
+    staging = directory + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    # 前回のファイルは書き出し後に保存先ごと置き換わるため、今回の保存先にリンクしてから使う
+    previous = {"directory": directory, "files": EXPORTED_FILES.get(directory, {}) if os.path.isdir(directory) else {}}
+    exported = {}
+    records = []
+    written = {}
+    spaces = 0
+    for access_id in list(STRAGE):
+        if access_id in FORKS:
+            continue
+        with exec_lock(access_id):
+            namespace = STRAGE.get(access_id)
+            if namespace is None:
+                continue
+            _dump_namespace(staging, records, written, access_id, "space", namespace, previous, exported)
+            if access_id in STRAGE_ROLLBACK:
+                _dump_namespace(
+                    staging, records, written, access_id, "rollback", STRAGE_ROLLBACK[access_id], previous, exported
+                )
+            for version, snapshot in list(STRAGE_VERSIONS.get(access_id, {}).items()):
+                _dump_namespace(staging, records, written, access_id, ("version", version), snapshot, previous, exported)
+        spaces += 1
+    with open(os.path.join(staging, "manifest.pkl"), "wb") as f:
+        pickle.dump(records, f, protocol=pickle.HIGHEST_PROTOCOL)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(staging, directory)
+    EXPORTED_FILES[directory] = exported
+    return {"ok": "state exported", "spaces": spaces}
+
+
+def import_state(payload):
+    """export_stateで保存した名前空間を読み込む"""
+    directory = payload["path"]
+    with open(os.path.join(directory, "manifest.pkl"), "rb") as f:
+        records = pickle.load(f)
+    restored = {"space": {}, "rollback": {}}
+    loaded = {}
+    for access_id, kind, name, tag, data in records:
+        namespace = restored.setdefault(kind, {}).setdefault(access_id, {})
+        try:
+            if tag == "engine":
+                namespace[name] = state.engine
+            elif tag == "module":
+                namespace[name] = importlib.import_module(data)
+            elif tag == "shared":
+                namespace[name] = loaded[data]
+            elif tag == "arrow":
+                loaded[data] = namespace[name] = _read_arrow(os.path.join(directory, data + ".arrow"))
+            else:
+                with open(os.path.join(directory, data + ".pkl"), "rb") as f:
+                    loaded[data] = namespace[name] = pickle.load(f)
+        except Exception as e:
+            print(f"Skipping variable {name} of {access_id} while restoring: {e}")
+    for access_id, namespace in restored["space"].items():
+        STRAGE[access_id] = namespace
+        set_running(access_id, False)
+    STRAGE_ROLLBACK.update(restored["rollback"])
+    for kind, snapshots in restored.items():
+        if isinstance(kind, tuple):
+            for access_id, snapshot in snapshots.items():
+                STRAGE_VERSIONS.setdefault(access_id, {})[kind[1]] = snapshot
+    # 上限を超えて止めた実行は、実行前にロールバック用の変数を保存していたため、
+    # 保存した名前空間(その実行の直前の状態)をロールバック先にする
+    for access_id in payload.get("reset_rollback", []):
+        if access_id in STRAGE:
+            previous = STRAGE_ROLLBACK.get(access_id)
+            STRAGE_ROLLBACK[access_id] = snapshot_namespace(STRAGE[access_id], latest_snapshot(access_id))
+            forget_snapshot(previous)
+    return {"ok": "state imported", "spaces": len(restored["space"])}
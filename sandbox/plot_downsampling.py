@@ -0,0 +1,127 @@
+import os
+from contextlib import contextmanager
+import numpy as np
+from matplotlib.collections import PathCollection
+from matplotlib.colors import to_rgba_array
+
+# 描画時に大きな系列を間引くかどうか
+SANDBOX_PLOT_DOWNSAMPLE = os.getenv("SANDBOX_PLOT_DOWNSAMPLE", "true").lower() == "true"
+# 間引きの対象にする系列の最小の点数
+SANDBOX_PLOT_DOWNSAMPLE_MIN_POINTS = int(os.getenv("SANDBOX_PLOT_DOWNSAMPLE_MIN_POINTS", "10000"))
+
+
+def min_max_buckets(y, buckets):
+    """
+    x順に並んだ系列の値を等しい点数のバケットに分け、各バケットの最小値と最大値の点だけを残す
+    (折れ線の外形とスパイクを保ったまま点数を2*buckets程度にする)。残す点のindexを返す
+    """
+    size = len(y)
+    width = int(np.ceil(size / buckets))
+    padded = np.full(width * int(np.ceil(size / width)), np.nan)
+    padded[:size] = y
+    grid = padded.reshape(-1, width)
+    starts = np.arange(grid.shape[0]) * width
+    # 末尾のバケットの埋め草は最小値・最大値に選ばれないようにする
+    lows = starts + np.argmin(np.where(np.isnan(grid), np.inf, grid), axis=1)
+    highs = starts + np.argmax(np.where(np.isnan(grid), -np.inf, grid), axis=1)
+    # 端点は必ず残す
+    return np.unique(np.concatenate(([0, size - 1], lows, highs)))
+
+
+def _pixel_width(axes, dpi):
+    # 保存時のDPIでのAxesの幅(ピクセル)
+    return max(1, int(axes.bbox.width * dpi / axes.figure.dpi))
+
+
+def _downsample_line(line, buckets):
+    xy = line.get_xydata()
+    if len(xy) < max(SANDBOX_PLOT_DOWNSAMPLE_MIN_POINTS, 4 * buckets):
+        return None
+    x, y = xy[:, 0], xy[:, 1]
+    # 欠損で途切れる系列やxが単調でない系列(軌跡など)は形が変わるため間引かない
+    if not np.isfinite(xy).all() or not (np.all(np.diff(x) >= 0) or np.all(np.diff(x) <= 0)):
+        return None
+    # マーカー付きの線は点を減らすと見た目が変わる
+    if line.get_marker() not in (None, "None", "", " ", "none"):
+        return None
+    keep = min_max_buckets(y, buckets)
+    original = (line.get_xdata(orig=True), line.get_ydata(orig=True))
+    line.set_data(x[keep], y[keep])
+    return lambda: line.set_data(*original), len(xy), len(keep)
+
+
+def _downsample_scatter(collection, axes, dpi):
+    offsets = np.asarray(collection.get_offsets())
+    if len(offsets) < SANDBOX_PLOT_DOWNSAMPLE_MIN_POINTS or not np.isfinite(offsets).all():
+        return None
+    # 半透明の点は重なりで濃淡を表すため間引かない
+    if collection.get_alpha() is not None and collection.get_alpha() < 1:
+        return None
+    facecolors = collection.get_facecolors()
+    if len(facecolors) and (to_rgba_array(facecolors)[:, 3] < 1).any():
+        return None
+    # マーカーの半径(ピクセル)の格子で重なる点は最初の1つだけを残す
+    sizes = collection.get_sizes()
+    radius = np.sqrt(np.median(sizes)) * dpi / 72 / 2 if len(sizes) else 1
+    cell = max(1.0, radius) * axes.figure.dpi / dpi
+    pixels = np.floor(axes.transData.transform(offsets) / cell).astype(np.int64)
+    _, keep = np.unique(pixels, axis=0, return_index=True)
+    keep.sort()
+    if len(keep) >= len(offsets):
+        return None
+
+    count = len(offsets)
+    restorers = [lambda: collection.set_offsets(offsets)]
+    collection.set_offsets(offsets[keep])
+    array = collection.get_array()
+    if array is not None and len(array) == count:
+        # 色の範囲は間引く前の値で決めておく
+        collection.autoscale_None()
+        restorers.append(lambda: collection.set_array(array))
+        collection.set_array(array[keep])
+    elif len(facecolors) == count:
+        restorers.append(lambda: collection.set_facecolor(facecolors))
+        collection.set_facecolor(facecolors[keep])
+    if len(sizes) == count:
+        restorers.append(lambda: collection.set_sizes(sizes))
+        collection.set_sizes(sizes[keep])
+    edgecolors = collection.get_edgecolors()
+    if len(edgecolors) == count:
+        restorers.append(lambda: collection.set_edgecolor(edgecolors))
+        collection.set_edgecolor(edgecolors[keep])
+
+    def restore():
+        for restorer in restorers:
+            restorer()
+
+    return restore, count, len(keep)
+
+
+@contextmanager
+def downsampled(figure, dpi):
+    """
+    描画の間だけ、Figureの大きな折れ線・散布図の点を描画先のピクセル数程度に間引く
+    Figure自体は描画後に元のデータに戻す。間引いた系列の記録の一覧を返す
+    """
+    records = []
+    restorers = []
+    try:
+        if SANDBOX_PLOT_DOWNSAMPLE:
+            for axes in figure.get_axes():
+                buckets = _pixel_width(axes, dpi)
+                for line in axes.get_lines():
+                    applied = _downsample_line(line, buckets)
+                    if applied is not None:
+                        restorers.append(applied[0])
+                        records.append({"kind": "line", "points": applied[1], "rendered_points": applied[2]})
+                for collection in axes.collections:
+                    if not isinstance(collection, PathCollection):
+                        continue
+                    applied = _downsample_scatter(collection, axes, dpi)
+                    if applied is not None:
+                        restorers.append(applied[0])
+                        records.append({"kind": "scatter", "points": applied[1], "rendered_points": applied[2]})
+        yield records
+    finally:
+        for restore in reversed(restorers):
+            restore()
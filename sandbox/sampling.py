@@ -0,0 +1,111 @@
+import os
+import re
+import threading
+from sqlalchemy import event
+from sql_cache import _LITERALS, _IDENTIFIER, _table_name
+
+# 近似モードでのサンプリング方式(SYSTEMはブロック単位で高速、BERNOULLIは行単位で偏りが少ない)
+SANDBOX_SAMPLE_METHOD = os.getenv("SANDBOX_SAMPLE_METHOD", "SYSTEM").upper()
+# 同じクエリで同じ標本になるようにするシード(自己結合でも同じブロックが選ばれる)
+SANDBOX_SAMPLE_SEED = int(os.getenv("SANDBOX_SAMPLE_SEED", "0"))
+
+_SELECT = re.compile(r"^\s*\(?\s*(select|with)\b", re.IGNORECASE)
+_TABLE_REF = re.compile(
+    rf"\b(?:from|join)\s+({_IDENTIFIER}(?:\s*\.\s*{_IDENTIFIER})?)"
+    rf"(\s+(?:as\s+)?(?!(?:where|join|inner|left|right|full|cross|natural|on|using|group|order|limit|offset|having|union|intersect|except|window|lateral|tablesample|fetch|for)\b){_IDENTIFIER})?",
+    re.IGNORECASE,
+)
+_ESTIMATE_SQL = (
+    "SELECT name, c.reltuples FROM unnest(%(names)s::text[]) AS name "
+    "LEFT JOIN pg_class c ON c.oid = to_regclass(quote_ident(name))"
+)
+
+# 実行中のコードの行数の予算と、適用したサンプリング率 {テーブル名: パーセント}
+_local = threading.local()
+
+
+def begin(row_budget):
+    """このスレッドで実行するクエリのサンプリングを開始する(Noneの場合は何もしない)"""
+    _local.row_budget = row_budget or None
+    _local.samples = {}
+
+
+def end():
+    """サンプリングを終了し、適用したテーブルとサンプリング率の一覧を返す"""
+    samples = getattr(_local, "samples", {})
+    _local.row_budget = None
+    _local.samples = {}
+    return [{"table": table, "percent": percent} for table, percent in samples.items()]
+
+
+def row_budget():
+    return getattr(_local, "row_budget", None)
+
+
+def _masked(statement):
+    # 文字列リテラルの中を同じ長さで塗りつぶし、位置を変えずにテーブル参照を探す
+    return _LITERALS.sub(lambda m: "'" + "_" * (len(m.group(0)) - 2) + "'", statement)
+
+
+def _table_refs(statement):
+    """(テーブル名, 別名を含む参照の終了位置)の一覧(スキーマ付き・テーブル関数は除く)"""
+    masked = _masked(statement)
+    refs = []
+    for match in _TABLE_REF.finditer(masked):
+        parts = re.findall(_IDENTIFIER, match.group(1))
+        if len(parts) > 1 and _table_name(parts[0]) != "public":
+            continue
+        rest = masked[match.end():].lstrip()
+        if masked[match.end(1):].lstrip().startswith("(") or rest[:11].lower() == "tablesample":
+            continue
+        refs.append((_table_name(parts[-1]), match.end()))
+    return refs
+
+
+def rewrite(statement, estimates, budget):
+    """
+    推定行数が予算を超えるテーブルのうち最大のものだけをTABLESAMPLEで読むように書き換える
+    (結合する全テーブルを標本にすると結合結果が標本化率の積まで減るため)
+    書き換え後のSQLと(テーブル名, パーセント)を返す
+    """
+    refs = _table_refs(statement)
+    candidates = [(estimates.get(table) or 0, table) for table, _ in refs]
+    if not candidates:
+        return statement, None
+    rows, table = max(candidates)
+    if rows <= budget:
+        return statement, None
+    percent = round(max(budget / rows * 100, 0.0001), 4)
+    clause = f" TABLESAMPLE {SANDBOX_SAMPLE_METHOD} ({percent}) REPEATABLE ({SANDBOX_SAMPLE_SEED})"
+    for ref_table, end in sorted((ref for ref in refs if ref[0] == table), key=lambda ref: -ref[1]):
+        statement = statement[:end] + clause + statement[end:]
+    return statement, (table, percent)
+
+
+def _estimate_rows(cursor, tables):
+    """pg_classの統計からテーブルの推定行数を取得する(未集計のテーブルは含めない)"""
+    cursor.execute(_ESTIMATE_SQL, {"names": list(tables)})
+    return {name: rows for name, rows in cursor.fetchall() if rows is not None and rows > 0}
+
+
+def install(engine):
+    """
+    近似モードの実行中、engineで実行するSELECTの大きなテーブルの読み込みを標本化する
+    結果の上限の検査より先に書き換えるため、scan_guardより前にinstallする
+    """
+    if engine is None or engine.dialect.name != "postgresql":
+        return
+
+    @event.listens_for(engine, "before_cursor_execute", retval=True)
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        budget = row_budget()
+        if budget is None or executemany or not _SELECT.match(statement):
+            return statement, parameters
+        tables = {table for table, _ in _table_refs(statement)}
+        if not tables:
+            return statement, parameters
+        sampled, applied = rewrite(statement, _estimate_rows(cursor, tables), budget)
+        if applied is not None:
+            table, percent = applied
+            _local.samples[table] = min(percent, _local.samples.get(table, percent))
+        return sampled, parameters
@@ -0,0 +1,86 @@
+import os
+import re
+import json
+from sqlalchemy import event
+
+# engineで実行する1クエリが返してよい行数・データ量の上限(0の場合は制限しない)
+SANDBOX_SCAN_MAX_ROWS = int(os.getenv("SANDBOX_SCAN_MAX_ROWS", "10000000"))
+SANDBOX_SCAN_MAX_MB = int(os.getenv("SANDBOX_SCAN_MAX_MB", "1024"))
+
+_SELECT = re.compile(r"^\s*\(?\s*(select|with)\b", re.IGNORECASE)
+# pandasやSQLAlchemyが発行するカタログの参照は対象外
+_CATALOG = re.compile(r"\b(pg_catalog|information_schema)\.", re.IGNORECASE)
+
+# カーネルのメトリクス記録関数(install時に設定)
+_observe = None
+
+
+class QueryTooLarge(Exception):
+    """クエリの推定結果が上限を超えるため実行しなかったことを示す例外"""
+
+
+def _format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:,.0f}{unit}" if unit == "B" else f"{size:,.1f}{unit}"
+        size /= 1024
+
+
+def check_estimate(rows, size, source):
+    """推定の行数・バイト数が上限を超えていればQueryTooLargeを送出する"""
+    if _observe is not None:
+        _observe("SCAN_ESTIMATED_ROWS", rows, source=source)
+    if SANDBOX_SCAN_MAX_ROWS and rows > SANDBOX_SCAN_MAX_ROWS:
+        limit = "rows"
+        detail = f"{rows:,.0f} rows (limit {SANDBOX_SCAN_MAX_ROWS:,} rows)"
+    elif SANDBOX_SCAN_MAX_MB and size > SANDBOX_SCAN_MAX_MB * 1024 * 1024:
+        limit = "bytes"
+        detail = f"{_format_bytes(size)} (limit {SANDBOX_SCAN_MAX_MB:,}MB)"
+    else:
+        return
+    if _observe is not None:
+        _observe("SCAN_GUARD_REJECTIONS", 1, limit=limit, source=source)
+    raise QueryTooLarge(
+        f"Query refused: it would load an estimated {detail} into the sandbox. "
+        "Select only the columns you need instead of SELECT *, and push filtering, aggregation "
+        "and LIMIT into the SQL (WHERE / GROUP BY / LIMIT) rather than loading the whole table "
+        "and filtering it in pandas."
+    )
+
+
+def _explain(cursor, statement, parameters, no_parameters):
+    """PostgreSQLの実行計画から結果の推定行数とバイト数を返す"""
+    # 本来のクエリと同じ呼び出し方にする(パラメータなしの場合は%がエスケープされていない)
+    if no_parameters:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + statement)
+    else:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    root = plan[0]["Plan"]
+    return root["Plan Rows"], root["Plan Rows"] * root["Plan Width"]
+
+
+def install(engine, observe=None):
+    """
+    engineで実行するSELECTを事前にEXPLAINし、推定結果が上限を超えるものを拒否する
+    上限を超えたクエリはQueryTooLargeとなり、生成コードのエラーとして修正に回される
+    sql_cacheのキャッシュやスナップショットから返すpd.read_sql*はデータベースを読まないため、
+    検査するのはキャッシュにない(データベースで実行する)クエリだけになる
+    """
+    global _observe
+    _observe = observe
+    if engine is None or not (SANDBOX_SCAN_MAX_ROWS or SANDBOX_SCAN_MAX_MB):
+        return
+    if engine.dialect.name != "postgresql":
+        return
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if executemany or not _SELECT.match(statement) or _CATALOG.search(statement):
+            return
+        # EXPLAINが失敗する場合は本来のクエリも同じエラーになるため、そのまま送出する
+        no_parameters = not parameters and context is not None and context.no_parameters
+        rows, size = _explain(cursor, statement, parameters, no_parameters)
+        check_estimate(rows, size, "explain")
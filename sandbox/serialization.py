@@ -0,0 +1,202 @@
+import os
+import io
+import json
+import time
+import base64
+import weakref
+import threading
+import pandas as pd
+import matplotlib.pyplot as plt
+from matplotlib._pylab_helpers import Gcf
+import japanize_matplotlib
+import plot_downsampling
+import kernel_state as state
+from kernel_state import STRAGE, STRAGE_ROLLBACK, STRAGE_VERSIONS, IS_RUNNING, RUNNING_CONDITION, wait_until_idle, observe
+
+# /varでDataFrameを返す際の1ページの行数
+SANDBOX_TABLE_PAGE_ROWS = int(os.getenv("SANDBOX_TABLE_PAGE_ROWS", "1000"))
+# /varでFigureを画像にする際の既定の形式(png/webp/svg)とDPI
+SANDBOX_FIGURE_FORMAT = os.getenv("SANDBOX_FIGURE_FORMAT", "png").lower()
+SANDBOX_FIGURE_DPI = float(os.getenv("SANDBOX_FIGURE_DPI", "100"))
+# Figureの画像の長辺の最大ピクセル数(超える場合はDPIを下げる)
+SANDBOX_FIGURE_MAX_PIXELS = int(os.getenv("SANDBOX_FIGURE_MAX_PIXELS", "2000"))
+FIGURE_MIME_TYPES = {"png": "image/png", "webp": "image/webp", "svg": "image/svg+xml"}
+
+# Figureの描画結果のキャッシュ {id(Figure): (描画時の実行世代, {(形式, DPI): base64})}
+FIGURE_CACHE = {}
+# Figureの描画は並行して行わない(matplotlibはスレッドセーフでない)
+FIGURE_LOCK = threading.Lock()
+
+
+def _live_figure_ids():
+    """名前空間・スナップショットのいずれかから参照されているFigureのid"""
+    namespaces = list(STRAGE.values()) + list(STRAGE_ROLLBACK.values())
+    namespaces += [snapshot for versions in list(STRAGE_VERSIONS.values()) for snapshot in list(versions.values())]
+    return {
+        id(value)
+        for namespace in namespaces
+        for value in list((namespace or {}).values())
+        if isinstance(value, plt.Figure)
+    }
+
+
+def release_figures(namespaces, unreferenced=False):
+    """
+    破棄した名前空間のFigureのうち、他から参照されていないものをpyplotから外して描画キャッシュを解放する
+    unreferencedがTrueの場合は、どの変数からも参照されていないpyplotのFigureも閉じる
+    """
+    live = _live_figure_ids()
+    figures = [
+        value
+        for namespace in namespaces
+        for value in list((namespace or {}).values())
+        if isinstance(value, plt.Figure) and id(value) not in live
+    ]
+    if unreferenced:
+        with RUNNING_CONDITION:
+            idle = not any(IS_RUNNING.values())
+        # 実行中のコードがpyplotで作成中のFigureは閉じない
+        if idle:
+            figures += [manager.canvas.figure for manager in Gcf.get_all_fig_managers()]
+    with FIGURE_LOCK:
+        for figure in figures:
+            if id(figure) in live:
+                continue
+            plt.close(figure)
+            FIGURE_CACHE.pop(id(figure), None)
+
+
+def _render_figure(figure, image_format, dpi):
+    """
+    Figureを画像(base64)にし、(画像, 間引いた系列の記録)を返す
+    同じ実行世代・形式・DPIの描画結果はキャッシュから返す
+    """
+    # 長辺が上限を超える場合はDPIを下げる
+    width, height = figure.get_size_inches()
+    if max(width, height) * dpi > SANDBOX_FIGURE_MAX_PIXELS:
+        dpi = SANDBOX_FIGURE_MAX_PIXELS / max(width, height)
+    key = (image_format, round(dpi, 2))
+    with FIGURE_LOCK:
+        cached = FIGURE_CACHE.get(id(figure))
+        if cached is None or cached[0] != state.exec_generation:
+            if cached is None:
+                # Figureが解放されたらキャッシュも削除する(idの再利用で別のFigureの画像を返さないように)
+                weakref.finalize(figure, FIGURE_CACHE.pop, id(figure), None)
+            cached = FIGURE_CACHE[id(figure)] = (state.exec_generation, {})
+        if key in cached[1]:
+            observe("FIGURE_RENDERS", 1, format=image_format, cache="hit")
+        else:
+            buf = io.BytesIO()
+            # 描画先のピクセル数より多い点の折れ線・散布図は間引いて描画する
+            with plot_downsampling.downsampled(figure, key[1]) as downsampled:
+                figure.savefig(buf, format=image_format, dpi=key[1])
+            for record in downsampled:
+                observe("FIGURE_DOWNSAMPLED_SERIES", 1, kind=record["kind"])
+                observe("FIGURE_DOWNSAMPLED_POINTS", record["points"] - record["rendered_points"], kind=record["kind"])
+            cached[1][key] = (base64.b64encode(buf.getvalue()).decode('utf-8'), downsampled)
+            observe("FIGURE_RENDERS", 1, format=image_format, cache="miss")
+        return cached[1][key]
+
+
+def _has_default_index(frame):
+    index = frame.index
+    if isinstance(index, pd.RangeIndex):
+        return index.start == 0 and index.step == 1
+    return index.equals(pd.RangeIndex(len(frame)))
+
+
+def _serialize_table(frame, offset, limit):
+    """
+    DataFrameの指定範囲を列指向のJSON({"columns": [...], "data": [[列の値], ...]})にする
+    範囲の切り出しはビューで行い、全体のコピーは作らない
+    """
+    page = frame.iloc[offset : offset + limit]
+    columns = []
+    values = []
+    if not _has_default_index(frame):
+        # indexが意味のある値を持っている場合、先頭に空のカラム名でindexを追加
+        columns.append("")
+        values.append(pd.Series(page.index).to_json(orient="values", date_format="epoch"))
+    for position in range(page.shape[1]):
+        columns.append(str(page.columns[position]))
+        values.append(page.iloc[:, position].to_json(orient="values", date_format="epoch"))
+    data = '{"columns":' + json.dumps(columns, ensure_ascii=False) + ',"data":[' + ",".join(values) + "]}"
+    return {
+        "data": data,
+        "type": "table",
+        "format": "columnar",
+        "total_rows": len(frame),
+        "offset": offset,
+        "rows": len(page),
+    }
+
+
+def get_variable(payload):
+    access_id, name = payload["id"], payload["name"]
+    offset = max(0, payload.get("offset") or 0)
+    limit = payload.get("limit") or SANDBOX_TABLE_PAGE_ROWS
+    image_format = (payload.get("format") or SANDBOX_FIGURE_FORMAT).lower()
+    if image_format not in FIGURE_MIME_TYPES:
+        return {"error": f"Unsupported image format: {image_format}"}
+    dpi = payload.get("dpi") or SANDBOX_FIGURE_DPI
+    if access_id not in STRAGE or access_id not in IS_RUNNING:
+        return {"error": "Id not found"}
+
+    # 実行中の場合は完了するまで待つ
+    if not wait_until_idle(access_id):
+        return {"error": "Code is still running, please try again later"}
+
+    currentstrage = STRAGE[access_id]
+
+    # :.の対策
+    if ":." in name:
+        requestcode = f"f'''{{{name}}}'''"
+    else:
+        requestcode = name
+
+    # evalで"df.shape"や"df.columns"を実行できるようにする(dfなどの変数はcurrentstrageに入っている)
+    try:
+        result = eval(requestcode, {}, currentstrage)
+    except Exception as e:
+        if "error" in name or "log" in name:
+            return {"data": "", "type": "string"}
+        return {"error": "エラー: " + str(e)}
+
+    def _to_json(result):
+        started_at = time.perf_counter()
+        serialized = _serialize(result)
+        observe("SERIALIZATION_SECONDS", time.perf_counter() - started_at, type=serialized["type"])
+        return serialized
+
+    def _serialize(result):
+        if isinstance(result, pd.DataFrame):
+            # 1ページ分だけを列指向で返し、残りはoffsetを指定して取得する
+            return _serialize_table(result, offset, limit)
+        elif isinstance(result, pd.Series):
+            # Seriesはindexを列名とした1行の表として返す
+            return _serialize_table(pd.DataFrame([result]).reset_index(drop=True), 0, 1)
+        # 2. pltグラフの時: base64画像にして返す(Figureは閉じずに描画結果をキャッシュする)
+        elif isinstance(result, plt.Figure):
+            base64_image, downsampled = _render_figure(result, image_format, dpi)
+            serialized = {"data": base64_image, "type": "image", "mime_type": FIGURE_MIME_TYPES[image_format]}
+            if downsampled:
+                serialized["downsampled"] = downsampled
+            return serialized
+        # 3. それ以外の時 : 文字列にして返す
+        else:
+            return {"data": str(result), "type": "string"}
+
+    if isinstance(result, list):
+        # リストの場合は、各要素をJSONに変換
+        result_data = [_to_json(item) for item in result]
+    elif isinstance(result, dict):
+        # 辞書の場合は、各キーをStringにして値をJSONに変換
+        result_data = []
+        for key, value in result.items():
+            result_data.append({"data": str(key), "type": "string"})
+            result_data.append(_to_json(value))
+    else:
+        # 単一のオブジェクトの場合は、直接JSONに変換
+        result_data = [_to_json(result)]
+
+    return {"result": result_data}
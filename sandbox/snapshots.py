@@ -0,0 +1,241 @@
+import os
+import copy
+import types
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+import kernel_state as state
+from kernel_state import (
+    STRAGE, STRAGE_ROLLBACK, STRAGE_VERSIONS, SNAPSHOT_FINGERPRINTS, IS_RUNNING, FORKS, FORK_BASES,
+    new_namespace, exec_lock, set_running, wait_until_idle,
+)
+from serialization import release_figures
+
+# 履歴のindexごとに保持する名前空間のスナップショットの最大数
+SANDBOX_MAX_VERSIONS = int(os.getenv("SANDBOX_MAX_VERSIONS", "20"))
+
+
+# 変更されないため参照を共有してよい型
+_IMMUTABLE_TYPES = (int, float, complex, bool, str, bytes, type(None), range, types.FunctionType, types.BuiltinFunctionType, type)
+
+
+def _copy_on_write_enabled():
+    try:
+        return bool(pd.get_option("mode.copy_on_write"))
+    except Exception:
+        return False
+
+
+def _copy_pandas(value):
+    """pandasオブジェクトの複製(Copy-on-Writeが有効な場合は変更されるまでデータを共有する)"""
+    return value.copy(deep=not _copy_on_write_enabled())
+
+
+def fingerprint(value):
+    """変更の検出に使う指紋(計算できない場合はNone)"""
+    try:
+        if isinstance(value, pd.DataFrame):
+            digest = hashlib.blake2b(pd.util.hash_pandas_object(value, index=True).values.tobytes(), digest_size=16)
+            digest.update(repr((list(value.columns), [str(dtype) for dtype in value.dtypes])).encode())
+            return digest.hexdigest()
+        if isinstance(value, np.ndarray) and value.dtype != object:
+            digest = hashlib.blake2b(np.ascontiguousarray(value).data, digest_size=16)
+            digest.update(repr((value.shape, value.dtype.str)).encode())
+            return digest.hexdigest()
+        return hashlib.blake2b(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), digest_size=16).hexdigest()
+    except Exception:
+        return None
+
+
+def snapshot_namespace(namespace, previous=None):
+    """
+    名前空間のスナップショットを作成する
+    前のスナップショットから変わっていない変数はその値を共有し、変更された可変オブジェクトだけをコピーする
+    """
+    previous = previous or {}
+    previous_fingerprints = SNAPSHOT_FINGERPRINTS.get(id(previous), {})
+    snapshot = {}
+    fingerprints = {}
+    for name, value in namespace.items():
+        if (
+            name == "__builtins__"
+            or value is state.engine
+            or isinstance(value, (types.ModuleType,) + _IMMUTABLE_TYPES)
+        ):
+            snapshot[name] = value
+        elif isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+            snapshot[name] = _copy_pandas(value)
+        else:
+            value_fingerprint = fingerprint(value)
+            origin = previous_fingerprints.get(name)
+            if value_fingerprint is not None and origin == (id(value), value_fingerprint) and name in previous:
+                snapshot[name] = previous[name]
+            else:
+                try:
+                    snapshot[name] = value.copy() if isinstance(value, np.ndarray) else copy.deepcopy(value)
+                except Exception:
+                    # コピーできないオブジェクト(接続など)は参照を共有する
+                    snapshot[name] = value
+            fingerprints[name] = (id(value), value_fingerprint)
+    SNAPSHOT_FINGERPRINTS[id(snapshot)] = fingerprints
+    return snapshot
+
+
+def restore_snapshot(snapshot):
+    """スナップショットから名前空間を作成する(スナップショット自体は変更されないように複製する)"""
+    namespace = {}
+    for name, value in snapshot.items():
+        if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+            namespace[name] = _copy_pandas(value)
+        elif isinstance(value, np.ndarray):
+            namespace[name] = value.copy()
+        elif name == "__builtins__" or value is state.engine or isinstance(value, (types.ModuleType,) + _IMMUTABLE_TYPES):
+            namespace[name] = value
+        else:
+            try:
+                namespace[name] = copy.deepcopy(value)
+            except Exception:
+                namespace[name] = value
+    return namespace
+
+
+def forget_snapshot(snapshot):
+    if snapshot is not None:
+        SNAPSHOT_FINGERPRINTS.pop(id(snapshot), None)
+
+
+def latest_snapshot(access_id):
+    """差分の基準にする直近のスナップショット"""
+    versions = STRAGE_VERSIONS.get(access_id)
+    if versions:
+        return versions[max(versions)]
+    return STRAGE_ROLLBACK.get(access_id)
+
+
+def take_version(access_id, version):
+    """履歴のindexの開始時点の名前空間を保存する(既に保存済みの場合は何もしない)"""
+    versions = STRAGE_VERSIONS.setdefault(access_id, {})
+    if version in versions:
+        return False
+    namespace = STRAGE.get(access_id) or new_namespace()
+    versions[version] = snapshot_namespace(namespace, latest_snapshot(access_id))
+    while len(versions) > SANDBOX_MAX_VERSIONS:
+        forget_snapshot(versions.pop(min(versions)))
+    return True
+
+
+def rollback(payload):
+    access_id = payload["id"]
+    if access_id not in STRAGE or access_id not in STRAGE_ROLLBACK:
+        return {"error": "Id not found"}
+
+    # 実行中の場合は完了するまで待つ
+    if not wait_until_idle(access_id):
+        return {"error": "Code is still running, please try again later"}
+
+    # ロールバック(スナップショットは次のロールバックのために残す)
+    discarded = STRAGE[access_id]
+    STRAGE[access_id] = restore_snapshot(STRAGE_ROLLBACK[access_id])
+    release_figures([discarded])
+    return {"ok": "variables rolled back successfully"}
+
+
+def checkpoint(payload):
+    """履歴のindexの開始時点の名前空間を保存する"""
+    access_id = payload["id"]
+    with exec_lock(access_id):
+        created = take_version(access_id, payload["version"])
+    return {"ok": "checkpoint saved" if created else "checkpoint already exists"}
+
+
+def revert(payload):
+    """名前空間を履歴のindexの開始時点に戻し、それ以降のスナップショットを破棄する"""
+    access_id, version = payload["id"], payload["version"]
+    versions = STRAGE_VERSIONS.get(access_id, {})
+    if version not in versions:
+        return {"error": f"Snapshot for version {version} not found"}
+    if not wait_until_idle(access_id):
+        return {"error": "Code is still running, please try again later"}
+    with exec_lock(access_id):
+        discarded = [STRAGE.get(access_id), STRAGE_ROLLBACK.pop(access_id, None)]
+        STRAGE[access_id] = restore_snapshot(versions[version])
+        forget_snapshot(discarded[1])
+        for newer in [v for v in versions if v > version]:
+            discarded.append(versions.pop(newer))
+            forget_snapshot(discarded[-1])
+        set_running(access_id, False)
+    release_figures(discarded)
+    return {"ok": "namespace reverted", "version": version}
+
+
+def _fork_namespace(namespace):
+    """名前空間を複製する(DataFrameなどは実体をコピーし、フォーク間で変更が干渉しないようにする)"""
+    forked = {}
+    for key, value in namespace.items():
+        if key == "__builtins__" or value is state.engine or isinstance(value, types.ModuleType):
+            forked[key] = value
+        elif isinstance(value, (pd.DataFrame, pd.Series)):
+            forked[key] = _copy_pandas(value)
+        elif isinstance(value, np.ndarray):
+            forked[key] = value.copy()
+        else:
+            try:
+                forked[key] = copy.deepcopy(value)
+            except Exception:
+                # コピーできないオブジェクト(接続など)は参照を共有する
+                forked[key] = value
+    return forked
+
+
+def fork(payload):
+    source = STRAGE.get(payload["id"]) or new_namespace()
+    forked = _fork_namespace(source)
+    STRAGE[payload["fork_id"]] = forked
+    IS_RUNNING[payload["fork_id"]] = False
+    FORKS[payload["fork_id"]] = dict(forked)
+    FORK_BASES[payload["fork_id"]] = dict(source)
+    return {"ok": "namespace forked successfully"}
+
+
+def promote(payload):
+    access_id, fork_id = payload["id"], payload["fork_id"]
+    if fork_id not in FORKS or fork_id not in STRAGE:
+        return {"error": "Fork not found"}
+    STRAGE[access_id] = STRAGE.pop(fork_id)
+    forget_snapshot(STRAGE_ROLLBACK.pop(fork_id, None))
+    set_running(fork_id, None)
+    set_running(access_id, False)
+    FORKS.pop(fork_id, None)
+    FORK_BASES.pop(fork_id, None)
+    return {"ok": "fork promoted successfully"}
+
+
+def merge(payload):
+    """
+    フォークで定義・再代入された変数を元の名前空間に取り込む
+    フォーク後に元の名前空間で再代入された変数(先に取り込んだ他のフォークの変数など)と名前が衝突する場合は、
+    prefixが指定されていれば接頭辞を付けた名前で取り込み、指定されていなければ上書きしてconflictsで報告する
+    """
+    access_id, fork_id = payload["id"], payload["fork_id"]
+    prefix = payload.get("prefix")
+    if fork_id not in FORKS or fork_id not in STRAGE:
+        return {"error": "Fork not found"}
+    origins = FORKS[fork_id]
+    bases = FORK_BASES.get(fork_id, {})
+    target = STRAGE.setdefault(access_id, new_namespace())
+    IS_RUNNING.setdefault(access_id, False)
+    merged = []
+    conflicts = []
+    renamed = {}
+    for key, value in STRAGE[fork_id].items():
+        if key == "__builtins__" or (key in origins and origins[key] is value):
+            continue
+        name = key
+        if key in target and target[key] is not value and target[key] is not bases.get(key):
+            conflicts.append(key)
+            if prefix:
+                name = renamed[key] = prefix + key
+        target[name] = value
+        merged.append(name)
+    return {"ok": "fork merged successfully", "merged": merged, "conflicts": conflicts, "renamed": renamed}
@@ -0,0 +1,407 @@
+import os
+import re
+import json
+import time
+import fcntl
+import hashlib
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote
+import pandas as pd
+import pyarrow as pa
+from sqlalchemy import event
+from quelmap_table_changes import table_change_counters
+
+# SQLの結果キャッシュを使うかどうか
+SANDBOX_SQL_CACHE = os.getenv("SANDBOX_SQL_CACHE", "true").lower() == "true"
+# 結果をArrow形式で保存するディレクトリ(全カーネルで共有する)
+SANDBOX_SQL_CACHE_DIR = os.getenv("SANDBOX_SQL_CACHE_DIR", "/tmp/quelmap-sql-cache")
+# キャッシュの合計サイズの上限(MB)。超えた場合は最後に使われた時刻が古いものから削除する
+SANDBOX_SQL_CACHE_MB = int(os.getenv("SANDBOX_SQL_CACHE_MB", "1024"))
+# キャッシュの有効期限(秒、0は無期限)。アプリを経由せずにデータベースが変更された場合もこの時間で読み直す
+SANDBOX_SQL_CACHE_TTL = float(os.getenv("SANDBOX_SQL_CACHE_TTL", "600"))
+# キャッシュを使う前にPostgreSQLの統計情報でテーブルの変更を確認するかどうか
+SANDBOX_SQL_CACHE_CHECK_CHANGES = os.getenv("SANDBOX_SQL_CACHE_CHECK_CHANGES", "true").lower() == "true"
+# APIサーバーが書き出すテーブルのスナップショット(Arrow形式)の保存先
+TABLE_SNAPSHOT_DIR = os.getenv("TABLE_SNAPSHOT_DIR", "/tmp/quelmap-table-snapshots")
+TABLE_SNAPSHOTS = os.getenv("TABLE_SNAPSHOTS", "true").lower() == "true"
+# スナップショットの有効期限(秒、0は無期限。APIサーバー側と同じ値)
+TABLE_SNAPSHOT_TTL = float(os.getenv("TABLE_SNAPSHOT_TTL", "600"))
+
+_VERSIONS_FILE = "versions.json"
+_LOCK_FILE = "versions.lock"
+# カーネルでテーブルを変更した時点のスナップショットの識別子 {テーブル名: "inode:更新時刻"}
+# スナップショットのディレクトリは読み取り専用のため、古いスナップショットは削除せずにこの記録で使わないようにする
+_STALE_SNAPSHOTS_FILE = "stale_snapshots.json"
+# キャッシュを保存した時刻と、スナップショットの書き出し時のテーブルの変更の累計を記録するArrowのスキーマのメタデータのキー
+_CACHED_AT = b"quelmap_cached_at"
+_TABLE_CHANGES = b"quelmap_table_changes"
+
+# 実行するたびに結果が変わる可能性があるためキャッシュしない関数
+_VOLATILE = re.compile(r"\b(now|random|current_date|current_time|current_timestamp|localtime|localtimestamp|clock_timestamp|nextval|uuid_generate_\w+|gen_random_uuid)\b", re.IGNORECASE)
+# コメントは前後の空白とまとめて1つの空白にする
+_TOKENS = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")|((?:\s*(?:--[^\n]*|/\*.*?\*/))+\s*)|(\s+)", re.DOTALL)
+_LITERALS = re.compile(r"'(?:[^']|'')*'")
+_IDENTIFIER = r'(?:"(?:[^"]|"")+"|[A-Za-z_][\w$]*)'
+_READ_TABLES = re.compile(rf"\b(?:from|join)\s+({_IDENTIFIER}(?:\s*\.\s*{_IDENTIFIER})?)", re.IGNORECASE)
+_SELECT_ALL = re.compile(rf"select \* from ({_IDENTIFIER}(?:\s*\.\s*{_IDENTIFIER})?)", re.IGNORECASE)
+_WRITE_TABLES = re.compile(
+    rf"\b(?:insert\s+into|update|delete\s+from|truncate(?:\s+table)?|(?:create|drop|alter)\s+table(?:\s+if\s+(?:not\s+)?exists)?)\s+({_IDENTIFIER}(?:\s*\.\s*{_IDENTIFIER})?)",
+    re.IGNORECASE,
+)
+
+# ゼロコピーで読み込んだ表の元のDataFrame {キャッシュキーまたはファイルの識別子: DataFrame}
+# 返したDataFrameが変更された際にCopy-on-Writeでコピーされるよう、カーネルが終了するまで参照を保持する
+_MAPPED = {}
+_MAPPED_LOCK = threading.Lock()
+
+# カーネルのengine(install時に設定)
+_engine = None
+
+
+def normalize_sql(sql):
+    """キャッシュキー用にSQLを正規化する(コメントの削除・空白の統一。文字列リテラルは変更しない)"""
+
+    def _replace(match):
+        if match.group(1):
+            return match.group(1)
+        return " "
+
+    return _TOKENS.sub(_replace, str(sql)).strip().rstrip(";").strip()
+
+
+def _table_name(identifier):
+    # スキーマを除いたテーブル名(引用符のない識別子はPostgreSQLと同様に小文字にする)
+    name = re.findall(_IDENTIFIER, identifier)[-1]
+    if name.startswith('"'):
+        return name[1:-1].replace('""', '"')
+    return name.lower()
+
+
+def _without_literals(sql):
+    # 文字列リテラル内の"from"などをテーブル名と誤認しないように中身を除く
+    return _LITERALS.sub("''", normalize_sql(sql))
+
+
+def referenced_tables(sql):
+    """SQLが読み込むテーブル名"""
+    return sorted({_table_name(identifier) for identifier in _READ_TABLES.findall(_without_literals(sql))})
+
+
+def written_tables(sql):
+    """SQLが変更するテーブル名"""
+    return sorted({_table_name(identifier) for identifier in _WRITE_TABLES.findall(_without_literals(sql))})
+
+
+@contextmanager
+def _versions_lock():
+    os.makedirs(SANDBOX_SQL_CACHE_DIR, exist_ok=True)
+    with open(os.path.join(SANDBOX_SQL_CACHE_DIR, _LOCK_FILE), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def table_versions():
+    """テーブルごとのデータバージョン(APIサーバーやカーネルでテーブルが変更されるたびに加算)"""
+    try:
+        with open(os.path.join(SANDBOX_SQL_CACHE_DIR, _VERSIONS_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def bump_table_versions(table_names):
+    """テーブルのバージョンを更新し、そのテーブルに依存するキャッシュを使われないようにする"""
+    if not table_names:
+        return
+    with _versions_lock():
+        versions = table_versions()
+        for table_name in table_names:
+            versions[table_name] = versions.get(table_name, 0) + 1
+        path = os.path.join(SANDBOX_SQL_CACHE_DIR, _VERSIONS_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(versions, f)
+        os.replace(path + ".tmp", path)
+
+
+def table_changes(table_names):
+    """
+    アプリを経由せずに行われた変更も含めたテーブルの変更の累計(PostgreSQL以外や確認しない場合はNone)
+    キャッシュを使うたびに確認するため、クエリのイベント(標本化・上限の検査・行数の計測)を通さずに実行する
+    """
+    if not SANDBOX_SQL_CACHE_CHECK_CHANGES or _engine is None or _engine.dialect.name != "postgresql":
+        return None
+    try:
+        connection = _engine.raw_connection()
+        try:
+            return table_change_counters(connection, table_names)
+        finally:
+            connection.close()
+    except Exception as e:
+        print(f"Failed to check table changes: {e}")
+        return None
+
+
+def _cache_key(sql, tables, options):
+    versions = table_versions()
+    changes = table_changes(tables) or {}
+    source = {
+        "sql": normalize_sql(sql),
+        "tables": [[table, versions.get(table, 0), changes.get(table)] for table in tables],
+        "options": repr(sorted(options.items())),
+    }
+    return hashlib.sha256(json.dumps(source, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _schema_metadata(path):
+    """Arrowのファイルのスキーマのメタデータ(フッターだけを読む。読み込めない場合はNone)"""
+    try:
+        return pa.ipc.open_file(pa.memory_map(path)).schema.metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return None
+
+
+def _cached_at(path):
+    """キャッシュを保存した時刻(読み込めない場合はNone)"""
+    try:
+        return float((_schema_metadata(path) or {})[_CACHED_AT])
+    except (KeyError, ValueError):
+        return None
+
+
+def _load(key):
+    """キャッシュされた結果を読み込む(ない場合と有効期限を過ぎた場合はNone)"""
+    path = os.path.join(SANDBOX_SQL_CACHE_DIR, key + ".arrow")
+    cached_at = _cached_at(path)
+    if cached_at is None or (SANDBOX_SQL_CACHE_TTL and time.time() - cached_at > SANDBOX_SQL_CACHE_TTL):
+        return None
+    # 期限切れで保存し直した結果を区別するため、保存した時刻もメモリマップの識別子に含める
+    frame = _map_arrow(path, f"{key}:{cached_at}")
+    if frame is not None:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+    return frame
+
+
+def _map_arrow(path, key):
+    """Arrowのファイルをメモリマップで読み込み、可能な列はコピーせずにDataFrameにする"""
+    with _MAPPED_LOCK:
+        base = _MAPPED.get(key)
+    if base is None:
+        try:
+            table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        except (OSError, pa.ArrowInvalid):
+            return None
+        base = table.to_pandas(split_blocks=True)
+        with _MAPPED_LOCK:
+            base = _MAPPED.setdefault(key, base)
+    # メモリマップは読み取り専用のため、参照を共有した浅いコピーを返して変更時にコピーさせる
+    return base.copy(deep=False)
+
+
+def _store(key, frame):
+    try:
+        table = pa.Table.from_pandas(frame)
+    except (pa.ArrowException, TypeError, ValueError):
+        # Arrowで表現できない型の列がある場合はキャッシュしない
+        return
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), _CACHED_AT: repr(time.time()).encode()})
+    os.makedirs(SANDBOX_SQL_CACHE_DIR, exist_ok=True)
+    path = os.path.join(SANDBOX_SQL_CACHE_DIR, key + ".arrow")
+    staging = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with pa.OSFile(staging, "wb") as f:
+            with pa.ipc.new_file(f, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(staging, path)
+    except OSError as e:
+        print(f"Failed to store SQL cache entry: {e}")
+        if os.path.exists(staging):
+            os.remove(staging)
+        return
+    _evict()
+
+
+def _evict():
+    """合計サイズが上限を超えている場合、最後に使われた時刻が古いものから削除する"""
+    entries = []
+    for entry in os.scandir(SANDBOX_SQL_CACHE_DIR):
+        if entry.name.endswith(".arrow"):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    budget = SANDBOX_SQL_CACHE_MB * 1024 * 1024
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        try:
+            # 読み込み中のカーネルのメモリマップは削除後も有効
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+### テーブルのスナップショット ###
+def snapshot_path(table_name):
+    """テーブルのスナップショットのパス(APIサーバー側と同じ命名)"""
+    return os.path.join(TABLE_SNAPSHOT_DIR, quote(table_name, safe="") + ".arrow")
+
+
+def _snapshot_identity(path):
+    # テーブルの変更時にファイルは置き換えられるため、inodeと更新時刻で区別する
+    stat = os.stat(path)
+    return f"{stat.st_ino}:{stat.st_mtime_ns}"
+
+
+def _stale_snapshots():
+    try:
+        with open(os.path.join(SANDBOX_SQL_CACHE_DIR, _STALE_SNAPSHOTS_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def read_snapshot(table_name):
+    """テーブルのスナップショットをメモリマップで読み込む(ない場合と古い場合はNone)"""
+    if not TABLE_SNAPSHOTS:
+        return None
+    path = snapshot_path(table_name)
+    try:
+        identity = _snapshot_identity(path)
+        modified_at = os.path.getmtime(path)
+    except OSError:
+        return None
+    # カーネルで変更したテーブルは、APIサーバーが書き出し直すまでデータベースから読み込む
+    if _stale_snapshots().get(table_name) == identity:
+        return None
+    # 有効期限を過ぎたスナップショットと、アプリを経由せずに変更されたテーブルのスナップショットは使わない
+    if TABLE_SNAPSHOT_TTL and time.time() - modified_at > TABLE_SNAPSHOT_TTL:
+        return None
+    recorded = (_schema_metadata(path) or {}).get(_TABLE_CHANGES)
+    if recorded is not None:
+        current = (table_changes([table_name]) or {}).get(table_name)
+        if current is not None and current != recorded.decode():
+            return None
+    return _map_arrow(path, f"{path}:{identity}")
+
+
+def mark_snapshots_stale(table_names):
+    """カーネルで変更したテーブルの現在のスナップショットを使わないようにする"""
+    if not TABLE_SNAPSHOTS:
+        return
+    with _versions_lock():
+        stale = _stale_snapshots()
+        for table_name in table_names:
+            try:
+                stale[table_name] = _snapshot_identity(snapshot_path(table_name))
+            except OSError:
+                stale.pop(table_name, None)
+        path = os.path.join(SANDBOX_SQL_CACHE_DIR, _STALE_SNAPSHOTS_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(stale, f)
+        os.replace(path + ".tmp", path)
+
+
+def _whole_table(sql):
+    """SELECT * FROM テーブル の形のクエリであればテーブル名を返す"""
+    match = _SELECT_ALL.fullmatch(normalize_sql(sql))
+    if match is None:
+        return None
+    parts = re.findall(_IDENTIFIER, match.group(1))
+    # publicスキーマ以外のテーブルはスナップショットの対象外
+    if len(parts) > 1 and _table_name(parts[0]) != "public":
+        return None
+    return _table_name(parts[-1])
+
+
+def read_table(table_name, con=None):
+    """テーブル全体を読み込む。スナップショットがあればそれを使い、なければデータベースから読み込む"""
+    frame = read_snapshot(table_name)
+    if frame is None:
+        frame = pd.read_sql_table(table_name, con if con is not None else _engine)
+    return frame
+
+
+def install(engine, observe=None, sample_budget=None):
+    """
+    カーネルのengineを使ったpd.read_sql*の結果をキャッシュする
+    pandasはSQLAlchemyの接続以外を受け付けないため、engineを包む代わりにpandasの関数を置き換える
+    sample_budgetは近似モードの行数の予算を返す関数(標本の結果は別のキーでキャッシュする)
+    """
+    global _engine
+    if engine is None:
+        return
+    _engine = engine
+
+    def _record(result):
+        if observe is not None:
+            observe("SQL_CACHE_LOOKUPS", 1, result=result)
+
+    def _cached(original, tables_of, whole_table_of):
+        def wrapper(sql, con, *args, **kwargs):
+            # engine以外の接続・分割読み込み・位置引数での指定はキャッシュしない
+            if con is not engine or args or kwargs.get("chunksize") is not None:
+                return original(sql, con, *args, **kwargs)
+            budget = sample_budget() if sample_budget is not None else None
+            # テーブル全体の読み込みはスナップショットから返す(近似モードでは標本をデータベースから読む)
+            whole_table = None if kwargs or budget is not None else whole_table_of(sql)
+            if whole_table is not None:
+                frame = read_snapshot(whole_table)
+                if frame is not None:
+                    # スナップショットとキャッシュから返す場合はデータベースを読まないため、scan_guardの検査も行わない
+                    _record("snapshot")
+                    return frame
+            if not SANDBOX_SQL_CACHE:
+                return original(sql, con, **kwargs)
+            tables = tables_of(sql)
+            if not tables or _VOLATILE.search(normalize_sql(sql)):
+                _record("bypass")
+                return original(sql, con, **kwargs)
+            key = _cache_key(sql, tables, kwargs if budget is None else dict(kwargs, sample_budget=budget))
+            frame = _load(key)
+            if frame is not None:
+                _record("hit")
+                return frame
+            _record("miss")
+            frame = original(sql, con, **kwargs)
+            _store(key, frame)
+            return frame
+
+        wrapper.__doc__ = original.__doc__
+        wrapper.__wrapped__ = original
+        return wrapper
+
+    def _is_table_name(sql):
+        # read_sqlにテーブル名だけが渡された場合
+        return isinstance(sql, str) and re.fullmatch(_IDENTIFIER, sql.strip()) is not None
+
+    def _read_sql_tables(sql):
+        if _is_table_name(sql):
+            return [sql.strip()]
+        return referenced_tables(sql)
+
+    def _read_sql_whole_table(sql):
+        if _is_table_name(sql):
+            return sql.strip()
+        return _whole_table(sql)
+
+    pd.read_sql_query = _cached(pd.read_sql_query, referenced_tables, _whole_table)
+    pd.read_sql = _cached(pd.read_sql, _read_sql_tables, _read_sql_whole_table)
+    pd.read_sql_table = _cached(pd.read_sql_table, lambda table_name: [table_name], lambda table_name: table_name)
+
+    # コード内でテーブルを変更した場合(to_sqlなど)はバージョンを更新する
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        tables = written_tables(statement)
+        if tables:
+            bump_table_versions(tables)
+            mark_snapshots_stale(tables)
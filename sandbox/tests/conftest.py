@@ -0,0 +1,7 @@
+import os
+import sys
+
+# カーネルのモジュールはsandbox直下からimportされる(イメージでは/appに配置される)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+# アプリと共通のモジュール(イメージではsandboxと同じ場所にコピーされる)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "shared"))
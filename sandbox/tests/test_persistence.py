@@ -0,0 +1,98 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import persistence
+import snapshots
+from kernel_state import STRAGE, STRAGE_ROLLBACK, STRAGE_VERSIONS, FORKS, FORK_BASES, IS_RUNNING, SNAPSHOT_FINGERPRINTS
+
+
+@pytest.fixture(autouse=True)
+def kernel():
+    tables = (STRAGE, STRAGE_ROLLBACK, STRAGE_VERSIONS, FORKS, FORK_BASES, IS_RUNNING, SNAPSHOT_FINGERPRINTS)
+    for table in tables:
+        table.clear()
+    persistence.EXPORTED_FILES.clear()
+    yield
+    for table in tables:
+        table.clear()
+    persistence.EXPORTED_FILES.clear()
+
+
+def _restart():
+    """カーネルを再起動した状態にする"""
+    for table in (STRAGE, STRAGE_ROLLBACK, STRAGE_VERSIONS, FORKS, FORK_BASES, IS_RUNNING, SNAPSHOT_FINGERPRINTS):
+        table.clear()
+
+
+def _files(directory):
+    return {name: os.stat(os.path.join(directory, name)).st_ino for name in os.listdir(directory) if name != "manifest.pkl"}
+
+
+def test_state_round_trips_through_a_checkpoint(tmp_path):
+    path = str(tmp_path / "spill")
+    frame = pd.DataFrame({"a": [1, 2], "b": ["x", "y"]})
+    STRAGE["space"] = {"df": frame, "array": np.arange(3), "rows": [1, 2], "np": np}
+    STRAGE_ROLLBACK["space"] = snapshots.snapshot_namespace({"rows": [1]})
+    STRAGE_VERSIONS["space"] = {0: {"rows": []}}
+    assert persistence.export_state({"path": path})["spaces"] == 1
+    _restart()
+    assert persistence.import_state({"path": path})["spaces"] == 1
+    pd.testing.assert_frame_equal(STRAGE["space"]["df"], frame)
+    assert STRAGE["space"]["array"].tolist() == [0, 1, 2]
+    assert STRAGE["space"]["np"] is np
+    assert STRAGE_ROLLBACK["space"] == {"rows": [1]}
+    assert STRAGE_VERSIONS["space"] == {0: {"rows": []}}
+    # 読み込んだDataFrameは変更できる
+    STRAGE["space"]["df"].loc[0, "a"] = 5
+
+
+def test_forks_and_unpicklable_values_are_not_saved(tmp_path):
+    path = str(tmp_path / "spill")
+    STRAGE["space"] = {"a": 1, "handle": (lambda: None)}
+    snapshots.fork({"id": "space", "fork_id": "space:step:1"})
+    persistence.export_state({"path": path})
+    _restart()
+    persistence.import_state({"path": path})
+    assert STRAGE == {"space": {"a": 1}}
+
+
+def test_values_shared_with_the_rollback_snapshot_stay_shared(tmp_path):
+    path = str(tmp_path / "spill")
+    rows = [1, 2]
+    STRAGE["space"] = {"rows": rows}
+    STRAGE_ROLLBACK["space"] = {"rows": rows}
+    persistence.export_state({"path": path})
+    _restart()
+    persistence.import_state({"path": path})
+    assert STRAGE["space"]["rows"] is STRAGE_ROLLBACK["space"]["rows"]
+
+
+def test_unchanged_values_are_linked_from_the_previous_checkpoint(tmp_path):
+    path = str(tmp_path / "spill")
+    STRAGE["space"] = {"df": pd.DataFrame({"a": range(100)}), "rows": [1]}
+    persistence.export_state({"path": path})
+    before = _files(path)
+    STRAGE["space"]["rows"].append(2)
+    persistence.export_state({"path": path})
+    after = _files(path)
+    # 変わっていないDataFrameは書き直さず、変更したリストだけを書き出す
+    assert after["0.arrow"] == before["0.arrow"]
+    assert after["1.pkl"] != before["1.pkl"]
+    _restart()
+    persistence.import_state({"path": path})
+    assert STRAGE["space"]["rows"] == [1, 2]
+
+
+def test_killed_run_rolls_back_to_the_restored_namespace(tmp_path):
+    path = str(tmp_path / "spill")
+    STRAGE["space"] = {"a": 1, "b": 2}
+    STRAGE_ROLLBACK["space"] = {"a": 1}
+    persistence.export_state({"path": path})
+    _restart()
+    # 強制終了した実行の前に保存したロールバック先は、保存した名前空間より古い
+    persistence.import_state({"path": path, "reset_rollback": ["space", "space:step:1"]})
+    assert STRAGE_ROLLBACK["space"] == {"a": 1, "b": 2}
+    assert "space:step:1" not in STRAGE_ROLLBACK
@@ -0,0 +1,95 @@
+import matplotlib
+
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+
+import plot_downsampling
+from plot_downsampling import downsampled, min_max_buckets
+
+
+@pytest.fixture(autouse=True)
+def enabled(monkeypatch):
+    monkeypatch.setattr(plot_downsampling, "SANDBOX_PLOT_DOWNSAMPLE", True)
+    monkeypatch.setattr(plot_downsampling, "SANDBOX_PLOT_DOWNSAMPLE_MIN_POINTS", 1000)
+    yield
+    plt.close("all")
+
+
+def test_buckets_keep_each_minimum_maximum_and_the_end_points():
+    y = np.zeros(100)
+    y[17] = 5
+    y[63] = -5
+    keep = min_max_buckets(y, 10)
+    assert {0, 17, 63, 99} <= set(keep)
+    assert len(keep) <= 2 * 10 + 2
+    assert np.all(np.diff(keep) > 0)
+
+
+def test_last_partial_bucket_is_handled():
+    keep = min_max_buckets(np.arange(10, dtype=float), 3)
+    assert keep[0] == 0 and keep[-1] == 9
+    assert keep.max() < 10
+
+
+def test_long_line_is_drawn_with_fewer_points_and_restored():
+    figure, axes = plt.subplots(figsize=(2, 1), dpi=100)
+    x = np.arange(100_000)
+    y = np.sin(x / 1000)
+    y[54_321] = 10
+    (line,) = axes.plot(x, y)
+    with downsampled(figure, dpi=100) as records:
+        drawn = line.get_ydata()
+        assert len(drawn) < 1000
+        assert drawn.max() == 10
+    assert records == [{"kind": "line", "points": 100_000, "rendered_points": len(drawn)}]
+    assert len(line.get_ydata()) == 100_000
+
+
+@pytest.mark.parametrize(
+    "plot",
+    [
+        # マーカー付きの線・欠損を含む線・xが単調でない線は間引かない
+        lambda axes, x, y: axes.plot(x, y, marker="o"),
+        lambda axes, x, y: axes.plot(x, np.where(x % 100 == 0, np.nan, y)),
+        lambda axes, x, y: axes.plot(y, x % 7),
+    ],
+)
+def test_lines_whose_shape_would_change_are_kept(plot):
+    figure, axes = plt.subplots(figsize=(2, 1), dpi=100)
+    x = np.arange(20_000)
+    plot(axes, x, np.sin(x / 100))
+    with downsampled(figure, dpi=100) as records:
+        assert records == []
+
+
+def test_overlapping_scatter_points_are_drawn_once():
+    figure, axes = plt.subplots(figsize=(2, 2), dpi=100)
+    rng = np.random.default_rng(0)
+    points = rng.normal(size=(50_000, 2))
+    collection = axes.scatter(points[:, 0], points[:, 1], c=points[:, 0])
+    with downsampled(figure, dpi=100) as records:
+        drawn = len(collection.get_offsets())
+        assert drawn < 50_000
+        assert len(collection.get_array()) == drawn
+    assert records[0]["kind"] == "scatter"
+    assert len(collection.get_offsets()) == 50_000
+    assert len(collection.get_array()) == 50_000
+
+
+def test_translucent_scatter_is_kept():
+    figure, axes = plt.subplots(figsize=(2, 2), dpi=100)
+    points = np.random.default_rng(0).normal(size=(50_000, 2))
+    axes.scatter(points[:, 0], points[:, 1], alpha=0.2)
+    with downsampled(figure, dpi=100) as records:
+        assert records == []
+
+
+def test_disabled(monkeypatch):
+    monkeypatch.setattr(plot_downsampling, "SANDBOX_PLOT_DOWNSAMPLE", False)
+    figure, axes = plt.subplots()
+    axes.plot(np.arange(100_000))
+    with downsampled(figure, dpi=100) as records:
+        assert records == []
@@ -0,0 +1,65 @@
+import pytest
+
+import sampling
+
+
+@pytest.fixture(autouse=True)
+def method(monkeypatch):
+    monkeypatch.setattr(sampling, "SANDBOX_SAMPLE_METHOD", "SYSTEM")
+    monkeypatch.setattr(sampling, "SANDBOX_SAMPLE_SEED", 0)
+
+
+def test_large_table_is_read_with_tablesample():
+    sql, applied = sampling.rewrite("SELECT region, sum(amount) FROM orders GROUP BY region", {"orders": 1_000_000}, 10_000)
+    assert sql == "SELECT region, sum(amount) FROM orders TABLESAMPLE SYSTEM (1.0) REPEATABLE (0) GROUP BY region"
+    assert applied == ("orders", 1.0)
+
+
+def test_tables_within_the_budget_are_not_rewritten():
+    sql = "SELECT * FROM orders"
+    assert sampling.rewrite(sql, {"orders": 5_000}, 10_000) == (sql, None)
+    # 統計のないテーブルは書き換えない
+    assert sampling.rewrite(sql, {}, 10_000) == (sql, None)
+
+
+def test_only_the_largest_joined_table_is_sampled():
+    sql, applied = sampling.rewrite(
+        "SELECT * FROM orders o JOIN customers c ON c.id = o.customer_id",
+        {"orders": 2_000_000, "customers": 500_000},
+        10_000,
+    )
+    assert sql == "SELECT * FROM orders o TABLESAMPLE SYSTEM (0.5) REPEATABLE (0) JOIN customers c ON c.id = o.customer_id"
+    assert applied == ("orders", 0.5)
+
+
+def test_every_reference_to_the_sampled_table_is_rewritten():
+    sql, _ = sampling.rewrite(
+        "SELECT * FROM orders a JOIN orders AS b ON a.parent_id = b.id", {"orders": 1_000_000}, 10_000
+    )
+    assert sql.count("TABLESAMPLE SYSTEM (1.0) REPEATABLE (0)") == 2
+    assert "orders a TABLESAMPLE" in sql and "orders AS b TABLESAMPLE" in sql
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT * FROM analytics.orders",
+        "SELECT * FROM generate_series(1, 10) orders",
+        "SELECT * FROM orders TABLESAMPLE BERNOULLI (10)",
+        "SELECT * FROM events WHERE note = 'from orders'",
+    ],
+)
+def test_references_that_cannot_be_sampled_are_left_alone(sql):
+    assert sampling.rewrite(sql, {"orders": 1_000_000}, 10_000) == (sql, None)
+
+
+def test_begin_and_end_report_the_applied_rates():
+    sampling.begin(10_000)
+    assert sampling.row_budget() == 10_000
+    sampling._local.samples["orders"] = 1.0
+    assert sampling.end() == [{"table": "orders", "percent": 1.0}]
+    assert sampling.row_budget() is None
+    # 予算がない場合は標本化しない
+    sampling.begin(None)
+    assert sampling.row_budget() is None
+    sampling.end()
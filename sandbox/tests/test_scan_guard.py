@@ -0,0 +1,35 @@
+import pytest
+
+import scan_guard
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(scan_guard, "SANDBOX_SCAN_MAX_ROWS", 1000)
+    monkeypatch.setattr(scan_guard, "SANDBOX_SCAN_MAX_MB", 1)
+    observed = []
+    monkeypatch.setattr(scan_guard, "_observe", lambda name, value, **labels: observed.append((name, labels)))
+    return observed
+
+
+def test_estimates_within_the_limits_pass(limits):
+    scan_guard.check_estimate(1000, 1024 * 1024, "explain")
+    assert limits == [("SCAN_ESTIMATED_ROWS", {"source": "explain"})]
+
+
+def test_too_many_rows_are_refused(limits):
+    with pytest.raises(scan_guard.QueryTooLarge, match="1,001 rows"):
+        scan_guard.check_estimate(1001, 10, "explain")
+    assert limits[-1] == ("SCAN_GUARD_REJECTIONS", {"limit": "rows", "source": "explain"})
+
+
+def test_too_many_bytes_are_refused(limits):
+    with pytest.raises(scan_guard.QueryTooLarge, match=r"2\.0MB"):
+        scan_guard.check_estimate(10, 2 * 1024 * 1024, "duckdb")
+    assert limits[-1] == ("SCAN_GUARD_REJECTIONS", {"limit": "bytes", "source": "duckdb"})
+
+
+def test_zero_disables_a_limit(limits, monkeypatch):
+    monkeypatch.setattr(scan_guard, "SANDBOX_SCAN_MAX_ROWS", 0)
+    monkeypatch.setattr(scan_guard, "SANDBOX_SCAN_MAX_MB", 0)
+    scan_guard.check_estimate(10 ** 12, 10 ** 15, "explain")
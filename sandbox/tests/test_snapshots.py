@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import kernel_state as state
+import snapshots
+from kernel_state import STRAGE, STRAGE_ROLLBACK, STRAGE_VERSIONS, FORKS, FORK_BASES, IS_RUNNING, SNAPSHOT_FINGERPRINTS
+
+
+@pytest.fixture(autouse=True)
+def kernel():
+    for table in (STRAGE, STRAGE_ROLLBACK, STRAGE_VERSIONS, FORKS, FORK_BASES, IS_RUNNING, SNAPSHOT_FINGERPRINTS):
+        table.clear()
+    yield
+    for table in (STRAGE, STRAGE_ROLLBACK, STRAGE_VERSIONS, FORKS, FORK_BASES, IS_RUNNING, SNAPSHOT_FINGERPRINTS):
+        table.clear()
+
+
+def test_snapshot_copies_values_changed_since_the_previous_snapshot():
+    namespace = {"rows": [1, 2], "totals": {"a": 1}, "n": 3}
+    first = snapshots.snapshot_namespace(namespace)
+    namespace["rows"].append(3)
+    second = snapshots.snapshot_namespace(namespace, first)
+    # 変わっていない可変オブジェクトは前のスナップショットと共有する
+    assert second["totals"] is first["totals"]
+    assert second["rows"] is not first["rows"]
+    assert first["rows"] == [1, 2]
+    assert second["rows"] == [1, 2, 3]
+
+
+def test_snapshot_is_not_changed_by_later_edits():
+    frame = pd.DataFrame({"a": [1, 2]})
+    array = np.arange(3)
+    snapshot = snapshots.snapshot_namespace({"df": frame, "array": array})
+    frame.loc[0, "a"] = 100
+    array[0] = 100
+    assert snapshot["df"]["a"].tolist() == [1, 2]
+    assert snapshot["array"].tolist() == [0, 1, 2]
+
+
+def test_rollback_restores_the_snapshot_and_keeps_it_for_the_next_rollback():
+    STRAGE["space"] = {"rows": [1]}
+    STRAGE_ROLLBACK["space"] = snapshots.snapshot_namespace(STRAGE["space"])
+    STRAGE["space"]["rows"].append(2)
+    STRAGE["space"]["b"] = 1
+    assert "ok" in snapshots.rollback({"id": "space"})
+    assert STRAGE["space"] == {"rows": [1]}
+    STRAGE["space"]["rows"].append(3)
+    assert "ok" in snapshots.rollback({"id": "space"})
+    assert STRAGE["space"] == {"rows": [1]}
+
+
+def test_rollback_without_a_snapshot_is_an_error():
+    STRAGE["space"] = {"a": 1}
+    assert "error" in snapshots.rollback({"id": "space"})
+
+
+def test_revert_returns_to_a_version_and_drops_newer_ones():
+    STRAGE["space"] = {"a": 1}
+    assert snapshots.checkpoint({"id": "space", "version": 0})["ok"] == "checkpoint saved"
+    STRAGE["space"]["a"] = 2
+    snapshots.checkpoint({"id": "space", "version": 1})
+    STRAGE["space"]["a"] = 3
+    # 同じindexのスナップショットは取り直さない
+    assert snapshots.checkpoint({"id": "space", "version": 1})["ok"] == "checkpoint already exists"
+    assert snapshots.revert({"id": "space", "version": 0})["version"] == 0
+    assert STRAGE["space"]["a"] == 1
+    assert list(STRAGE_VERSIONS["space"]) == [0]
+    assert "error" in snapshots.revert({"id": "space", "version": 1})
+
+
+def test_old_versions_are_discarded(monkeypatch):
+    monkeypatch.setattr(snapshots, "SANDBOX_MAX_VERSIONS", 2)
+    STRAGE["space"] = {"a": 0}
+    for version in range(4):
+        snapshots.take_version("space", version)
+    assert sorted(STRAGE_VERSIONS["space"]) == [2, 3]
+
+
+def test_fork_does_not_share_mutable_values():
+    STRAGE["space"] = {"rows": [1], "df": pd.DataFrame({"a": [1]})}
+    snapshots.fork({"id": "space", "fork_id": "space:step:1"})
+    STRAGE["space:step:1"]["rows"].append(2)
+    STRAGE["space:step:1"]["df"].loc[0, "a"] = 9
+    assert STRAGE["space"]["rows"] == [1]
+    assert STRAGE["space"]["df"]["a"].tolist() == [1]
+
+
+def test_promote_replaces_the_space_with_the_fork():
+    STRAGE["space"] = {"a": 1}
+    snapshots.fork({"id": "space", "fork_id": "space:exact"})
+    STRAGE["space:exact"]["a"] = 2
+    assert "ok" in snapshots.promote({"id": "space", "fork_id": "space:exact"})
+    assert STRAGE["space"]["a"] == 2
+    assert "space:exact" not in STRAGE and "space:exact" not in FORKS
+    assert "error" in snapshots.promote({"id": "space", "fork_id": "space:exact"})
+
+
+def test_merge_takes_only_variables_the_fork_assigned():
+    STRAGE["space"] = {"a": 1, "b": 2}
+    snapshots.fork({"id": "space", "fork_id": "space:step:1"})
+    STRAGE["space:step:1"]["c"] = 3
+    result = snapshots.merge({"id": "space", "fork_id": "space:step:1"})
+    assert result["merged"] == ["c"]
+    assert result["conflicts"] == []
+    assert STRAGE["space"] == {"a": 1, "b": 2, "c": 3}
+
+
+def test_merge_renames_names_assigned_by_another_fork():
+    STRAGE["space"] = {"a": 1}
+    snapshots.fork({"id": "space", "fork_id": "space:step:1"})
+    snapshots.fork({"id": "space", "fork_id": "space:step:2"})
+    STRAGE["space:step:1"]["total"] = 10
+    STRAGE["space:step:2"]["total"] = 20
+    snapshots.merge({"id": "space", "fork_id": "space:step:1", "prefix": "step1_"})
+    result = snapshots.merge({"id": "space", "fork_id": "space:step:2", "prefix": "step2_"})
+    assert result["conflicts"] == ["total"]
+    assert result["renamed"] == {"total": "step2_total"}
+    assert STRAGE["space"]["total"] == 10
+    assert STRAGE["space"]["step2_total"] == 20
+
+
+def test_merge_without_a_prefix_overwrites_and_reports_the_conflict():
+    STRAGE["space"] = {"a": 1}
+    snapshots.fork({"id": "space", "fork_id": "space:step:1"})
+    STRAGE["space"]["a"] = 5
+    STRAGE["space:step:1"]["a"] = 2
+    result = snapshots.merge({"id": "space", "fork_id": "space:step:1"})
+    assert result["conflicts"] == ["a"]
+    assert STRAGE["space"]["a"] == 2
+
+
+def test_engine_is_shared_not_copied(monkeypatch):
+    engine = object()
+    monkeypatch.setattr(state, "engine", engine)
+    snapshot = snapshots.snapshot_namespace({"engine": engine})
+    assert snapshot["engine"] is engine
+    assert snapshots.restore_snapshot(snapshot)["engine"] is engine
@@ -0,0 +1,116 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+from sqlalchemy import create_engine, text
+
+import sql_cache
+
+
+@pytest.fixture
+def engine(monkeypatch, tmp_path):
+    monkeypatch.setattr(sql_cache, "SANDBOX_SQL_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(sql_cache, "TABLE_SNAPSHOT_DIR", str(tmp_path / "snapshots"))
+    monkeypatch.setattr(sql_cache, "_MAPPED", {})
+    # installはpandasの関数を置き換えるため、テスト後に元に戻す
+    for name in ("read_sql_query", "read_sql", "read_sql_table"):
+        monkeypatch.setattr(pd, name, getattr(pd, name))
+    engine = create_engine(f"sqlite:///{tmp_path / 'db.sqlite'}")
+    pd.DataFrame({"id": [1, 2, 3], "amount": [10, 20, 30]}).to_sql("orders", engine, index=False)
+    queries = []
+    lookups = []
+    original = pd.read_sql_query
+
+    def counting(sql, con, *args, **kwargs):
+        queries.append(sql)
+        return original(sql, con, *args, **kwargs)
+
+    monkeypatch.setattr(pd, "read_sql_query", counting)
+    sql_cache.install(engine, observe=lambda name, value, **labels: lookups.append(labels["result"]))
+    return engine, queries, lookups
+
+
+def test_normalize_sql_ignores_comments_and_whitespace_but_not_literals():
+    assert sql_cache.normalize_sql("SELECT  a -- note\nFROM t;") == "SELECT a FROM t"
+    assert sql_cache.normalize_sql("SELECT a /* x */ /* y */ FROM t") == "SELECT a FROM t"
+    assert sql_cache.normalize_sql("SELECT 'a  -- b' FROM t") == "SELECT 'a  -- b' FROM t"
+
+
+def test_referenced_and_written_tables():
+    sql = "SELECT * FROM public.Orders o JOIN \"Customers\" c ON c.id = o.customer_id WHERE note = 'from x'"
+    assert sql_cache.referenced_tables(sql) == ["Customers", "orders"]
+    assert sql_cache.written_tables("INSERT INTO orders VALUES (1)") == ["orders"]
+    assert sql_cache.written_tables("SELECT * FROM orders") == []
+
+
+def test_repeated_query_is_served_from_the_cache(engine):
+    engine, queries, lookups = engine
+    first = pd.read_sql_query("SELECT id, amount FROM orders WHERE amount > 10", engine)
+    second = pd.read_sql_query("SELECT id, amount\n  FROM orders -- again\n WHERE amount > 10;", engine)
+    assert len(queries) == 1
+    assert lookups == ["miss", "hit"]
+    pd.testing.assert_frame_equal(first, second)
+    # 返したDataFrameを変更してもキャッシュは変わらない
+    second.loc[0, "amount"] = 0
+    assert pd.read_sql_query("SELECT id, amount FROM orders WHERE amount > 10", engine)["amount"].tolist() == [20, 30]
+
+
+def test_volatile_queries_are_not_cached(engine):
+    engine, queries, lookups = engine
+    for _ in range(2):
+        pd.read_sql_query("SELECT id, random() AS r FROM orders", engine)
+    assert len(queries) == 2
+    assert lookups == ["bypass", "bypass"]
+
+
+def test_writes_invalidate_cached_queries(engine):
+    engine, queries, lookups = engine
+    sql = "SELECT sum(amount) AS total FROM orders"
+    assert pd.read_sql_query(sql, engine)["total"].tolist() == [60]
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO orders VALUES (4, 40)"))
+    assert pd.read_sql_query(sql, engine)["total"].tolist() == [100]
+    assert lookups == ["miss", "miss"]
+
+
+def test_entries_expire(engine, monkeypatch):
+    engine, queries, lookups = engine
+    monkeypatch.setattr(sql_cache, "SANDBOX_SQL_CACHE_TTL", 60)
+    now = [1000.0]
+    monkeypatch.setattr(sql_cache.time, "time", lambda: now[0])
+    sql = "SELECT id FROM orders"
+    pd.read_sql_query(sql, engine)
+    now[0] += 30
+    pd.read_sql_query(sql, engine)
+    now[0] += 61
+    pd.read_sql_query(sql, engine)
+    assert lookups == ["miss", "hit", "miss"]
+
+
+def test_changes_outside_the_app_invalidate_cached_queries(engine, monkeypatch):
+    engine, queries, lookups = engine
+    changes = {"orders": "16384:3"}
+    monkeypatch.setattr(sql_cache, "table_changes", lambda tables: {table: changes[table] for table in tables})
+    sql = "SELECT id FROM orders"
+    pd.read_sql_query(sql, engine)
+    pd.read_sql_query(sql, engine)
+    changes["orders"] = "16384:4"
+    pd.read_sql_query(sql, engine)
+    assert lookups == ["miss", "hit", "miss"]
+
+
+def test_whole_table_reads_use_a_fresh_snapshot(engine, monkeypatch):
+    engine, queries, lookups = engine
+    frame = pd.DataFrame({"id": [7], "amount": [70]})
+    os.makedirs(sql_cache.TABLE_SNAPSHOT_DIR)
+    table = pa.Table.from_pandas(frame)
+    with pa.OSFile(sql_cache.snapshot_path("orders"), "wb") as f:
+        with pa.ipc.new_file(f, table.schema) as writer:
+            writer.write_table(table)
+    pd.testing.assert_frame_equal(pd.read_sql_query("SELECT * FROM orders", engine), frame)
+    assert queries == []
+    assert lookups == ["snapshot"]
+    # カーネルで変更したテーブルのスナップショットは使わない
+    sql_cache.mark_snapshots_stale(["orders"])
+    assert pd.read_sql_query("SELECT * FROM orders", engine)["id"].tolist() == [1, 2, 3]
@@ -0,0 +1,44 @@
+import io
+import os
+import time
+import pandas as pd
+import pyarrow as pa
+import matplotlib.pyplot as plt
+from sqlalchemy import create_engine
+import columnar
+
+
+def warm_up():
+    """
+    カーネルが最初の実行で行う遅延初期化(フォントキャッシュ、描画バックエンド、各種変換処理など)を済ませる
+    forkserverで読み込むことで、そこからforkする全てのカーネルが初期化済みの状態で起動する
+    """
+    started_at = time.perf_counter()
+    try:
+        # 日本語フォントの読み込みと描画バックエンドの初期化
+        fig, ax = plt.subplots()
+        ax.plot([0, 1], [0, 1], label="ウォームアップ")
+        ax.set_title("ウォームアップ")
+        ax.legend()
+        for image_format in ("png", "svg"):
+            fig.savefig(io.BytesIO(), format=image_format)
+        plt.close(fig)
+
+        # pandasの集計・結合・JSON変換とArrowとの変換
+        frame = pd.DataFrame({"key": ["a", "b", "a"], "value": [1.0, 2.0, 3.0], "at": pd.to_datetime(["2024-01-01"] * 3)})
+        grouped = frame.groupby("key", as_index=False)["value"].sum()
+        frame.merge(grouped, on="key").to_json(orient="values", date_format="epoch")
+        pa.Table.from_pandas(frame).to_pandas()
+
+        # データベースドライバの読み込み(接続はカーネルごとに行う)
+        create_engine(os.getenv("USER_DATABASE_URL", "postgresql://")).dialect
+
+        if columnar.SANDBOX_DUCKDB and columnar.duckdb is not None:
+            columnar.duckdb.connect(":memory:").execute("select 1").fetchall()
+    except Exception as e:
+        print(f"Sandbox warm-up failed: {e}")
+        return
+    print(f"Sandbox warm-up finished in {time.perf_counter() - started_at:.2f}s")
+
+
+warm_up()
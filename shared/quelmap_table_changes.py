@@ -0,0 +1,30 @@
+# APIサーバーとサンドボックスで共通の、アプリを経由しないテーブルの変更の検出
+# (各イメージのビルド時にコピーし、どちらもトップレベルのモジュールとして読み込む)
+from typing import Dict, Iterable
+
+# PostgreSQLの統計情報の行の変更数の累計。テーブルを作り直した場合はrelidが変わる
+# 統計はトランザクションの終了後に遅れて反映され、TRUNCATEは数えられないため、有効期限と組み合わせて使う
+TABLE_CHANGES_SQL = """
+SELECT relname, relid, n_tup_ins + n_tup_upd + n_tup_del
+FROM pg_catalog.pg_stat_user_tables
+WHERE relname = ANY(%(names)s)
+ORDER BY relid
+"""
+
+
+def table_change_counters(dbapi_connection, table_names: Iterable[str]) -> Dict[str, str]:
+    """
+    テーブルごとの変更の累計を返す(値が変わっていればテーブルが変更されている)
+    SQLAlchemyのイベントを通さないよう、DBAPIの接続を受け取る
+    """
+    counters: Dict[str, str] = {}
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(TABLE_CHANGES_SQL, {"names": list(table_names)})
+        for name, relid, changes in cursor.fetchall():
+            # スキーマが異なる同名のテーブルはすべての値を並べる
+            counter = f"{relid}:{changes}"
+            counters[name] = f"{counters[name]},{counter}" if name in counters else counter
+    finally:
+        cursor.close()
+    return counters